@@ -1,6 +1,7 @@
 
-from locust import task, between, FastHttpUser, events
+from locust import task, between, FastHttpUser, LoadTestShape, events
 from anls_star import anls_score as anls_star_score
+from gevent.pool import Pool
 
 import pandas as pd
 import queue
@@ -9,15 +10,33 @@ from gradio_client import Client, handle_file
 
 import json
 import time
+import itertools
 import numpy as np
 
 from datetime import datetime
 import os
+import sys
+
+# Answer similarity shared with the backend
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from similarity import anls_score
 
 
 path = "data/T1-SP-DocVQA/val_v1.0_withQT.json"
 root_dir = "data/T1-SP-DocVQA/"
 output_dir = "output"
+host_url = os.environ.get("GRADIO_URL", "http://localhost/")
+
+# Benchmark mode: fixed-rate open-loop load, results are kept in memory and written once at the end
+#   BENCHMARK_MODE=1 BENCHMARK_PROFILE="1:120,2:120" locust -f locustfile.py --headless
+# The profile lists "<requests per second>:<seconds>" stages, arrivals do not wait for earlier responses.
+BENCHMARK_MODE = os.environ.get("BENCHMARK_MODE", "0") == "1"
+BENCHMARK_PROFILE = os.environ.get("BENCHMARK_PROFILE", "1:300")
+BENCHMARK_USERS = int(os.environ.get("BENCHMARK_USERS", 4))
+BENCHMARK_MAX_IN_FLIGHT = int(os.environ.get("BENCHMARK_MAX_IN_FLIGHT", 64))
+BENCHMARK_FEEDBACK = os.environ.get("BENCHMARK_FEEDBACK", "0") == "1"
+MAX_RECORDS = int(os.environ["MAX_RECORDS"]) if "MAX_RECORDS" in os.environ else None
 
 #  Loads all records from the SP-DocVQA Datasets as dataframes and adds new columns
 def prepare_dataset(max_records=None):
@@ -32,7 +51,8 @@ def prepare_dataset(max_records=None):
     if max_records:
         df = df.iloc[:max_records]
     
-    df = remove_indices_from_df("output", df)
+    if not BENCHMARK_MODE:
+        df = remove_indices_from_df(output_dir, df)
 
     df[['inference_id', 'inference_answer', 'ANLS', 'ANLS*', 'Accuracy']] = None
     df['full_image_path'] = [root_dir + image_file for image_file in df['image']]
@@ -75,49 +95,6 @@ def string_accuracy(str1, str2):
     return accuracy
 
 
-def levenshtein_distance(str1, str2):
-    len_str1 = len(str1) + 1
-    len_str2 = len(str2) + 1
-
-
-    matrix = np.zeros((len_str1, len_str2))
-
-
-    for i in range(len_str1):
-        matrix[i, 0] = i
-    for j in range(len_str2):
-        matrix[0, j] = j
-
-
-    for i in range(1, len_str1):
-        for j in range(1, len_str2):
-            cost = 0 if str1[i - 1] == str2[j - 1] else 1
-            matrix[i, j] = min(matrix[i - 1, j] + 1,      # Insert
-                               matrix[i, j - 1] + 1,      # Remove
-                               matrix[i - 1, j - 1] + cost)  # Replace
-
-    return matrix[len_str1 - 1, len_str2 - 1]
-
-
-def anls_score(str1, str2):
-
-    lev_distance = levenshtein_distance(str1, str2)
-    
-    max_len = max(len(str1), len(str2))
-    
-    if max_len == 0:
-        return 1.0
-    
-    normalized_lev_distance = lev_distance / max_len
-    
-    if normalized_lev_distance >= 0.5:
-        anls = 0.0
-    else:
-        anls = 1 - normalized_lev_distance
-    
-    return anls
-
-
 def call_inference(client, question, image_path):
     
     result = client.predict(
@@ -160,9 +137,26 @@ def give_incorrect_feedback(client, id_label):
 
 
 
+def record_request(environment, name, start, exception=None):
+
+    environment.events.request.fire(
+        request_type="gradio",
+        name=name,
+        response_time=(time.perf_counter() - start) * 1000,
+        response_length=0,
+        exception=exception,
+        context={}
+    )
+
+
 class WebsiteUser(FastHttpUser):
 
-    wait_time = between(1, 5)  
+    wait_time = between(1, 5)
+    abstract = BENCHMARK_MODE
+
+    def on_start(self):
+        # One client per user, creating a client fetches the whole gradio config
+        self.gr_client = Client(host_url)
 
     @task
     def perform_query(self):
@@ -172,22 +166,20 @@ class WebsiteUser(FastHttpUser):
 
             print(f"[*] {data_queue.qsize()}/{len(df)}")
 
-            gr_client = Client("http://localhost/")
-
             try:
                   
-                inference_answer, inference_id = call_inference(gr_client, row['question'], row['full_image_path'])
+                inference_answer, inference_id = call_inference(self.gr_client, row['question'], row['full_image_path'])
                             
                 anls_star, anls, accuracy_score = evaluate_result(row['answers'], inference_answer)
 
                 if anls_star >= 0.8:
                     time.sleep(1)
-                    give_correct_feedback(gr_client, inference_id)
+                    give_correct_feedback(self.gr_client, inference_id)
 
 
                 else:
                     time.sleep(1)
-                    give_incorrect_feedback(gr_client, inference_id)
+                    give_incorrect_feedback(self.gr_client, inference_id)
 
                 df.at[index, 'inference_id'] = inference_id
                 df.at[index, 'inference_answer'] = inference_answer
@@ -209,21 +201,190 @@ class WebsiteUser(FastHttpUser):
             print("QUEUE EMPTY")
             self.stop(True)
 
+
+#########################################################################
+### Benchmark Mode
+#########################################################################
+
+# Parses "<rps>:<seconds>,..." into a list of (end_time, rps) stages
+def parse_profile(profile):
+
+    stages = []
+    end_time = 0.0
+
+    for stage in profile.split(","):
+        rate, duration = stage.split(":")
+        end_time += float(duration)
+        stages.append((end_time, float(rate)))
+
+    return stages
+
+
+benchmark_stages = parse_profile(BENCHMARK_PROFILE)
+benchmark_results = []
+benchmark_start = None
+benchmark_arrivals = itertools.count()
+
+
+def current_rate(elapsed):
+
+    for end_time, rate in benchmark_stages:
+        if elapsed < end_time:
+            return rate
+
+    return None
+
+
+class BenchmarkUser(FastHttpUser):
+
+    abstract = not BENCHMARK_MODE
+
+    def on_start(self):
+        global benchmark_start
+
+        if benchmark_start is None:
+            benchmark_start = time.perf_counter()
+
+        self.gr_client = Client(host_url, verbose=False)
+        self.in_flight = Pool(BENCHMARK_MAX_IN_FLIGHT)
+        self.next_arrival = time.perf_counter()
+
+    # Arrivals follow a fixed schedule per user, independent of how long earlier requests take
+    def wait_time(self):
+
+        rate = current_rate(time.perf_counter() - benchmark_start)
+
+        if not rate:
+            return 1.0
+
+        self.next_arrival += BENCHMARK_USERS / rate
+        return max(0.0, self.next_arrival - time.perf_counter())
+
+    @task
+    def schedule_query(self):
+
+        if self.in_flight.full():
+            # The open-loop schedule can not be kept, the arrival is recorded as dropped
+            benchmark_results.append({"index": None, "status": "dropped", "scheduled": time.perf_counter() - benchmark_start})
+            return
+
+        index = df.index[next(benchmark_arrivals) % len(df)]
+        self.in_flight.spawn(self.run_query, index)
+
+    def run_query(self, index):
+
+        row = df.loc[index]
+        scheduled = time.perf_counter()
+        record = {"index": index, "scheduled": scheduled - benchmark_start}
+
+        try:
+            inference_answer, inference_id = call_inference(self.gr_client, row['question'], row['full_image_path'])
+            record["latency"] = time.perf_counter() - scheduled
+            record_request(self.environment, "/run_distinct_inference", scheduled)
+
+            anls_star, anls, accuracy_score = evaluate_result(row['answers'], inference_answer)
+            record.update({"status": "ok", "inference_id": inference_id, "inference_answer": inference_answer, "ANLS": anls, "ANLS*": anls_star, "Accuracy": accuracy_score})
+
+            if BENCHMARK_FEEDBACK:
+                if anls_star >= 0.8:
+                    give_correct_feedback(self.gr_client, inference_id)
+                else:
+                    give_incorrect_feedback(self.gr_client, inference_id)
+
+        except Exception as e:
+            record.update({"status": "error", "latency": time.perf_counter() - scheduled, "error": str(e)})
+            record_request(self.environment, "/run_distinct_inference", scheduled, e)
+
+        benchmark_results.append(record)
+
+
+if BENCHMARK_MODE:
+
+    class FixedRateShape(LoadTestShape):
+        """ Keeps BENCHMARK_USERS users alive until the last stage of the profile is over. """
+
+        def tick(self):
+
+            if self.get_run_time() >= benchmark_stages[-1][0]:
+                return None
+
+            return (BENCHMARK_USERS, BENCHMARK_USERS)
+
+
+def summarize_benchmark(results, duration):
+
+    results_df = pd.DataFrame(results)
+
+    if results_df.empty:
+        # No request was scheduled, e.g. the run was stopped right away
+        return results_df, {
+            "profile": BENCHMARK_PROFILE,
+            "duration_s": duration,
+            "scheduled": 0,
+            "completed": 0,
+            "errors": 0,
+            "dropped": 0,
+            "throughput_rps": 0.0,
+        }
+
+    completed = results_df[results_df["status"] == "ok"]
+    latencies = completed["latency"].to_numpy(dtype=float)
+
+    summary = {
+        "profile": BENCHMARK_PROFILE,
+        "duration_s": duration,
+        "scheduled": len(results_df),
+        "completed": len(completed),
+        "errors": int((results_df["status"] == "error").sum()),
+        "dropped": int((results_df["status"] == "dropped").sum()),
+        "throughput_rps": len(completed) / duration if duration else 0.0,
+    }
+
+    if len(latencies):
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        summary.update({
+            "latency_p50_s": p50,
+            "latency_p95_s": p95,
+            "latency_p99_s": p99,
+            "ANLS": completed["ANLS"].astype(float).mean(),
+            "ANLS*": completed["ANLS*"].astype(float).mean(),
+            "Accuracy": completed["Accuracy"].astype(float).mean(),
+        })
+
+    return results_df, summary
+
     
 @events.test_stop.add_listener
 def export_data(environment, **kwargs):
 
+    if BENCHMARK_MODE:
+
+        duration = time.perf_counter() - benchmark_start if benchmark_start else 0.0
+        results_df, summary = summarize_benchmark(benchmark_results, duration)
+
+        run_name = datetime.now().strftime("%Y%m%d-%H%M%S")
+        results_df.to_parquet(f'{output_dir}/benchmark_{run_name}.parquet', index=False)
+
+        with open(f'{output_dir}/benchmark_{run_name}.json', 'w') as f:
+            json.dump(summary, f, indent=2, default=float)
+
+        print(json.dumps(summary, indent=2, default=float))
+        return
+
     df.to_csv(f'{output_dir}/updated_data.csv', index=False)
     print("Dataset exported.")
 
 
 
 
-df = prepare_dataset()
+df = prepare_dataset(MAX_RECORDS)
 data_queue = queue.Queue()
 prepare_data_queue()
 
 
 #webui
 #locust -f locustfile.py --host=http://localhost
-#http://localhost:8089
\ No newline at end of file
+#http://localhost:8089
+
+#benchmark
+#BENCHMARK_MODE=1 BENCHMARK_PROFILE="1:120,2:120,4:120" locust -f locustfile.py --host=http://localhost --headless
@@ -0,0 +1,172 @@
+import os
+import math
+import time
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+#########################################################################
+### Admission Control
+#########################################################################
+#
+# Every gunicorn worker runs a bounded number of inferences per model at the same time.
+# Further requests wait in a bounded priority queue, everything beyond that is shed
+# immediately with a retry hint instead of timing out together with all other requests.
+
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get('ADMISSION_MAX_CONCURRENCY', 1))
+ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', 4))
+ADMISSION_MAX_WAIT = float(os.environ.get('ADMISSION_MAX_WAIT', 30))
+
+# Low priority requests may only occupy this share of the queue
+ADMISSION_LOW_PRIORITY_QUEUE_SHARE = float(os.environ.get('ADMISSION_LOW_PRIORITY_QUEUE_SHARE', 0.5))
+
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+
+def normalize_priority(priority):
+    """ Maps a client supplied priority to a key of PRIORITIES, unknown values are treated as "normal". """
+
+    priority = str(priority).strip().lower()
+    return priority if priority in PRIORITIES else "normal"
+
+
+class AdmissionRejected(Exception):
+    """ Raised if a request is shed by the admission controller. """
+
+    def __init__(self, model_name, reason, retry_after):
+        super().__init__(f"{model_name} is overloaded ({reason}), retry after {retry_after}s")
+        self.model_name = model_name
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """ Limits concurrent inferences of one model within a worker process and queues a bounded amount of requests by priority. """
+
+    def __init__(self, model_name, max_concurrency, max_queue, max_wait):
+        self.model_name = model_name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+
+        # Exponentially weighted average of the service time, used to estimate Retry-After
+        self.avg_service_time = 1.0
+
+    def retry_after(self):
+        """ Estimates in seconds when a free slot is likely available. """
+
+        pending = len(self.waiting) + self.active
+        return max(1, math.ceil(pending * self.avg_service_time / self.max_concurrency))
+
+    def reject(self, priority, reason):
+        metrics.inc_admission_shed(self.model_name, priority, reason)
+        raise AdmissionRejected(self.model_name, reason, self.retry_after())
+
+    def acquire(self, priority="normal", deadline=None):
+        """
+        Waits for a free slot.
+
+        Args:
+            priority (str): "high", "normal" or "low", higher priorities are admitted first. Other values count as "normal".
+            deadline (float): Optional time.time() timestamp after which waiting is pointless.
+
+        Raises:
+            AdmissionRejected: If the queue is full, the deadline passed or no slot became available in time.
+        """
+
+        # Used as metric label, so only known priorities are passed on
+        priority = normalize_priority(priority)
+        rank = PRIORITIES[priority]
+        wait_start = time.perf_counter()
+        timeout = self.max_wait
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.time())
+
+        with self.condition:
+
+            if self.active < self.max_concurrency and not self.waiting:
+                self.active += 1
+                metrics.update_admission_active(self.model_name, 1)
+                metrics.update_admission_wait_duration(self.model_name, priority, 0.0)
+                return
+
+            queue_limit = self.max_queue
+            if rank == PRIORITIES["low"]:
+                queue_limit = int(self.max_queue * ADMISSION_LOW_PRIORITY_QUEUE_SHARE)
+
+            if timeout <= 0:
+                self.reject(priority, "deadline")
+
+            if len(self.waiting) >= queue_limit:
+                self.reject(priority, "queue_full")
+
+            ticket = (rank, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+            metrics.update_admission_queue_depth(self.model_name, 1)
+
+            try:
+                admitted = self.condition.wait_for(
+                    lambda: self.active < self.max_concurrency and self.waiting[0] == ticket,
+                    timeout=timeout
+                )
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                metrics.update_admission_queue_depth(self.model_name, -1)
+
+            if not admitted:
+                # The next waiter may be admissible now that this ticket left the queue
+                self.condition.notify_all()
+                self.reject(priority, "wait_timeout")
+
+            self.active += 1
+            metrics.update_admission_active(self.model_name, 1)
+
+            # The new head of the queue may have checked its predicate while this ticket was still ahead of it
+            if self.active < self.max_concurrency:
+                self.condition.notify_all()
+
+        metrics.update_admission_wait_duration(self.model_name, priority, time.perf_counter() - wait_start)
+
+    def release(self, service_time):
+        with self.condition:
+            self.active -= 1
+            self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * service_time
+            metrics.update_admission_active(self.model_name, -1)
+            self.condition.notify_all()
+
+    @contextmanager
+    def admit(self, priority="normal", deadline=None):
+        self.acquire(priority, deadline)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - start)
+
+
+controllers = {}
+controllers_lock = threading.Lock()
+
+
+def get_controller(model_name):
+    """ Returns the admission controller of a given model, creating it on first use. """
+
+    with controllers_lock:
+        if model_name not in controllers:
+            controllers[model_name] = AdmissionController(model_name, ADMISSION_MAX_CONCURRENCY, ADMISSION_MAX_QUEUE, ADMISSION_MAX_WAIT)
+        return controllers[model_name]
+
+
+def admit(model_name, priority="normal", deadline=None):
+    """ Context manager admitting a request of a given model, raises AdmissionRejected if the request is shed. """
+
+    return get_controller(model_name).admit(priority, deadline)
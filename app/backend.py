@@ -1,95 +1,263 @@
-from flask import Flask, request, jsonify, send_file, Response
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context
+import json
+import time
 from datetime import datetime
 import io
+import os
 from PIL import Image
-from prometheus_client import multiprocess
-from prometheus_client import make_wsgi_app, generate_latest, CollectorRegistry, CONTENT_TYPE_LATEST
-from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
-import model.layoutlmv3 as layoutlmv3
+from model import registry
 
 import database
 import metrics
+import admission
+import deadline as deadlines
+import profiling
+import multiprocess_metrics
+import retention
+import framing
+import singleflight
+import log
 
 
-
+logger = log.get_logger("backend")
 
 
 app = Flask(__name__)
 
-app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {
-        '/metrics': make_wsgi_app()
-})
-
 # Initialize Database
-print("[*] Backend: Initialize Database", flush=True)
+logger.info("Initialize Database")
 initialize_db_start = datetime.now()
 database.initialize_mongodb()
 database.initialize_minio()
 initialize_db_end= datetime.now()
-print("[*] Backend: Database initialized", flush=True)
+logger.info("Database initialized")
 
 metrics.update_initialization_duration("layoutlmv3", "Databases", initialize_db_start, initialize_db_end)
 
+# Lookup and TTL indexes, the archival itself runs periodically in the background
+for model_name in registry.MODELS:
+    try:
+        database.ensure_indexes(model_name)
+    except Exception as e:
+        logger.warning(f"Could not ensure indexes of {model_name}: {e}", extra={"model_name": model_name})
+
+retention.start_scheduler()
 
-print("[*] Backend: Backend ready", flush=True)
+
+logger.info("Backend ready")
 
 
 @app.route("/metrics")
 def get_metrics():
-    """ Retrieves Prometheus metrics from the multi-process collector and returns them as a response. """
+    """ Retrieves Prometheus metrics aggregated over all workers by the multi-process collector and returns them as a response. """
+
+    if multiprocess_metrics.get_directory():
+        data = multiprocess_metrics.generate_metrics()
+    else:
+        # Single process, e.g. started with python backend.py
+        data = generate_latest()
 
-    registry = CollectorRegistry()
-    multiprocess.MultiProcessCollector(registry)
-    data = generate_latest(registry)
     return Response(data, mimetype=CONTENT_TYPE_LATEST)
 
 
 #########################################################################
-### LayoutLMv3 Inference Endpoints
+### Inference Endpoints
 #########################################################################
 
 
-@app.route('/layoutlmv3/distinct_inference', methods=['POST'])
-def distinct_inference_route():
+@app.errorhandler(registry.UnknownModel)
+def unknown_model_handler(e):
+    return jsonify({"error": str(e)}), 404
+
+
+def run_inference(model, question, image, inference_id, request_timestamp, deadline, priority, inference_start, endpoint):
+    """
+    Runs an admitted inference and updates the request metrics, shared by the multipart and the binary endpoint.
+
+    Concurrent identical requests are coalesced by singleflight.py.
+
+    Raises:
+        admission.AdmissionRejected: If the request exceeds the admission limits.
+        deadlines.DeadlineExceeded: If the deadline passed before an expensive stage or while waiting for a coalesced request.
+    """
+
+    def compute():
+        deadlines.check_deadline(model, deadline, "admission")
+
+        with admission.admit(model, priority, deadline), registry.use(model) as pipeline:
+            return profiling.profile_call(model, inference_id, pipeline.start_inference, question, image, inference_id, deadline)
+
+    # Every log record of the pipeline carries the inference id of the request
+    log_context = log.inference_id.set(inference_id)
+
+    try:
+        # Identical requests in flight share one inference, every request still gets its own record
+        key = singleflight.request_key(model, image, question)
+        result, leader_inference_id = singleflight.run(model, key, inference_id, deadline, compute)
+
+        if leader_inference_id is not None:
+            logger.info(f"Inference coalesced with {leader_inference_id}", extra={"model_name": model})
+            database.clone_entry(model, leader_inference_id, inference_id, question)
+
+        inference_end = datetime.now()
+        logger.info("Inference finished", extra={"model_name": model, "stage": endpoint, "duration": (inference_end - inference_start).total_seconds()})
+
+    finally:
+        log.inference_id.reset(log_context)
+
+    metrics.inc_successful__inference(model)
+    metrics.calculate_backend_inference_duration(model, inference_start, inference_end)
+    metrics.update_endpoint_latency(model, endpoint, inference_start, request_timestamp)
+    metrics.calculate_total_inference_duration(model, request_timestamp, inference_end)
+    metrics.update_worker_memory()
+
+    return result
+
+
+@app.route('/<model>/distinct_inference', methods=['POST'])
+def distinct_inference_route(model):
     """
     Receives an inference POST request from the frontend containing an Image, a questiond and the coresponding inference id
 
+    The model is loaded by the model registry on its first request.
+
+    The optional priority ("high", "normal", "low") can be given by the X-Priority header or a priority form field.
+    Requests exceeding the admission limits are rejected with 429 and a Retry-After header.
+
+    The optional deadline form field (seconds since epoch) bounds the work spent on the request,
+    requests whose deadline passed before an expensive stage are aborted with 504.
+
     Returns:
         dict: The JSON response containing the inference result and the coresponding inference id.
     """
+    registry.get_spec(model)
+
     inference_start = datetime.now()
-    print("[*] Backend: Receiving Input", flush=True)
+    logger.debug("Receiving Input", extra={"model_name": model})
     try:
 
+        parse_start = time.perf_counter()
 
         question = request.form['question']
         inference_id = request.form['inference_id']
         image_file = request.files['image']
-        request_timestamp_string = request.form['timestamp']
-        request_timestamp = datetime.strptime(request_timestamp_string, "%Y-%m-%d %H:%M:%S")
+
+        try:
+            request_timestamp = deadlines.parse_timestamp(request.form['timestamp'])
+            deadline = deadlines.parse_deadline(request.form.get('deadline'))
+        except (ValueError, TypeError, OverflowError) as e:
+            # A client error, not counted as failed inference
+            logger.warning(f"Rejecting inference - invalid timestamp or deadline: {e}", extra={"inference_id": inference_id, "model_name": model, "status": 400})
+            return jsonify({"error": f"Invalid timestamp or deadline: {e}"}), 400
+
+        priority = request.headers.get('X-Priority', request.form.get('priority', 'normal'))
         
         image = image_file.read()
-        result = layoutlmv3.start_inference(question, image, inference_id)
-        
-        inference_end = datetime.now()
-        
-        metrics.inc_successful__inference("layoutlmv3")
-        metrics.calculate_backend_inference_duration("layoutlmv3", inference_start, inference_end)
-        metrics.update_endpoint_latency("layoutlmv3", "distinct_inference", inference_start, request_timestamp)
-        metrics.calculate_total_inference_duration("layoulmv3", request_timestamp, inference_end)
-        print("[*] Backend: Sending results", flush=True)
+
+        metrics.update_request_parse_duration(model, "multipart", time.perf_counter() - parse_start)
+
+        result = run_inference(model, question, image, inference_id, request_timestamp, deadline, priority, inference_start, "distinct_inference")
 
         return jsonify({"result": result, "inference_id": inference_id})
 
+    except admission.AdmissionRejected as e:
+
+        logger.warning(f"Shedding inference - {e.reason}", extra={"inference_id": inference_id, "model_name": model, "status": 429})
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+
+    except deadlines.DeadlineExceeded as e:
+
+        logger.warning(f"Dropping inference - {str(e)}", extra={"inference_id": inference_id, "model_name": model, "stage": e.stage, "status": 504})
+        return jsonify({"error": str(e), "stage": e.stage}), 504
+
     except Exception as e:
         
-        metrics.inc_unsuccessful__inference("layoutlmv3")
+        logger.exception("Inference failed", extra={"model_name": model, "status": 500})
+        metrics.inc_unsuccessful__inference(model)
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/layoutlmv3/handle_feedback', methods=['POST'])
-def handle_feedback_route():
+def binary_inference(model, header, image, priority):
+    """ Runs the inference of a single frame and returns its response payload, errors are reported per frame. """
+
+    inference_start = datetime.now()
+    inference_id = header['inference_id']
+
+    try:
+        request_timestamp = deadlines.parse_timestamp(header['timestamp'])
+        deadline = deadlines.parse_deadline(header.get('deadline'))
+    except (ValueError, TypeError, OverflowError) as e:
+        # A client error, not counted as failed inference
+        logger.warning(f"Rejecting inference - invalid timestamp or deadline: {e}", extra={"inference_id": inference_id, "model_name": model, "status": 400})
+        return {"inference_id": inference_id, "status": 400, "error": f"Invalid timestamp or deadline: {e}"}
+
+    try:
+        priority = header.get('priority', priority)
+
+        result = run_inference(model, header['question'], image, inference_id, request_timestamp, deadline, priority, inference_start, "binary_inference")
+
+        return {"inference_id": inference_id, "status": 200, "result": result}
+
+    except admission.AdmissionRejected as e:
+
+        logger.warning(f"Shedding inference - {e.reason}", extra={"inference_id": inference_id, "model_name": model, "status": 429})
+        return {"inference_id": inference_id, "status": 429, "error": str(e), "retry_after": e.retry_after}
+
+    except deadlines.DeadlineExceeded as e:
+
+        logger.warning(f"Dropping inference - {str(e)}", extra={"inference_id": inference_id, "model_name": model, "stage": e.stage, "status": 504})
+        return {"inference_id": inference_id, "status": 504, "error": str(e), "stage": e.stage}
+
+    except Exception as e:
+
+        logger.exception("Inference failed", extra={"inference_id": inference_id, "model_name": model, "status": 500})
+        metrics.inc_unsuccessful__inference(model)
+        return {"inference_id": inference_id, "status": 500, "error": str(e)}
+
+
+@app.route('/<model>/binary_inference', methods=['POST'])
+def binary_inference_route(model):
+    """
+    Receives one or more length-prefixed inference frames in the request body, see framing.py.
+
+    Frames are read from the request stream without multipart parsing and answered one after another,
+    each response frame is sent as soon as its inference finished. The X-Priority header applies to
+    all frames without a priority of their own.
+
+    Returns:
+        Streamed response frames, one per request frame. A malformed frame ends the response with a 400 frame.
+    """
+
+    registry.get_spec(model)
+
+    stream = request.stream
+    priority = request.headers.get('X-Priority', 'normal')
+
+    def generate():
+        while True:
+            parse_start = time.perf_counter()
+
+            try:
+                header, image = framing.read_frame(stream)
+            except framing.FramingError as e:
+                logger.warning(f"Invalid inference frame - {str(e)}", extra={"model_name": model, "status": 400})
+                yield framing.encode_response({"status": 400, "error": str(e)})
+                return
+
+            if header is None:
+                return
+
+            metrics.update_request_parse_duration(model, "binary", time.perf_counter() - parse_start)
+
+            yield framing.encode_response(binary_inference(model, header, image, priority))
+
+    return Response(stream_with_context(generate()), mimetype=framing.CONTENT_TYPE)
+
+
+@app.route('/<model>/handle_feedback', methods=['POST'])
+def handle_feedback_route(model):
     """
     Receives an POST request in ordner to update the contained feedback type in the database.
 
@@ -97,28 +265,123 @@ def handle_feedback_route():
         dict: Status Code
     """
 
-    print("[*] Backend: Receiving Feedback", flush=True)
+    registry.get_spec(model)
+
+    logger.debug("Receiving Feedback", extra={"model_name": model})
     try:
         feedback_type = request.form['feedback_type']
         inference_id = request.form['inference_id']
-        request_timestamp_string = request.form['timestamp']
-        request_timestamp = datetime.strptime(request_timestamp_string, "%Y-%m-%d %H:%M:%S")
+        request_timestamp = deadlines.parse_timestamp(request.form['timestamp'])
 
-        database.update_feedback_type("layoutlmv3", inference_id, feedback_type)
+        database.update_feedback_type(model, inference_id, feedback_type)
         
-        metrics.update_user_feedback_counter("layoutlmv3", feedback_type)
-        metrics.update_endpoint_latency("layoutlmv3", "handle_feedback", datetime.now(), request_timestamp)
+        metrics.update_user_feedback_counter(model, feedback_type)
+        metrics.update_endpoint_latency(model, "handle_feedback", datetime.now(), request_timestamp)
         
-        print(f"[*] Backend: updated {feedback_type} Feedback for inference {inference_id}", flush=True)
+        logger.info(f"Updated {feedback_type} Feedback", extra={"inference_id": inference_id, "model_name": model})
 
         return jsonify({"message": "Feedback received"}), 200
 
     except Exception as e:
         
-        print(f"[*] Backend: Handling Feedback Error - {str(e)}", flush=True)
+        logger.error(f"Handling Feedback Error - {str(e)}", extra={"model_name": model, "status": 500})
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/<model>/handle_feedback_bulk', methods=['POST'])
+def handle_feedback_bulk_route(model):
+    """
+    Receives a JSON POST request containing a list of feedback items in order to update all of them with a single bulk write.
+
+    Expected body: {"feedback": [{"inference_id": "...", "feedback_type": "correct"}, ...], "timestamp": "..."}
+
+    Returns:
+        dict: Per-item matched status as well as the amount of matched and unmatched items.
+    """
+
+    registry.get_spec(model)
+
+    logger.debug("Receiving Bulk Feedback", extra={"model_name": model})
+    try:
+        payload = request.get_json(force=True)
+        request_timestamp = deadlines.parse_timestamp(payload['timestamp'])
+
+        feedback_items = [(item['inference_id'], item['feedback_type']) for item in payload['feedback']]
+
+        if not feedback_items:
+            return jsonify({"error": "No feedback items given"}), 400
+
+        statuses = database.bulk_update_feedback_type(model, feedback_items)
+
+        matched_feedback_types = [status['feedback_type'] for status in statuses if status['matched']]
+
+        metrics.update_user_feedback_counter_bulk(model, matched_feedback_types)
+        metrics.update_endpoint_latency(model, "handle_feedback_bulk", datetime.now(), request_timestamp)
+
+        logger.info(f"Updated {len(matched_feedback_types)} of {len(statuses)} Feedback items", extra={"model_name": model})
+
+        return jsonify({
+            "results": statuses,
+            "matched": len(matched_feedback_types),
+            "unmatched": len(statuses) - len(matched_feedback_types)
+        }), 200
+
+    except (KeyError, TypeError, ValueError) as e:
+
+        return jsonify({"error": f"Invalid bulk feedback request: {str(e)}"}), 400
+
+    except Exception as e:
+        
+        logger.error(f"Handling Bulk Feedback Error - {str(e)}", extra={"model_name": model, "status": 500})
+        return jsonify({"error": str(e)}), 500
+
+
+#########################################################################
+### Admin Endpoints
+#########################################################################
+
+
+@app.route('/admin/profile', methods=['GET', 'POST'])
+def profile_endpoint():
+    """
+    Arms the profiler for the next N inference requests (POST {"requests": N}) or lists stored profiles (GET).
+
+    Requires the X-Admin-Token header to match the ADMIN_TOKEN environment variable, an empty ADMIN_TOKEN disables the endpoint.
+    """
+
+    if not profiling.is_authorized(request.headers.get('X-Admin-Token')):
+        return jsonify({"error": "Forbidden"}), 403
+
+    try:
+        if request.method == 'POST':
+            payload = request.get_json(silent=True) or {}
+            armed = profiling.arm(int(payload.get('requests', 1)))
+            logger.info(f"Profiling the next {armed} inference requests")
+            return jsonify({"armed": armed})
+
+        return jsonify({"remaining": profiling.remaining(), "profiles": profiling.list_profiles()})
+
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Invalid profiling request: {str(e)}"}), 400
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/admin/profile/<profile>/<file_name>', methods=['GET'])
+def profile_file_endpoint(profile, file_name):
+    """ Downloads a single file of a stored profile. """
+
+    if not profiling.is_authorized(request.headers.get('X-Admin-Token')):
+        return jsonify({"error": "Forbidden"}), 403
+
+    files = profiling.list_profiles().get(profile)
+    if not files or file_name not in files:
+        return jsonify({"error": "No profile found with that name"}), 404
+
+    return send_file(os.path.join(profiling.PROFILE_OUTPUT_DIR, profile, file_name), as_attachment=True)
+
+
 #########################################################################
 ### Database Endpoints
 #########################################################################
@@ -126,14 +389,19 @@ def handle_feedback_route():
 
 @app.route('/get_image_by_id/<model>/<inference_id>', methods=['GET'])
 def get_image_by_id_endpoint(model, inference_id):
+    """ Returns the stored image of an entry in its stored encoding, or its JPEG thumbnail with ?thumbnail=true. """
+
     try:
-        image_data = database.get_image_by_id(model, inference_id)
+        thumbnail = request.args.get('thumbnail', 'false').lower() == 'true'
+
+        image_data, content_type = database.get_image_by_id(model, inference_id, thumbnail)
         if not image_data:
             return jsonify({"error": "No entry found with that ID"}), 404
 
         img_io = io.BytesIO(image_data)
         img_io.seek(0)
-        return send_file(img_io, mimetype='image/png')
+        # The image of an entry never changes
+        return send_file(img_io, mimetype=content_type, max_age=86400)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -166,6 +434,94 @@ def get_entries_by_id_endpoint(model, inference_id):
 
 
 
+@app.route('/storage_stats/<model>', methods=['GET'])
+def storage_stats_endpoint(model):
+    """ Returns amount, total and average size in bytes of the stored entries and per-image documents. """
+
+    try:
+        return jsonify({"schema": database.STORAGE_SCHEMA, **database.storage_stats(model)})
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/query_entries/<model>', methods=['GET'])
+def query_entries_endpoint(model):
+    """
+    Queries the history of a given model with optional filters and keyset pagination.
+
+    Query parameters:
+        start, end (str): ISO timestamps limiting the time range.
+        feedback_type (str): Feedback type to filter by.
+        min_confidence, max_confidence (float): Confidence range for start and end confidence score.
+        empty_result (str): "true" or "false" in order to filter by empty results.
+        fields (str): Comma separated list of additional fields or "features" for all feature arrays.
+        after (str): Cursor returned by a previous page.
+        limit (int): Page size (JSON) or maximum amount of entries (NDJSON).
+        format (str): "json" for a single page, "ndjson" to stream all matching entries.
+
+    Returns:
+        JSON page with entries and next cursor, or a streamed NDJSON response.
+    """
+
+    try:
+        args = request.args
+
+        start_time = datetime.fromisoformat(args['start']) if 'start' in args else None
+        end_time = datetime.fromisoformat(args['end']) if 'end' in args else None
+        min_confidence = float(args['min_confidence']) if 'min_confidence' in args else None
+        max_confidence = float(args['max_confidence']) if 'max_confidence' in args else None
+        empty_result = args['empty_result'].lower() == 'true' if 'empty_result' in args else None
+        limit = int(args['limit']) if 'limit' in args else None
+        if limit is not None and limit <= 0:
+            return jsonify({"error": "Invalid query: limit must be positive"}), 400
+
+        fields = []
+        for field in filter(None, args.get('fields', '').split(',')):
+            if field == 'features':
+                fields.extend(database.FEATURE_FIELDS)
+            elif field in database.FEATURE_FIELDS:
+                fields.append(field)
+            else:
+                return jsonify({"error": f"Unknown field: {field}"}), 400
+
+        query_filter = database.build_query_filter(
+            start_time=start_time,
+            end_time=end_time,
+            feedback_type=args.get('feedback_type'),
+            min_confidence=min_confidence,
+            max_confidence=max_confidence,
+            empty_result=empty_result,
+            after=args.get('after')
+        )
+
+        database.get_collection(model)
+
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": f"Invalid query: {str(e)}"}), 400
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    if args.get('format', 'json') == 'ndjson':
+
+        def generate():
+            for entry in database.query_entries(model, query_filter, fields, limit=limit):
+                yield json.dumps(entry) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    try:
+        limit = min(limit or 100, 1000)
+        entries = list(database.query_entries(model, query_filter, fields, limit=limit, batch_size=limit))
+        next_cursor = entries[-1]['_id'] if len(entries) == limit else None
+
+        return jsonify({"entries": entries, "next_cursor": next_cursor})
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 if __name__ == '__main__':
 
     app.run(host='0.0.0.0', port=5000, debug=True)
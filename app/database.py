@@ -1,126 +1,598 @@
 import os
-from pymongo import MongoClient
+import time
+import random
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient, UpdateOne, ASCENDING, monitoring
+from pymongo.errors import AutoReconnect, DuplicateKeyError, OperationFailure
+from bson import ObjectId
+from bson.errors import InvalidId
 
 import io
+import gzip
+import json
+import urllib3
 from minio import Minio
 from minio.error import S3Error
+from minio.commonconfig import Filter, ENABLED
+from minio.lifecycleconfig import LifecycleConfig, Rule, Expiration
 
 from PIL import Image
 import hashlib
+from datetime import datetime, timedelta
+
+import metrics
+import log
+from model import registry
+
+logger = log.get_logger("database")
 
 # MongoDB
 mongodb_client = None
 db = None
 collections = {}
+document_collections = {}
+
+# Fields returned by history queries, large feature arrays are only included on request
+ENTRY_FIELDS = ("_id", "inference_id", "timestamp", "question", "image", "result", "feedback_type", "confidence_score_start", "confidence_score_end", "answered_by")
+FEATURE_FIELDS = ("words", "input_ids", "attention_mask", "bbox", "pixel_values")
+# Read for joining and rehydrating features only, not returned to API clients
+INTERNAL_FIELDS = ("image_hash", "archive_object")
+
+# Storage schema of new entries: "embedded" stores all features in every entry, "normalized" stores the
+# per-image features once in a document collection keyed by image hash and references it from the entries.
+# Reads join both transparently, so entries of both schemas can coexist in a collection.
+STORAGE_SCHEMA = os.environ.get('STORAGE_SCHEMA', 'embedded')
+DOCUMENT_FIELDS = ("words", "pixel_values")
+# Fields of a per-image document moved to the archive, see archive_documents()
+DOCUMENT_ARCHIVE_FIELDS = DOCUMENT_FIELDS + ("ocr_boxes",)
 
 # Minio
 minio_client = None
 bucket_name = "my-bucket"
 
+# Images are stored in their original encoding by default. "png" and "webp" recompress losslessly encoded
+# uploads (PNG, TIFF, BMP) losslessly, the original is kept if the recompressed image is not smaller.
+# Lossy uploads (e.g. JPEG photos) and multi-page TIFFs are always stored as they are.
+IMAGE_STORAGE_FORMAT = os.environ.get('IMAGE_STORAGE_FORMAT', 'original')
+THUMBNAIL_SIZE = int(os.environ.get('THUMBNAIL_SIZE', 256))
+THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', 80))
+THUMBNAIL_MAX_PENDING = int(os.environ.get('THUMBNAIL_MAX_PENDING', 32))
+THUMBNAIL_PREFIX = "thumbnails"
+
+LOSSLESS_FORMATS = ("PNG", "TIFF", "BMP")
+
+# PIL format: (file extension, content type)
+IMAGE_FORMATS = {
+    "PNG": ("png", "image/png"),
+    "JPEG": ("jpg", "image/jpeg"),
+    "WEBP": ("webp", "image/webp"),
+    "TIFF": ("tiff", "image/tiff"),
+    "GIF": ("gif", "image/gif"),
+    "BMP": ("bmp", "image/bmp"),
+}
+CONTENT_TYPES = dict(IMAGE_FORMATS.values())
+
+StoredImage = namedtuple('StoredImage', ['data', 'extension', 'content_type'])
+
+# Thumbnails are created by one background thread per process
+thumbnail_executor = None
+thumbnail_pid = None
+thumbnail_pending = 0
+thumbnail_lock = threading.Lock()
+
+# Process ids the clients were created in. Clients are not fork-safe, a forked worker creates its own.
+mongodb_pid = None
+minio_pid = None
+
+# Connection pools and deadlines (pool sizes per worker process, durations in seconds)
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 20))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 0))
+MONGO_POOL_WAIT_TIMEOUT = float(os.environ.get('MONGO_POOL_WAIT_TIMEOUT', 2))
+MONGO_CONNECT_TIMEOUT = float(os.environ.get('MONGO_CONNECT_TIMEOUT', 3))
+MONGO_OPERATION_TIMEOUT = float(os.environ.get('MONGO_OPERATION_TIMEOUT', 10))
+
+MINIO_POOL_SIZE = int(os.environ.get('MINIO_POOL_SIZE', 20))
+MINIO_CONNECT_TIMEOUT = float(os.environ.get('MINIO_CONNECT_TIMEOUT', 3))
+MINIO_READ_TIMEOUT = float(os.environ.get('MINIO_READ_TIMEOUT', 10))
+
+# Retry budget for transient storage errors: exponential backoff with full jitter, bounded by a deadline per operation
+STORAGE_MAX_RETRIES = int(os.environ.get('STORAGE_MAX_RETRIES', 2))
+STORAGE_RETRY_BASE_DELAY = float(os.environ.get('STORAGE_RETRY_BASE_DELAY', 0.1))
+STORAGE_RETRY_MAX_DELAY = float(os.environ.get('STORAGE_RETRY_MAX_DELAY', 1))
+STORAGE_OPERATION_DEADLINE = float(os.environ.get('STORAGE_OPERATION_DEADLINE', 15))
+
+# Retention tiers (durations in days): entries younger than RETENTION_HOT_DAYS keep their feature fields in MongoDB,
+# older entries have them moved to gzipped JSON objects below ARCHIVE_PREFIX. Expiry is opt-in: with
+# RETENTION_EXPIRE_DAYS > 0 entries and archive objects older than that are deleted for good by a TTL index
+# and a bucket lifecycle rule, including labelled entries. Images are shared by entries and never expire.
+RETENTION_HOT_DAYS = float(os.environ.get('RETENTION_HOT_DAYS', 7))
+RETENTION_EXPIRE_DAYS = int(os.environ.get('RETENTION_EXPIRE_DAYS', 0))
+ARCHIVE_PREFIX = "archive"
+ARCHIVE_RULE_ID = "expire-archive"
+
+TRANSIENT_ERRORS = (AutoReconnect, urllib3.exceptions.HTTPError, ConnectionError, TimeoutError)
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """ Exports utilization and check out wait time of the MongoDB connection pool. """
+
+    def __init__(self):
+        self.check_out_started = threading.local()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        metrics.update_storage_pool_connections("mongodb", "open", 1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        metrics.update_storage_pool_connections("mongodb", "open", -1)
+
+    def connection_check_out_started(self, event):
+        self.check_out_started.value = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        metrics.inc_storage_pool_check_out_failure("mongodb", str(event.reason))
+
+    def connection_checked_out(self, event):
+        started = getattr(self.check_out_started, 'value', None)
+        if started is not None:
+            metrics.update_storage_pool_wait_duration("mongodb", time.perf_counter() - started)
+        metrics.update_storage_pool_connections("mongodb", "in_use", 1)
+
+    def connection_checked_in(self, event):
+        metrics.update_storage_pool_connections("mongodb", "in_use", -1)
+
 
 def initialize_mongodb():
-    """ Initializes the MongoDB client, connects to the database, and sets up deciated collection for each model. """
-    
-    global mongodb_client, db, collections
+    """ Initializes the MongoDB client of the current process and sets up deciated collection for each model.
+
+    The client connects lazily on the first operation, calling this again within the same process has no effect.
+    """
     
+    global mongodb_client, db, collections, mongodb_pid
+
+    if mongodb_client is not None and mongodb_pid == os.getpid():
+        return
+
     try:
-        mongodb_client = MongoClient(os.environ.get('MONGO_URI', 'mongodb://127.0.0.1:27017'))
+        mongodb_client = MongoClient(
+            os.environ.get('MONGO_URI', 'mongodb://127.0.0.1:27017'),
+            connect=False,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            waitQueueTimeoutMS=int(MONGO_POOL_WAIT_TIMEOUT * 1000),
+            connectTimeoutMS=int(MONGO_CONNECT_TIMEOUT * 1000),
+            serverSelectionTimeoutMS=int(MONGO_CONNECT_TIMEOUT * 1000),
+            timeoutMS=int(MONGO_OPERATION_TIMEOUT * 1000),
+            event_listeners=[PoolMetricsListener()]
+        )
         db = mongodb_client.mydatabase
-        collections['layoutlmv3'] = db.entryhistory
-        # Add new collection for an additional model here
+
+        # Every registered model has its own collection, see model/registry.py
+        for spec in registry.MODELS.values():
+            collections[spec.name] = db[spec.collection]
+            document_collections[spec.name] = db[spec.collection + "_documents"]
+
+        mongodb_pid = os.getpid()
 
     except Exception as e:
-        print(f"Error connecting to MongoDB: {e}")
+        logger.error(f"Error connecting to MongoDB: {e}")
         raise
 
 def initialize_minio():
-    """ Initializes the MinIO client, connects to the server, and ensures the specified bucket exists."""
+    """ Initializes the MinIO client of the current process, connects to the server, and ensures the specified bucket exists."""
     
-    global minio_client, bucket_name
+    global minio_client, bucket_name, minio_pid
+
+    if minio_client is not None and minio_pid == os.getpid():
+        return
 
     try:
         minio_url = os.getenv('MINIO_URL')
         access_key = os.getenv('MINIO_ACCESS_KEY', 'minioadmin')
         secret_key = os.getenv('MINIO_SECRET_KEY', 'minioadmin') 
+
+        # Retries are handled by with_retries(), urllib3 must fail fast
+        http_client = urllib3.PoolManager(
+            maxsize=MINIO_POOL_SIZE,
+            block=True,
+            timeout=urllib3.Timeout(connect=MINIO_CONNECT_TIMEOUT, read=MINIO_READ_TIMEOUT),
+            retries=urllib3.Retry(total=0, connect=0, read=0, redirect=0)
+        )
         
         minio_client = Minio(
             minio_url,
             access_key=access_key,
             secret_key=secret_key,
-            secure=False  # If MinIO-Server uses HTTPS, set True
+            secure=False,  # If MinIO-Server uses HTTPS, set True
+            http_client=http_client
         )
+        minio_pid = os.getpid()
 
-        if not minio_client.bucket_exists(bucket_name):
+        if not with_retries("minio", "bucket_exists", minio_client.bucket_exists, bucket_name):
             minio_client.make_bucket(bucket_name)
-            print(f'Bucket "{bucket_name}" successfully created.')
+            logger.info(f'Bucket "{bucket_name}" successfully created.')
         else:
-            print(f'Bucket "{bucket_name}" already exists.')
+            logger.info(f'Bucket "{bucket_name}" already exists.')
 
     except S3Error as e:
-        print(f"Error connecting to MinIO: {e}")
+        logger.error(f"Error connecting to MinIO: {e}")
         raise
 
 
-def insert_data(model_name, data):
+def get_minio_client():
+    """ Returns the MinIO client of the current process, creating it after a fork. """
+
+    if minio_client is None or minio_pid != os.getpid():
+        initialize_minio()
+
+    return minio_client
+
+
+def with_retries(storage, operation, function, *args, **kwargs):
+    """ Calls a storage operation and retries it on transient errors.
+
+    Retries use exponential backoff with full jitter and stop once STORAGE_MAX_RETRIES or the
+    STORAGE_OPERATION_DEADLINE is exhausted, so a slow storage backend can not stall a worker indefinitely.
+
+    Args:
+        storage (str): "mongodb" or "minio", used as metric label.
+        operation (str): Name of the operation, used as metric label.
+        function (callable): The operation to be called with the given arguments.
+
+    Returns:
+        The return value of the operation.
+    """
+
+    deadline = time.monotonic() + STORAGE_OPERATION_DEADLINE
+    attempt = 0
+
+    metrics.update_storage_pool_connections(storage, "in_flight", 1)
+    start = time.perf_counter()
+
+    try:
+        while True:
+            try:
+                return function(*args, **kwargs)
+
+            except TRANSIENT_ERRORS as e:
+                delay = random.uniform(0, min(STORAGE_RETRY_MAX_DELAY, STORAGE_RETRY_BASE_DELAY * 2 ** attempt))
+
+                if attempt >= STORAGE_MAX_RETRIES or time.monotonic() + delay >= deadline:
+                    metrics.inc_storage_operation_failure(storage, operation)
+                    raise
+
+                attempt += 1
+                metrics.inc_storage_operation_retry(storage, operation)
+                logger.warning(f"Retrying {storage} {operation} ({attempt}/{STORAGE_MAX_RETRIES}) after {type(e).__name__}", extra={"stage": operation})
+                time.sleep(delay)
+
+    finally:
+        metrics.update_storage_pool_connections(storage, "in_flight", -1)
+        metrics.update_storage_operation_duration(storage, operation, time.perf_counter() - start)
+
+
+def insert_data(model_name, data, document=None):
     """ Inserts data into the specific mogno-db collection of the model. 
     
     Args:
         model_name (str): Name of the coresponding model in order to save data to the coresponding collection.
         data (dict): Data from the inference process of a specified model to be stored.
+        document (dict): Per-image features (DOCUMENT_FIELDS and OCR boxes), requires an image_hash in data.
+            Stored in the document collection with the normalized schema, merged into data otherwise.
     """
 
-    if db is None:
-        initialize_mongodb()
-
     collection = get_collection(model_name)
-    collection.insert_one(data)
+    schema = STORAGE_SCHEMA if document is not None else "embedded"
+
+    start = time.perf_counter()
+
+    if schema == "normalized":
+        insert_document(model_name, data['image_hash'], document)
+    elif document is not None:
+        data.update({field: document[field] for field in DOCUMENT_FIELDS})
+
+    try:
+        with_retries("mongodb", "insert", collection.insert_one, data)
+    except DuplicateKeyError:
+        # insert_one assigns the _id client-side, a retried insert that already succeeded conflicts with itself
+        pass
+
+    metrics.update_storage_insert_duration(model_name, schema, time.perf_counter() - start)
+
+
+def insert_document(model_name, image_hash, document):
+    """ Stores the per-image features of an image unless they are stored already and marks them as used.
+
+    An archived document is made hot again, its archive object may expire while the document is still in use.
+    """
+
+    collection = get_document_collection(model_name)
+    now = datetime.now()
+
+    previous = with_retries(
+        "mongodb",
+        "upsert",
+        collection.find_one_and_update,
+        {"_id": image_hash},
+        {"$setOnInsert": dict(document, created=now), "$set": {"last_used": now}},
+        projection={"archive_object": 1},
+        upsert=True
+    )
+
+    if previous and previous.get('archive_object'):
+        with_retries(
+            "mongodb",
+            "update",
+            collection.update_one,
+            {"_id": image_hash},
+            {"$set": {field: document[field] for field in DOCUMENT_ARCHIVE_FIELDS if field in document}, "$unset": {"archive_object": "", "archived_at": ""}}
+        )
+
+
+def touch_document(model_name, image_hash):
+    """ Marks the per-image document of an image as used. """
+
+    collection = get_document_collection(model_name)
+    with_retries("mongodb", "update", collection.update_one, {"_id": image_hash}, {"$set": {"last_used": datetime.now()}})
 
 
-def insert_image(model_name, object_name, image):
+def encode_image(image):
+    """ Returns the image bytes to be stored with their file extension and content type according to IMAGE_STORAGE_FORMAT.
+
+    Args:
+        image (bytes object): The image as uploaded.
+
+    Returns:
+        stored_image (StoredImage): Bytes, file extension and content type of the image to be stored.
+    """
+
+    pil_image = Image.open(io.BytesIO(image))
+    extension, content_type = IMAGE_FORMATS.get(pil_image.format, ("bin", "application/octet-stream"))
+    original = StoredImage(image, extension, content_type)
+
+    # Recompression would keep only the first page of a multi-page TIFF
+    if pil_image.format not in LOSSLESS_FORMATS or getattr(pil_image, "n_frames", 1) > 1:
+        return original
+
+    if IMAGE_STORAGE_FORMAT == "png":
+        options = {"format": "PNG", "optimize": True}
+    elif IMAGE_STORAGE_FORMAT == "webp":
+        options = {"format": "WEBP", "lossless": True, "quality": 100, "method": 4}
+    else:
+        return original
+
+    # Keeps the color profile, without it the recompressed image would not be lossless
+    options["icc_profile"] = pil_image.info.get("icc_profile")
+
+    buffered = io.BytesIO()
+    pil_image.save(buffered, **options)
+
+    if buffered.tell() >= len(image):
+        return original
+
+    return StoredImage(buffered.getvalue(), *IMAGE_FORMATS[options["format"]])
+
+
+def insert_image(model_name, object_name, image, content_type='image/png', kind="original"):
     """ Uploads an given image bound to a unique object name. 
     
     Args:
-        object_name (str): consists of string '<model_name>/<MD5-Image-Hash>'
+        object_name (str): consists of string '<model_name>/<MD5-Image-Hash>.<extension>'
         image (bytes object): Image of a certain inference-process to be stored a referenced.
+        content_type (str): Content type of the image bytes.
+        kind (str): "original" or "thumbnail", used as metric label.
+
+    Returns:
+        stored (bool): False if the object already existed.
     """
 
+    client = get_minio_client()
+
     try:
-        if minio_client.stat_object(bucket_name, object_name):
-            
-            print("[*] Database: Image already exists.", flush=True)
+        with_retries("minio", "stat", client.stat_object, bucket_name, object_name)
+        logger.debug("Image already exists", extra={"stage": "insert_image"})
+        return False
+
+    except S3Error as e:
 
-    except:
+        if e.code not in ("NoSuchKey", "NoSuchObject"):
+            raise
     
-        minio_client.put_object(
-            bucket_name,
-            object_name,
-            data=io.BytesIO(image),
-            length=len(image),
-            content_type='image/png'
+        with_retries(
+            "minio",
+            "put",
+            lambda: client.put_object(
+                bucket_name,
+                object_name,
+                data=io.BytesIO(image),
+                length=len(image),
+                content_type=content_type
+            )
         )
 
+        metrics.inc_image_bytes_stored(model_name, kind, len(image))
+        return True
+
+
+def thumbnail_object_name(object_name):
+    return f"{THUMBNAIL_PREFIX}/{object_name.rsplit('.', 1)[0]}.jpg"
+
+
+def create_thumbnail(model_name, object_name, pil_image):
+    """ Stores a JPEG thumbnail of at most THUMBNAIL_SIZE pixels per side for the image stored under object_name.
+
+    Returns:
+        thumbnail (bytes): The encoded thumbnail.
+    """
+
+    thumbnail = pil_image.convert("RGB")
+    thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+
+    buffered = io.BytesIO()
+    thumbnail.save(buffered, format="JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+    data = buffered.getvalue()
+
+    insert_image(model_name, thumbnail_object_name(object_name), data, "image/jpeg", kind="thumbnail")
+
+    return data
+
+
+def schedule_thumbnail(model_name, object_name, pil_image):
+    """ Creates the thumbnail of an image in the background. If too many are pending, it is created on its first request instead. """
+
+    global thumbnail_executor, thumbnail_pid, thumbnail_pending
+
+    with thumbnail_lock:
+        if thumbnail_executor is None or thumbnail_pid != os.getpid():
+            thumbnail_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="thumbnail")
+            thumbnail_pid = os.getpid()
+            thumbnail_pending = 0
+
+        if thumbnail_pending >= THUMBNAIL_MAX_PENDING:
+            return
+        thumbnail_pending += 1
+
+    def run():
+        global thumbnail_pending
+        try:
+            create_thumbnail(model_name, object_name, pil_image)
+        except Exception as e:
+            logger.warning(f"Creating thumbnail of {object_name} failed: {e}", extra={"model_name": model_name})
+        finally:
+            with thumbnail_lock:
+                thumbnail_pending -= 1
+
+    thumbnail_executor.submit(run)
+
+
+def clone_entry(model_name, source_inference_id, inference_id, question):
+    """ Stores a copy of an entry under a new inference id, used for requests coalesced with an identical request.
+
+    Args:
+        model_name (str): Name of the coresponding model.
+        source_inference_id (str): Inference id of the entry to be copied.
+        inference_id (str): Inference id of the new entry.
+        question (str): Question of the new request, which may differ from the source in case and whitespace.
+    """
+
+    collection = get_collection(model_name)
+
+    entry = with_retries("mongodb", "find", collection.find_one, {"inference_id": source_inference_id}, {"_id": 0})
+    if entry is None:
+        raise Exception(f"Database error: No entry found with id: {source_inference_id}")
+
+    entry.update({
+        'inference_id': inference_id,
+        'timestamp': datetime.now(),
+        'question': question,
+        'feedback_type': "None",
+        'coalesced_with': source_inference_id
+    })
+    entry.pop('feedback_timestamp', None)
+
+    insert_data(model_name, entry)
+
+    # A normalized clone is a use of the per-image document as well, for its TTL and archival
+    if entry.get('image_hash') and not any(field in entry for field in DOCUMENT_FIELDS):
+        touch_document(model_name, entry['image_hash'])
+
 
 def update_feedback_type(model_name, inference_id, new_feedback_type):
     """ Updates the feedback type based on a given model name and unique inference id"""
 
-    if db is None:
-        initialize_mongodb()
-
     collection = get_collection(model_name)
 
     # define which document
     filter = {"inference_id": inference_id}
 
     # define what to update
-    update = {"$set": {"feedback_type": new_feedback_type}}
+    update = {"$set": {"feedback_type": new_feedback_type, "feedback_timestamp": datetime.now()}}
 
     # update
-    result = collection.update_one(filter, update)
+    result = with_retries("mongodb", "update", collection.update_one, filter, update)
 
     if result.matched_count > 0:
-        print(f"[*] Database: Successfully updated the document with id: {inference_id}")
+        logger.debug("Successfully updated the feedback type", extra={"inference_id": inference_id, "model_name": model_name})
     else:
-        print(f"No document found with id: {inference_id}")
+        logger.warning("No document found for feedback", extra={"inference_id": inference_id, "model_name": model_name})
+
+
+def bulk_update_feedback_type(model_name, feedback_items):
+    """ Updates the feedback type of several entries with a single unordered bulk write.
+
+    Args:
+        model_name (str): Name of the coresponding model in order to update the coresponding collection.
+        feedback_items (List): List of (inference_id, feedback_type) pairs to be updated.
+
+    Returns:
+        statuses (List): One dict per feedback item containing the inference id, feedback type and whether a matching entry was found.
+    """
+
+    collection = get_collection(model_name)
+
+    inference_ids = list({inference_id for inference_id, _ in feedback_items})
+
+    # bulk_write only reports aggregated counts, so matching ids are resolved with one additional query
+    existing_ids = {
+        entry['inference_id']
+        for entry in with_retries("mongodb", "find", lambda: list(collection.find({"inference_id": {"$in": inference_ids}}, {"_id": 0, "inference_id": 1})))
+    }
+
+    feedback_timestamp = datetime.now()
+
+    operations = [
+        UpdateOne({"inference_id": inference_id}, {"$set": {"feedback_type": feedback_type, "feedback_timestamp": feedback_timestamp}})
+        for inference_id, feedback_type in feedback_items
+        if inference_id in existing_ids
+    ]
+
+    if operations:
+        result = with_retries("mongodb", "bulk_write", collection.bulk_write, operations, ordered=False)
+        logger.debug(f"Bulk updated {result.modified_count} of {len(feedback_items)} feedback entries", extra={"model_name": model_name})
+
+    return [
+        {"inference_id": inference_id, "feedback_type": feedback_type, "matched": inference_id in existing_ids}
+        for inference_id, feedback_type in feedback_items
+    ]
+
+
+def backfill_feedback_timestamps(model_name):
+    """ Sets the feedback timestamp of labelled entries whose feedback was given before it was recorded.
+
+    The time of the feedback is unknown, so the time of the backfill is used. These entries were never
+    exported, using the current time places them after the watermark of any previous export.
+
+    Returns:
+        modified (int): Amount of updated entries, 0 once every labelled entry has a feedback timestamp.
+    """
+
+    collection = get_collection(model_name)
+
+    result = with_retries(
+        "mongodb",
+        "update",
+        collection.update_many,
+        {"feedback_type": {"$in": ["correct", "incorrect"]}, "feedback_timestamp": {"$exists": False}},
+        {"$set": {"feedback_timestamp": datetime.now()}}
+    )
+
+    return result.modified_count
 
 
 def get_collection(model_name):
@@ -134,37 +606,127 @@ def get_collection(model_name):
 
     """
 
+    if mongodb_client is None or mongodb_pid != os.getpid():
+        initialize_mongodb()
+
     if model_name in collections:
         return collections[model_name]
     else:
         raise ValueError(f"No collection found for model: {model_name}")
 
 
-def get_image_by_id(model_name, inference_id):
-    """ Returns the image of an entry based on its ID. """
+def get_document_collection(model_name):
+    """ Returns the collection of per-image features of the given model used by the normalized schema. """
+
+    get_collection(model_name)
+    return document_collections[model_name]
+
+
+def join_documents(model_name, entries, fields=DOCUMENT_FIELDS):
+    """ Adds the per-image features of normalized entries from the document collection with one query per call.
+
+    Args:
+        model_name (str): Name of the coresponding model.
+        entries (List): Entries as read from the collection, embedded entries are left unchanged.
+        fields (Iterable): Document fields to be joined.
+
+    Returns:
+        entries (List): The given entries.
+    """
+
+    fields = [field for field in fields if field in DOCUMENT_FIELDS]
+    pending = [entry for entry in entries if entry.get('image_hash') and not any(field in entry for field in fields)]
+
+    if not fields or not pending:
+        return entries
+
+    collection = get_document_collection(model_name)
+    image_hashes = list({entry['image_hash'] for entry in pending})
+
+    projection = {field: 1 for field in fields}
+    projection['archive_object'] = 1
+
+    documents = {
+        document['_id']: restore_archived_fields(document, fields)
+        for document in with_retries("mongodb", "find", lambda: list(collection.find({"_id": {"$in": image_hashes}}, projection)))
+    }
+
+    for entry in pending:
+        document = documents.get(entry['image_hash'])
+        if document is not None:
+            entry.update({field: document[field] for field in fields if field in document})
+
+    return entries
+
+
+def read_object(object_name):
+    """ Reads an object from MinIO and releases the connection back to the pool. """
 
-    object_name = f"{model_name}/{inference_id}.png"
+    response = get_minio_client().get_object(bucket_name, object_name)
 
     try:
-        response = minio_client.get_object(bucket_name, object_name)
+        return response.read()
+    finally:
+        response.close()
+        response.release_conn()
 
-        image_data = response.read()
-        return image_data
+
+def get_image_by_object_name(object_name):
+    """ Returns the raw bytes of an image stored under the given object name. """
+
+    try:
+        return with_retries("minio", "get", read_object, object_name)
 
     except Exception as e:
         raise Exception(f"Error retrieving image from MinIO: {str(e)}")
+
+
+def get_image_by_id(model_name, inference_id, thumbnail=False):
+    """ Returns the image or its thumbnail of an entry based on its ID.
+
+    Returns:
+        image (bytes): The stored image, None if there is no entry with the given ID.
+        content_type (str): Content type of the image.
+    """
+
+    collection = get_collection(model_name)
+
+    try:
+        entry = with_retries("mongodb", "find", collection.find_one, {"inference_id": inference_id}, {"_id": 0, "image": 1})
+        if not entry or not entry.get('image'):
+            return None, None
+
+        object_name = entry['image']
+
+        if thumbnail:
+            kind, content_type = "thumbnail", "image/jpeg"
+            try:
+                data = with_retries("minio", "get", read_object, thumbnail_object_name(object_name))
+            except S3Error as e:
+                if e.code not in ("NoSuchKey", "NoSuchObject"):
+                    raise
+                # Not created yet, e.g. because the background queue was full
+                original = with_retries("minio", "get", read_object, object_name)
+                data = create_thumbnail(model_name, object_name, Image.open(io.BytesIO(original)))
+        else:
+            kind, content_type = "original", CONTENT_TYPES.get(object_name.rsplit('.', 1)[-1], "application/octet-stream")
+            data = with_retries("minio", "get", read_object, object_name)
+
+    except Exception as e:
+        raise Exception(f"Error retrieving image from MinIO: {str(e)}")
+
+    metrics.inc_image_bytes_served(model_name, kind, len(data))
+
+    return data, content_type
     
 
 def get_feedback_type_by_id(model_name, inference_id):
     """ Returns the feedback type of an entry based on its ID. """
 
-    if db is None:
-        initialize_mongodb()
-
     collection = get_collection(model_name)
 
     try:
-        entry = collection.find_one({"inference_id": inference_id})
+        entry = with_retries("mongodb", "find", collection.find_one, {"inference_id": inference_id})
 
         if not entry:
             return None 
@@ -177,9 +739,6 @@ def get_feedback_type_by_id(model_name, inference_id):
 def get_entries_by_id(model_name, inference_id):
     """ Returns returns all entries of a given model and inference id. """
 
-    if 'db' not in globals():
-        initialize_mongodb()
-
     collection = get_collection(model_name)
     
     fields = {
@@ -196,23 +755,374 @@ def get_entries_by_id(model_name, inference_id):
         "result": 1,
         "feedback_type": 1,
         "confidence_score_start" : 1,
-        "confidence_score_end" : 1
+        "confidence_score_end" : 1,
+        "answered_by" : 1,
+        "image_hash": 1,
+        "archive_object": 1
     }
 
     try:
-        entry = collection.find_one({"inference_id": inference_id}, fields)
+        entry = with_retries("mongodb", "find", collection.find_one, {"inference_id": inference_id}, fields)
         
         if not entry:
             return None
 
         
         entry['_id'] = str(entry['_id']) 
-        return entry
+        restore_archived_fields(entry)
+        join_documents(model_name, [entry])
+        return strip_internal_fields(entry)
     
     except Exception as e:
         raise Exception(f"Database error: {str(e)}")
     
 
+def strip_internal_fields(entry):
+    for field in INTERNAL_FIELDS:
+        entry.pop(field, None)
+    return entry
+
+
+def build_query_filter(start_time=None, end_time=None, feedback_type=None, min_confidence=None, max_confidence=None, empty_result=None, after=None):
+    """ Builds a MongoDB filter for history queries. Every argument is optional and only applied if given.
+
+    Args:
+        start_time (datetime): Only entries with a timestamp greater or equal.
+        end_time (datetime): Only entries with a timestamp lower than the given one.
+        feedback_type (str): Only entries with the given feedback type ("None", "correct", "incorrect").
+        min_confidence (float): Lower bound for both start and end confidence score.
+        max_confidence (float): Upper bound for both start and end confidence score.
+        empty_result (bool): True for entries with an empty result only, False for entries with a result only.
+        after (str): Cursor of the last entry of the previous page (keyset pagination on _id).
+
+    Returns:
+        query_filter (dict): The filter to be used by query_entries().
+
+    Raises:
+        ValueError: If the cursor is not a valid ObjectId.
+    """
+
+    query_filter = {}
+
+    if start_time is not None or end_time is not None:
+        query_filter['timestamp'] = {}
+        if start_time is not None:
+            query_filter['timestamp']['$gte'] = start_time
+        if end_time is not None:
+            query_filter['timestamp']['$lt'] = end_time
+
+    if feedback_type is not None:
+        query_filter['feedback_type'] = feedback_type
+
+    if min_confidence is not None or max_confidence is not None:
+        confidence_range = {}
+        if min_confidence is not None:
+            confidence_range['$gte'] = min_confidence
+        if max_confidence is not None:
+            confidence_range['$lte'] = max_confidence
+        query_filter['confidence_score_start'] = confidence_range
+        query_filter['confidence_score_end'] = dict(confidence_range)
+
+    if empty_result is True:
+        query_filter['result'] = {"$regex": r"^\s*$"}
+    elif empty_result is False:
+        query_filter['result'] = {"$regex": r"\S"}
+
+    if after is not None:
+        try:
+            query_filter['_id'] = {"$gt": ObjectId(after)}
+        except InvalidId:
+            raise ValueError(f"Invalid cursor: {after}")
+
+    return query_filter
+
+
+def query_entries(model_name, query_filter, fields=None, limit=None, batch_size=100):
+    """ Streams the entries of a given model matching a filter in ascending _id order.
+
+    The cursor is consumed lazily in batches, so arbitrarily large result sets are never loaded into memory at once.
+
+    Args:
+        model_name (str): Name of the coresponding model to be queried.
+        query_filter (dict): Filter as returned by build_query_filter().
+        fields (Iterable): Additional fields to be returned besides ENTRY_FIELDS, e.g. FEATURE_FIELDS.
+        limit (int): Maximum amount of entries to be returned, unlimited if None.
+        batch_size (int): Amount of documents fetched from MongoDB per round trip.
+
+    Yields:
+        entry (dict): JSON-serializable entry with stringified _id and ISO timestamp.
+    """
+
+    collection = get_collection(model_name)
+
+    projection = {field: 1 for field in ENTRY_FIELDS}
+    for field in fields or ():
+        projection[field] = 1
+
+    # Feature fields of archived entries are read from their archive objects, per-image features of
+    # normalized entries from the document collection
+    rehydrate = any(field in FEATURE_FIELDS for field in fields or ())
+    if rehydrate:
+        projection['archive_object'] = 1
+        projection['image_hash'] = 1
+
+    cursor = collection.find(query_filter, projection).sort("_id", ASCENDING).batch_size(batch_size)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    def prepare(batch):
+        for entry in batch:
+            entry['_id'] = str(entry['_id'])
+            if hasattr(entry.get('timestamp'), 'isoformat'):
+                entry['timestamp'] = entry['timestamp'].isoformat()
+            if rehydrate:
+                restore_archived_fields(entry, fields)
+        if rehydrate:
+            join_documents(model_name, batch, fields)
+            for entry in batch:
+                strip_internal_fields(entry)
+        return batch
+
+    try:
+        batch = []
+        for entry in cursor:
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                yield from prepare(batch)
+                batch = []
+        yield from prepare(batch)
+
+    except Exception as e:
+        raise Exception(f"Database error: {str(e)}")
+
+    finally:
+        cursor.close()
+
+
+def ensure_indexes(model_name):
+    """ Creates the inference_id index used by lookups and feedback updates, the feedback index used by the export and
+    the time indexes used by archival and time range queries.
+
+    The time index on the entry timestamp and the last use of per-image documents is a TTL index if RETENTION_EXPIRE_DAYS
+    is set and a plain index otherwise. Calling this again is cheap, a changed RETENTION_EXPIRE_DAYS is applied to the
+    existing index and switching expiry on or off replaces one index by the other.
+    """
+
+    collection = get_collection(model_name)
+
+    with_retries("mongodb", "create_index", collection.create_index, [("inference_id", ASCENDING)], name="inference_id")
+
+    # Keyset order of the incremental export, only labelled entries have a feedback timestamp
+    with_retries(
+        "mongodb",
+        "create_index",
+        collection.create_index,
+        [("feedback_timestamp", ASCENDING), ("_id", ASCENDING)],
+        name="feedback_timestamp",
+        partialFilterExpression={"feedback_timestamp": {"$exists": True}}
+    )
+
+    expire_after = int(RETENTION_EXPIRE_DAYS * 86400)
+
+    # Per-image documents expire once the newest entry referencing them expired
+    for time_collection, field in ((collection, "timestamp"), (get_document_collection(model_name), "last_used")):
+        ttl_name = f"{field}_ttl"
+        index_name = ttl_name if expire_after > 0 else field
+        stale_name = field if expire_after > 0 else ttl_name
+
+        # Both indexes share the key pattern, so the index of the other mode has to be dropped first
+        if stale_name in with_retries("mongodb", "index_information", time_collection.index_information):
+            with_retries("mongodb", "drop_index", time_collection.drop_index, stale_name)
+
+        if expire_after <= 0:
+            with_retries("mongodb", "create_index", time_collection.create_index, [(field, ASCENDING)], name=index_name)
+            continue
+
+        try:
+            with_retries("mongodb", "create_index", time_collection.create_index, [(field, ASCENDING)], name=index_name, expireAfterSeconds=expire_after)
+
+        except OperationFailure as e:
+            # IndexOptionsConflict, the index exists with a different expiry
+            if e.code != 85:
+                raise
+            with_retries("mongodb", "coll_mod", db.command, "collMod", time_collection.name, index={"name": index_name, "expireAfterSeconds": expire_after})
+
+
+def ensure_archive_lifecycle():
+    """ Expires archive objects together with their entries by a lifecycle rule on the archive prefix.
+
+    Only the rule with ARCHIVE_RULE_ID is added, replaced or removed, other rules of the bucket are kept.
+    """
+
+    client = get_minio_client()
+
+    config = with_retries("minio", "get_lifecycle", client.get_bucket_lifecycle, bucket_name)
+    rules = [rule for rule in (config.rules if config else []) if rule.rule_id != ARCHIVE_RULE_ID]
+
+    if RETENTION_EXPIRE_DAYS > 0:
+        rules.append(Rule(
+            ENABLED,
+            rule_filter=Filter(prefix=f"{ARCHIVE_PREFIX}/"),
+            rule_id=ARCHIVE_RULE_ID,
+            expiration=Expiration(days=RETENTION_EXPIRE_DAYS)
+        ))
+    elif config is None or len(rules) == len(config.rules):
+        # Expiry disabled and no rule of ours to remove
+        return
+
+    if rules:
+        with_retries("minio", "set_lifecycle", client.set_bucket_lifecycle, bucket_name, LifecycleConfig(rules))
+    else:
+        with_retries("minio", "delete_lifecycle", client.delete_bucket_lifecycle, bucket_name)
+
+
+def archive_entries(model_name, batch_size=100, limit=None):
+    """ Moves the feature fields of entries older than RETENTION_HOT_DAYS into compressed archive objects.
+
+    Each archive object is written before the fields are unset in MongoDB, an interrupted run leaves the
+    entry hot and it is archived again by the next run.
+
+    Args:
+        model_name (str): Name of the coresponding model whose collection is archived.
+        batch_size (int): Amount of entries unset with one bulk write.
+        limit (int): Maximum amount of entries archived by this call, unlimited if None.
+
+    Returns:
+        archived (int): Amount of archived entries.
+        archived_bytes (int): Compressed size of the written archive objects.
+    """
+
+    return archive_collection(get_collection(model_name), "timestamp", FEATURE_FIELDS, f"{ARCHIVE_PREFIX}/{model_name}", batch_size, limit)
+
+
+def archive_documents(model_name, batch_size=100, limit=None):
+    """ Moves the fields of per-image documents of the normalized schema unused for RETENTION_HOT_DAYS into archive objects.
+
+    Returns:
+        archived (int): Amount of archived documents.
+        archived_bytes (int): Compressed size of the written archive objects.
+    """
+
+    return archive_collection(get_document_collection(model_name), "last_used", DOCUMENT_ARCHIVE_FIELDS, f"{ARCHIVE_PREFIX}/{model_name}/documents", batch_size, limit)
+
+
+def archive_collection(collection, time_field, fields, object_prefix, batch_size, limit):
+    """ Archives the given fields of all documents of a collection whose time_field is older than RETENTION_HOT_DAYS. """
+
+    client = get_minio_client()
+
+    cutoff = datetime.now() - timedelta(days=RETENTION_HOT_DAYS)
+    query_filter = {
+        time_field: {"$lt": cutoff},
+        "archive_object": {"$exists": False},
+        "$or": [{field: {"$exists": True}} for field in fields]
+    }
+    projection = {field: 1 for field in fields}
+
+    cursor = collection.find(query_filter, projection).sort(time_field, ASCENDING).batch_size(batch_size)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    archived = 0
+    archived_bytes = 0
+    operations = []
+
+    def flush():
+        nonlocal archived
+        if operations:
+            result = with_retries("mongodb", "bulk_write", collection.bulk_write, operations, ordered=False)
+            archived += result.modified_count
+            operations.clear()
+
+    try:
+        for entry in cursor:
+            features = {field: entry[field] for field in fields if field in entry}
+            payload = gzip.compress(json.dumps(features).encode('utf-8'))
+            object_name = f"{object_prefix}/{entry['_id']}.json.gz"
+
+            with_retries(
+                "minio",
+                "put",
+                lambda: client.put_object(
+                    bucket_name,
+                    object_name,
+                    data=io.BytesIO(payload),
+                    length=len(payload),
+                    content_type='application/gzip'
+                )
+            )
+
+            # A document used again since it was read (e.g. by insert_document()) stays hot
+            operations.append(UpdateOne(
+                {"_id": entry['_id'], time_field: {"$lt": cutoff}, "archive_object": {"$exists": False}},
+                {"$set": {"archive_object": object_name, "archived_at": datetime.now()}, "$unset": {field: "" for field in fields}}
+            ))
+            archived_bytes += len(payload)
+
+            if len(operations) >= batch_size:
+                flush()
+
+        flush()
+
+    finally:
+        cursor.close()
+
+    return archived, archived_bytes
+
+
+def restore_archived_fields(entry, fields=FEATURE_FIELDS):
+    """ Reads the requested feature fields of an archived entry back from its archive object, hot entries are returned unchanged. """
+
+    object_name = entry.get('archive_object')
+    if not object_name:
+        return entry
+
+    try:
+        payload = with_retries("minio", "get", read_object, object_name)
+    except S3Error as e:
+        if e.code not in ("NoSuchKey", "NoSuchObject"):
+            raise
+        # The archive object expired before its entry
+        return entry
+
+    features = json.loads(gzip.decompress(payload))
+    entry.update({field: features[field] for field in fields if field in features})
+    return entry
+
+
+def count_tiers(model_name):
+    """ Returns the amount of hot and archived entries and the storage size of the collection in bytes. """
+
+    collection = get_collection(model_name)
+
+    archived = with_retries("mongodb", "count", collection.count_documents, {"archive_object": {"$exists": True}})
+    total = with_retries("mongodb", "count", collection.estimated_document_count)
+    stats = with_retries("mongodb", "coll_stats", db.command, "collStats", collection.name)
+
+    return {"hot": max(total - archived, 0), "archived": archived}, stats.get('size', 0)
+
+
+def storage_stats(model_name):
+    """ Returns amount, total and average size in bytes of the entries and the per-image documents of a model. """
+
+    stats = {}
+
+    for name, collection in (("entries", get_collection(model_name)), ("documents", get_document_collection(model_name))):
+        try:
+            coll_stats = with_retries("mongodb", "coll_stats", db.command, "collStats", collection.name)
+        except OperationFailure:
+            # The collection does not exist yet
+            coll_stats = {}
+
+        stats[name] = {
+            "count": coll_stats.get('count', 0),
+            "size": coll_stats.get('size', 0),
+            "avg_size": coll_stats.get('avgObjSize', 0),
+        }
+
+    return stats
+
+
 def generate_image_hash(image):
     """ This function takes a PIL image object and returns the MD5 hash of the image. """
     
@@ -0,0 +1,64 @@
+import time
+from datetime import datetime
+
+import metrics
+
+#########################################################################
+### Request Deadlines
+#########################################################################
+#
+# Deadlines are absolute time.time() timestamps (seconds since epoch as float) set by the client.
+# Expensive stages check the deadline first and abort requests the client already gave up on.
+
+
+class DeadlineExceeded(Exception):
+    """ Raised if the deadline of a request passed before a given stage. """
+
+    def __init__(self, stage, deadline):
+        super().__init__(f"Deadline exceeded before {stage} by {time.time() - deadline:.3f}s")
+        self.stage = stage
+        self.deadline = deadline
+
+
+def parse_timestamp(value):
+    """
+    Parses a request timestamp with microsecond resolution.
+
+    Args:
+        value (str): ISO 8601 timestamp, the legacy "%Y-%m-%d %H:%M:%S" format or seconds since epoch.
+
+    Returns:
+        timestamp (datetime): The parsed timestamp.
+    """
+
+    try:
+        return datetime.fromtimestamp(float(value))
+    except ValueError:
+        return datetime.fromisoformat(value)
+
+
+def parse_deadline(value):
+    """ Parses an optional deadline form field into seconds since epoch, None if not given. """
+
+    if value is None or value == "":
+        return None
+
+    return float(value)
+
+
+def check_deadline(model_name, deadline, stage):
+    """
+    Aborts a request if its deadline has passed.
+
+    Args:
+        model_name (str): Name of the model, used as metric label.
+        deadline (float): Deadline as seconds since epoch or None for requests without deadline.
+        stage (str): Name of the stage about to be started.
+
+    Raises:
+        DeadlineExceeded: If the deadline has passed.
+    """
+
+    if deadline is not None and time.time() > deadline:
+        metrics.inc_deadline_exceeded(model_name, stage)
+        raise DeadlineExceeded(stage, deadline)
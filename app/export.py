@@ -0,0 +1,303 @@
+import os
+import glob
+import json
+import time
+import argparse
+from datetime import datetime
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pymongo import ASCENDING
+from bson import ObjectId
+
+import database
+
+#########################################################################
+### Export of feedback-labelled records for retraining
+#########################################################################
+#
+# Usage (inside the backend container):
+#   python export.py --model layoutlmv3 --output-dir /data/export
+#
+# Every run only exports records whose feedback was given after the watermark
+# stored in the output directory, so repeated runs are incremental. Shards are
+# written to a temporary file and renamed once complete.
+
+FEEDBACK_TYPES = ["correct", "incorrect"]
+
+# Feature arrays are stored flattened with a typed value column and a shape column
+FEATURE_TYPES = {
+    "input_ids": np.int32,
+    "attention_mask": np.int8,
+    "bbox": np.int16,
+    "pixel_values": np.float32,
+}
+
+WATERMARK_FILE = "_watermark.json"
+PARTIAL_SUFFIX = ".tmp"
+
+
+def feature_field(dtype):
+    return pa.list_(pa.from_numpy_dtype(dtype))
+
+
+SCHEMA = pa.schema(
+    [
+        ("inference_id", pa.string()),
+        ("timestamp", pa.timestamp("us")),
+        ("feedback_timestamp", pa.timestamp("us")),
+        ("question", pa.string()),
+        ("result", pa.string()),
+        ("feedback_type", pa.string()),
+        ("confidence_score_start", pa.float32()),
+        ("confidence_score_end", pa.float32()),
+        ("answered_by", pa.string()),
+        ("words", pa.list_(pa.string())),
+        ("image", pa.string()),
+        ("image_bytes", pa.binary()),
+    ]
+    + [(name, feature_field(dtype)) for name, dtype in FEATURE_TYPES.items()]
+    + [(f"{name}_shape", pa.list_(pa.int32())) for name in FEATURE_TYPES]
+)
+
+
+def load_watermark(output_dir):
+    """ Returns the (feedback_timestamp, _id) keyset of the last exported record or None for a full export. """
+
+    path = os.path.join(output_dir, WATERMARK_FILE)
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "r") as f:
+        watermark = json.load(f)
+
+    return datetime.fromisoformat(watermark["feedback_timestamp"]), ObjectId(watermark["_id"])
+
+
+def store_watermark(output_dir, feedback_timestamp, object_id):
+    """ Atomically stores the keyset of the last record of a completely written shard. """
+
+    path = os.path.join(output_dir, WATERMARK_FILE)
+
+    with open(path + ".tmp", "w") as f:
+        json.dump({"feedback_timestamp": feedback_timestamp.isoformat(), "_id": str(object_id)}, f)
+
+    os.replace(path + ".tmp", path)
+
+
+def remove_partial_shards(output_dir):
+    """ Removes shards of an interrupted run, their records were not covered by the watermark and are exported again. """
+
+    for path in glob.glob(os.path.join(output_dir, f"*.parquet{PARTIAL_SUFFIX}")):
+        os.remove(path)
+        print(f"[*] Export: Removed incomplete shard {os.path.basename(path)}", flush=True)
+
+
+def build_export_filter(watermark):
+    """ Selects feedback-labelled records after the watermark in (feedback_timestamp, _id) order. """
+
+    export_filter = {"feedback_type": {"$in": FEEDBACK_TYPES}, "feedback_timestamp": {"$exists": True}}
+
+    if watermark is not None:
+        feedback_timestamp, object_id = watermark
+        export_filter["$or"] = [
+            {"feedback_timestamp": {"$gt": feedback_timestamp}},
+            {"feedback_timestamp": feedback_timestamp, "_id": {"$gt": object_id}},
+        ]
+
+    return export_filter
+
+
+def iter_records(model_name, watermark, batch_size):
+    """ Streams matching records from MongoDB with a batched cursor. """
+
+    collection = database.get_collection(model_name)
+
+    projection = {field: 1 for field in database.ENTRY_FIELDS + database.FEATURE_FIELDS}
+    projection["feedback_timestamp"] = 1
+    projection["archive_object"] = 1
+    projection["image_hash"] = 1
+
+    cursor = (
+        collection.find(build_export_filter(watermark), projection)
+        .sort([("feedback_timestamp", ASCENDING), ("_id", ASCENDING)])
+        .batch_size(batch_size)
+    )
+
+    def prepare(batch):
+        for record in batch:
+            database.restore_archived_fields(record)
+        return database.join_documents(model_name, batch)
+
+    try:
+        batch = []
+        for record in cursor:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield from prepare(batch)
+                batch = []
+        yield from prepare(batch)
+    finally:
+        cursor.close()
+
+
+def to_record_batch(records, images):
+    """ Converts a list of MongoDB documents into a typed Arrow record batch. """
+
+    columns = {name: [] for name in SCHEMA.names}
+
+    for record in records:
+        for name in ("inference_id", "timestamp", "feedback_timestamp", "question", "result", "feedback_type", "confidence_score_start", "confidence_score_end", "answered_by", "image"):
+            columns[name].append(record.get(name))
+
+        columns["words"].append(record.get("words") or [])
+        columns["image_bytes"].append(images.get(record.get("image")))
+
+        for name, dtype in FEATURE_TYPES.items():
+            values = np.asarray(record.get(name, []), dtype=dtype)
+            columns[name].append(values.ravel())
+            columns[f"{name}_shape"].append(list(values.shape))
+
+    arrays = []
+    for field in SCHEMA:
+        if field.name in FEATURE_TYPES:
+            arrays.append(flat_list_array(columns[field.name], field.type))
+        else:
+            arrays.append(pa.array(columns[field.name], type=field.type))
+
+    return pa.RecordBatch.from_arrays(arrays, schema=SCHEMA)
+
+
+def flat_list_array(values, list_type):
+    """ Builds a list array from numpy arrays without converting every element to a Python object. """
+
+    offsets = np.zeros(len(values) + 1, dtype=np.int32)
+    np.cumsum([len(v) for v in values], out=offsets[1:])
+
+    return pa.ListArray.from_arrays(pa.array(offsets), pa.array(np.concatenate(values), type=list_type.value_type))
+
+
+def fetch_images(records):
+    """ Fetches the referenced images from MinIO, images shared by several records are only fetched once per batch. """
+
+    images = {}
+
+    for record in records:
+        object_name = record.get("image")
+
+        if object_name is None or object_name in images:
+            continue
+
+        try:
+            images[object_name] = database.get_image_by_object_name(object_name)
+        except Exception as e:
+            print(f"[*] Export: Image {object_name} not available - {e}", flush=True)
+            images[object_name] = None
+
+    return images
+
+
+def export(model_name, output_dir, batch_size=64, shard_size=4096, with_images=True):
+    """
+    Exports feedback-labelled records of a given model to sharded Parquet files.
+
+    At most one batch of records and their images is held in memory at a time. The watermark is
+    advanced after every completed shard, so an interrupted export continues with the next shard.
+
+    Returns:
+        rows (int): Amount of exported records.
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+    remove_partial_shards(output_dir)
+
+    # The export reads in (feedback_timestamp, _id) order, which is only fast with its index
+    database.ensure_indexes(model_name)
+
+    # Labels given before feedback timestamps were recorded would never match the export filter
+    backfilled = database.backfill_feedback_timestamps(model_name)
+    if backfilled:
+        print(f"[*] Export: Backfilled the feedback timestamp of {backfilled} records", flush=True)
+
+    watermark = load_watermark(output_dir)
+    shard_prefix = time.strftime("%Y%m%d-%H%M%S")
+
+    rows = 0
+    shard_index = 0
+    shard_rows = 0
+    writer = None
+    shard_path = None
+    last_record = None
+    batch = []
+
+    start = time.perf_counter()
+
+    def write_batch():
+        nonlocal writer, shard_path, shard_rows
+
+        images = fetch_images(batch) if with_images else {}
+
+        if writer is None:
+            shard_path = os.path.join(output_dir, f"{model_name}-{shard_prefix}-{shard_index:05d}.parquet")
+            writer = pq.ParquetWriter(shard_path + PARTIAL_SUFFIX, SCHEMA, compression="zstd")
+
+        writer.write_batch(to_record_batch(batch, images))
+        shard_rows += len(batch)
+
+        if shard_rows >= shard_size:
+            close_shard()
+
+    def close_shard():
+        nonlocal writer, shard_index, shard_rows
+
+        writer.close()
+        writer = None
+        os.replace(shard_path + PARTIAL_SUFFIX, shard_path)
+        shard_index += 1
+        shard_rows = 0
+        store_watermark(output_dir, last_record["feedback_timestamp"], last_record["_id"])
+
+    for record in iter_records(model_name, watermark, batch_size):
+        batch.append(record)
+        last_record = record
+        rows += 1
+
+        if len(batch) >= batch_size:
+            write_batch()
+            batch = []
+
+            elapsed = time.perf_counter() - start
+            print(f"[*] Export: {rows} rows, {rows / elapsed:.1f} rows/sec", flush=True)
+
+    if batch:
+        write_batch()
+
+    if writer is not None:
+        close_shard()
+
+    elapsed = time.perf_counter() - start
+    print(f"[*] Export: Finished {rows} rows in {shard_index} shards after {elapsed:.1f}s ({rows / elapsed if elapsed else 0:.1f} rows/sec)", flush=True)
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export feedback-labelled records to Parquet for retraining.")
+    parser.add_argument("--model", default="layoutlmv3")
+    parser.add_argument("--output-dir", default=os.environ.get("EXPORT_DIR", "/tmp/export"))
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--shard-size", type=int, default=4096)
+    parser.add_argument("--without-images", action="store_true")
+    args = parser.parse_args()
+
+    database.initialize_mongodb()
+    if not args.without_images:
+        database.initialize_minio()
+
+    export(args.model, args.output_dir, args.batch_size, args.shard_size, not args.without_images)
+
+
+if __name__ == "__main__":
+    main()
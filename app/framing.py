@@ -0,0 +1,119 @@
+import os
+import json
+import struct
+
+#########################################################################
+### Binary Inference Protocol
+#########################################################################
+#
+# A request body is a sequence of frames, each carrying one inference request:
+#
+#   uint32 header length | uint32 image length | JSON header | raw image bytes
+#
+# The header contains question, inference_id, timestamp and the optional deadline and priority,
+# lengths are big-endian. The response body is a sequence of frames in the order of the requests:
+#
+#   uint32 payload length | JSON payload
+#
+# with the payload {"inference_id", "status", "result"} or {"inference_id", "status", "error"}.
+# Several frames in one body are answered one after another over the same connection.
+
+REQUEST_PREFIX = struct.Struct('>II')
+RESPONSE_PREFIX = struct.Struct('>I')
+
+CONTENT_TYPE = 'application/x-inference-frames'
+
+MAX_HEADER_BYTES = 64 * 1024
+MAX_IMAGE_BYTES = int(os.environ.get('MAX_IMAGE_BYTES', 100 * 1024 * 1024))
+
+REQUIRED_FIELDS = ("question", "inference_id", "timestamp")
+
+
+class FramingError(ValueError):
+    """ Raised if a request body does not consist of well-formed frames. """
+
+
+def read_exact(stream, size):
+    """ Reads exactly size bytes, the input stream of a WSGI server may return less per read call. """
+
+    data = stream.read(size)
+    if len(data) == size:
+        return data
+
+    chunks = [data]
+    received = len(data)
+    while received < size:
+        chunk = stream.read(size - received)
+        if not chunk:
+            raise FramingError(f"Body ended after {received} of {size} bytes")
+        chunks.append(chunk)
+        received += len(chunk)
+
+    return b''.join(chunks)
+
+
+def read_frame(stream):
+    """
+    Reads the next request frame of a body.
+
+    Returns:
+        header (dict): The decoded header, None once the body is exhausted.
+        image (bytes): The raw image bytes.
+    """
+
+    prefix = stream.read(REQUEST_PREFIX.size)
+    if not prefix:
+        return None, None
+    if len(prefix) < REQUEST_PREFIX.size:
+        prefix += read_exact(stream, REQUEST_PREFIX.size - len(prefix))
+
+    header_length, image_length = REQUEST_PREFIX.unpack(prefix)
+
+    if header_length > MAX_HEADER_BYTES:
+        raise FramingError(f"Header of {header_length} bytes exceeds {MAX_HEADER_BYTES} bytes")
+    if image_length > MAX_IMAGE_BYTES:
+        raise FramingError(f"Image of {image_length} bytes exceeds {MAX_IMAGE_BYTES} bytes")
+
+    try:
+        header = json.loads(read_exact(stream, header_length))
+    except ValueError as e:
+        # Invalid JSON or invalid UTF-8
+        raise FramingError(f"Invalid header: {e}")
+
+    if not isinstance(header, dict):
+        raise FramingError("Header has to be a JSON object")
+
+    missing = [field for field in REQUIRED_FIELDS if field not in header]
+    if missing:
+        raise FramingError(f"Header misses {', '.join(missing)}")
+
+    image = read_exact(stream, image_length)
+
+    return header, image
+
+
+def encode_request(header, image):
+    """ Encodes one request frame, used by clients of the binary endpoint. """
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    return REQUEST_PREFIX.pack(len(header_bytes), len(image)) + header_bytes + image
+
+
+def encode_response(payload):
+    payload_bytes = json.dumps(payload).encode('utf-8')
+    return RESPONSE_PREFIX.pack(len(payload_bytes)) + payload_bytes
+
+
+def decode_responses(body):
+    """ Decodes all response frames of a response body, used by clients of the binary endpoint. """
+
+    payloads = []
+    offset = 0
+
+    while offset < len(body):
+        (length,) = RESPONSE_PREFIX.unpack_from(body, offset)
+        offset += RESPONSE_PREFIX.size
+        payloads.append(json.loads(body[offset:offset + length]))
+        offset += length
+
+    return payloads
@@ -1,73 +1,127 @@
 
 import gradio as gr
 import requests
-import io
+from requests.adapters import HTTPAdapter
+import os
+import time
 import uuid
+import mimetypes
 from datetime import datetime
+from prometheus_client import Histogram, Counter, start_http_server
+
+#########################################################################
+### Backend Connection
+#########################################################################
+
+# Shared keep-alive session, connections to nginx are pooled and reused across requests
+BACKEND_POOL_SIZE = int(os.environ.get('BACKEND_POOL_SIZE', 64))
+
+# Seconds the frontend waits for an inference, passed to the backend as deadline (nginx proxy_read_timeout is 120s)
+INFERENCE_TIMEOUT = float(os.environ.get('INFERENCE_TIMEOUT', 110))
+
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=BACKEND_POOL_SIZE, pool_block=False))
+
+#########################################################################
+### Frontend Metrics
+#########################################################################
+
+FRONTEND_ENCODE_DURATION_HISTOGRAM = Histogram('frontend_encode_duration_histogram', 'distribution of duration (seconds) of preparing the upload for the backend request', ['model_name'], buckets=[0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0])
+FRONTEND_TRANSFER_DURATION_HISTOGRAM = Histogram('frontend_transfer_duration_histogram', 'distribution of duration (seconds) of the backend request from sending the upload to receiving the response', ['model_name'], buckets=[0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0])
+FRONTEND_UPLOAD_BYTES = Counter('frontend_upload_bytes', 'Total amount of image bytes forwarded to the backend', ['model_name', 'content_type'])
 
 #########################################################################
 ### LayoutLMv3 Inference Functions 
 #########################################################################
 
-def run_distinct_inference(question, image):
+def run_distinct_inference(question, image, model_name="layoutlmv3"):
     """
     Sends an inference request to the backend for a distinct image-based question-answering task.
 
+    The uploaded file is forwarded with its original bytes and content type, it is neither decoded nor re-encoded.
+
     Args:
         question (str): The question to be answered based on the content of the image.
-        image (PIL.Image): The image to be used in the inference.
+        image (str): Path of the uploaded image file to be used in the inference.
+        model_name (str): Name of the model registered in the backend.
 
     Returns:
         dict: The JSON response from the backend containing the inference result and the coresponding inference id.
     """
     
     print("[*] Frontend: Calling Inference", flush=True)
-    url = 'http://nginx/api/layoutlmv3/distinct_inference'
+    url = f'http://nginx/api/{model_name}/distinct_inference'
+
+    if image is None:
+        raise gr.Error("Please upload an image")
     
     # Generate a unique ID for tracking the inference request
     inference_id = str(uuid.uuid4())
     print(f"[*] Frontend: Inference {inference_id} starts", flush=True)
 
-    with io.BytesIO() as buffered:
-        image.save(buffered, format="PNG")
-        buffered.seek(0)
-        
-        # Prepare the data
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        files = {'image': ('image.png', buffered, 'image/png')}
-        data = {'question': question, 'inference_id': inference_id, 'timestamp': timestamp}
-        
-        # POST request to the backend inference API
-        response = requests.post(url, files=files, data=data)
-        response.raise_for_status()
+    encode_start = time.perf_counter()
 
-        result = response.json()
-        
-        if 'result' not in result:
-            raise gr.Error("Invalid response: 'result' field is missing")
+    with open(image, 'rb') as f:
+        image_bytes = f.read()
+
+    content_type = mimetypes.guess_type(image)[0] or 'application/octet-stream'
+    file_name = os.path.basename(image)
+
+    # Prepare the data
+    now = time.time()
+    timestamp = datetime.fromtimestamp(now).isoformat()
+    deadline = now + INFERENCE_TIMEOUT
+    files = {'image': (file_name, image_bytes, content_type)}
+    data = {'question': question, 'inference_id': inference_id, 'timestamp': timestamp, 'deadline': repr(deadline)}
+
+    FRONTEND_ENCODE_DURATION_HISTOGRAM.labels(model_name=model_name).observe(time.perf_counter() - encode_start)
+    FRONTEND_UPLOAD_BYTES.labels(model_name=model_name, content_type=content_type).inc(len(image_bytes))
+
+    # POST request to the backend inference API
+    transfer_start = time.perf_counter()
+    try:
+        response = session.post(url, files=files, data=data, timeout=INFERENCE_TIMEOUT)
+    except requests.Timeout:
+        raise gr.Error("The inference did not finish in time, please retry")
+
+    FRONTEND_TRANSFER_DURATION_HISTOGRAM.labels(model_name=model_name).observe(time.perf_counter() - transfer_start)
+
+    if response.status_code == 429:
+        raise gr.Error(f"The model is busy, please retry in {response.headers.get('Retry-After', 'a few')} seconds")
+
+    if response.status_code == 504:
+        raise gr.Error("The inference did not finish in time, please retry")
+
+    response.raise_for_status()
+
+    result = response.json()
+    
+    if 'result' not in result:
+        raise gr.Error("Invalid response: 'result' field is missing")
     
     return result['result'], inference_id
 
 
-def handle_feedback(inference_id, feedback_type):
+def handle_feedback(inference_id, feedback_type, model_name="layoutlmv3"):
     """
     Sends a given feedback type as a request towards the dedicated endpoint. 
     
     Args:
         inference_id (str): The unique inference id to the coresponding inference process.
         feedback_type (str): "correct" or "incorrect" as feedback to be updated.
+        model_name (str): Name of the model registered in the backend.
     """
 
-    url = 'http://nginx/api/layoutlmv3/handle_feedback'
+    url = f'http://nginx/api/{model_name}/handle_feedback'
 
     if inference_id is not None:
         print(f"[*] Frontend: Sending '{feedback_type}' for inference_id: {inference_id}", flush=True)
 
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        timestamp = datetime.now().isoformat()
         data = {'feedback_type': feedback_type, 'inference_id': inference_id, 'timestamp': timestamp}
         
         try:
-            response = requests.post(url, data=data)
+            response = session.post(url, data=data)
             response.raise_for_status() 
         except requests.RequestException as e:
             print(f"Error sending feedback: {e}")
@@ -77,21 +131,36 @@ def handle_feedback(inference_id, feedback_type):
 ### Gradio User Interface Visuals
 #########################################################################
 
-with gr.Blocks() as demo:
+# One tab per model registered in the backend, e.g. MODELS="layoutlmv3,donut"
+MODELS = os.environ.get('MODELS', 'layoutlmv3').split(',')
+
+
+def build_model_tab(model_name, api_suffix):
+    """
+    Adds the inference tab of a model. The first model keeps the unsuffixed API names used by API clients.
 
-    with gr.Tab("Layoutlmv3"):
+    Args:
+        model_name (str): Name of the model registered in the backend.
+        api_suffix (str): Suffix appended to the API names of the tab's events.
+    """
+
+    with gr.Tab(model_name.capitalize()):
         gr.Markdown("# Document Question Answering")
         gr.Markdown("Upload an Image of a Document and enter a question to get an answer from the ML model")
-        image_input_custom = gr.Image(type="pil", label="Upload Image")
+        # gr.File keeps the uploaded bytes untouched, gr.Image would re-encode them
+        image_input_custom = gr.File(label="Upload Image", file_types=["image"], type="filepath")
+        image_preview_custom = gr.Image(label="Preview", interactive=False)
+        image_input_custom.upload(fn=lambda image: image, inputs=[image_input_custom], outputs=[image_preview_custom], api_name=False)
         question_input_custom = gr.Textbox(label="Enter Question")
         button_custom = gr.Button("Submit")
         result_output_custom = gr.Textbox(label="Result")
         inference_id_label = gr.Label(label="Inference-ID", visible=True)
         
         button_custom.click(
-            fn=run_distinct_inference, 
+            fn=lambda question, image: run_distinct_inference(question, image, model_name), 
             inputs=[question_input_custom, image_input_custom], 
-            outputs=[result_output_custom, inference_id_label]
+            outputs=[result_output_custom, inference_id_label],
+            api_name=f"run_distinct_inference{api_suffix}"
         )
 
 
@@ -100,22 +169,29 @@ with gr.Blocks() as demo:
             negative_feedback  = gr.Button("Incorrect")
             
             positive_feedback.click(
-                fn=lambda inference_id: handle_feedback(inference_id, "correct"),
+                fn=lambda inference_id: handle_feedback(inference_id, "correct", model_name),
                 inputs=[inference_id_label],
-                outputs=[]
+                outputs=[],
+                api_name=f"lambda{api_suffix}"
             )
 
             negative_feedback.click(
-                fn=lambda inference_id: handle_feedback(inference_id, "incorrect"),
+                fn=lambda inference_id: handle_feedback(inference_id, "incorrect", model_name),
                 inputs=[inference_id_label],
-                outputs=[]
+                outputs=[],
+                api_name=f"lambda_1{api_suffix}"
             )
-    
-    # Add a new model here:
-    # with gr.Tab("..."):
+
+
+with gr.Blocks() as demo:
+
+    for index, model_name in enumerate(MODELS):
+        build_model_tab(model_name, "" if index == 0 else f"_{model_name}")
 
             
 if __name__ == "__main__":
+
+    start_http_server(int(os.environ.get('FRONTEND_METRICS_PORT', 8000)))
     
     demo.queue(default_concurrency_limit=None).launch(server_name="0.0.0.0", server_port=7860, show_error=True, show_api=True, max_threads = 450)
    
\ No newline at end of file
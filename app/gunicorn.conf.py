@@ -0,0 +1,34 @@
+import os
+
+import multiprocess_metrics
+import sketch
+
+# Gunicorn configuration of the backend, see https://docs.gunicorn.org/en/latest/settings.html
+
+bind = "0.0.0.0:5000"
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+# threads = ADMISSION_MAX_CONCURRENCY + ADMISSION_MAX_QUEUE + spare threads for feedback and database requests
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 1200))
+
+
+def on_starting(server):
+    """ Starts every run with an empty Prometheus multiprocess directory. """
+
+    directory = multiprocess_metrics.get_directory()
+    if directory:
+        multiprocess_metrics.clear_directory(directory)
+
+
+def child_exit(server, worker):
+    """ Compacts the metric files of an exited worker, so scrapes do not slow down as workers are restarted. """
+
+    directory = multiprocess_metrics.get_directory()
+    if directory:
+        multiprocess_metrics.compact_worker(directory, worker.pid)
+
+
+def worker_exit(server, worker):
+    """ Writes the latest sketches of the exiting worker, so they are part of the compaction. """
+
+    sketch.flush()
@@ -0,0 +1,132 @@
+import os
+import sys
+import copy
+import json
+import time
+import queue
+import atexit
+import logging
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+#########################################################################
+### Structured Logging
+#########################################################################
+#
+# Log records are written as JSON lines to stdout by a background thread of each process, request
+# threads only put the record into a bounded queue. Records carry the inference id of the current
+# request, set once by the backend via inference_id.set(), and optional stage and duration fields.
+#
+# LOG_LEVEL=INFO (default) logs one line per request, LOG_LEVEL=DEBUG additionally logs every pipeline stage.
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+# Fields passed with extra={...} which are added to the JSON line
+EXTRA_FIELDS = ("inference_id", "model_name", "stage", "duration", "status")
+
+inference_id = contextvars.ContextVar('inference_id', default=None)
+
+listener = None
+listener_pid = None
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        line = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        for field in EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                line[field] = value
+
+        if record.exc_text:
+            line["exception"] = record.exc_text
+
+        return json.dumps(line, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """ Hands records to the listener thread, records are dropped instead of blocking a request if the queue is full. """
+
+    def prepare(self, record):
+        # Arguments and tracebacks are resolved here, they may not be valid anymore once the listener formats the record
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        # The inference id has to be read in the request thread, the listener thread has no request context
+        if getattr(record, 'inference_id', None) is None:
+            record.inference_id = inference_id.get()
+
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def setup():
+    """ Routes all log records of the current process through the queue, calling this again within the same process has no effect. """
+
+    global listener, listener_pid
+
+    if listener is not None and listener_pid == os.getpid():
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+
+    root = logging.getLogger()
+    root.handlers = [NonBlockingQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+
+    first_setup = listener is None
+
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    listener.start()
+    listener_pid = os.getpid()
+
+    if first_setup:
+        atexit.register(stop)
+
+
+def stop():
+    """ Writes the queued records, called when the process exits. A forked process only stops its own listener. """
+
+    if listener is not None and listener_pid == os.getpid():
+        listener.stop()
+
+
+def get_logger(name):
+    setup()
+    return logging.getLogger(name)
+
+
+@contextmanager
+def stage(logger, name, **fields):
+    """ Logs the duration of a pipeline stage at debug level, costs a single level check if debug logging is disabled. """
+
+    if not logger.isEnabledFor(logging.DEBUG):
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        logger.debug(f"{name} finished", extra=dict(fields, stage=name, duration=round(time.perf_counter() - start, 6)))
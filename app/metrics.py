@@ -2,6 +2,12 @@
 from collections import Counter as CollectionCounter
 from prometheus_client import Gauge, Histogram, Counter
 import re
+import time
+
+import sketch
+import log
+
+logger = log.get_logger("metrics")
 
 #########################################################################
 ### Input Metrics
@@ -50,6 +56,45 @@ UNSUCCESSFUL_INFERENCES = Counter('unsuccessful_inferences', 'Total amount of un
 REQUEST_LATENCY = Gauge('request_latency','Latency for a certain endpoint in ms', ['model_name', 'endpoint'])
 REQUEST_LATENCY_HISTOGRAM = Histogram('request_latency_histogram','distribution of Latency for a certain endpoint in ms', ['model_name', 'endpoint'], buckets=[0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0])
 
+REQUEST_PARSE_DURATION_HISTOGRAM = Histogram('request_parse_duration_histogram', 'distribution of duration (seconds) of receiving and parsing an inference request by protocol (multipart, binary)', ['model_name', 'protocol'], buckets=[0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0])
+
+WORKER_MEMORY_BYTES = Gauge('worker_memory_bytes', 'Memory of the worker process by kind (rss, pss, shared, private)', ['kind'])
+
+MODEL_LOADS = Counter('model_loads', 'Total amount of model loads by the model registry', ['model_name'])
+MODEL_EVICTIONS = Counter('model_evictions', 'Total amount of model evictions by the model registry', ['model_name'])
+MODEL_LOAD_DURATION_HISTOGRAM = Histogram('model_load_duration_histogram', 'distribution of duration (seconds) of loading a model on its first request', ['model_name'], buckets=[1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0])
+MODEL_LOADED = Gauge('model_loaded', 'Amount of worker processes holding the model in memory', ['model_name'], multiprocess_mode='livesum')
+MODEL_MEMORY_BYTES = Gauge('model_memory_bytes', 'Bytes of model parameters and buffers held in memory', ['model_name'], multiprocess_mode='livesum')
+
+COALESCED_REQUESTS = Counter('coalesced_requests', 'Total amount of requests answered with the result of an identical in-flight request', ['model_name'])
+COALESCED_WAIT_DURATION_HISTOGRAM = Histogram('coalesced_wait_duration_histogram', 'distribution of time (seconds) coalesced requests waited for the result of the identical request', ['model_name'], buckets=[0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0])
+
+DEADLINE_EXCEEDED_COUNTER = Counter('deadline_exceeded_requests', 'Total amount of requests aborted because their deadline passed before a stage', ['model_name', 'stage'])
+
+ADMISSION_ACTIVE = Gauge('admission_active_requests', 'Amount of admitted requests currently running', ['model_name'], multiprocess_mode='livesum')
+ADMISSION_QUEUE_DEPTH = Gauge('admission_queue_depth', 'Amount of requests waiting for admission', ['model_name'], multiprocess_mode='livesum')
+ADMISSION_WAIT_DURATION_HISTOGRAM = Histogram('admission_wait_duration_histogram', 'distribution of time (seconds) requests waited for admission', ['model_name', 'priority'], buckets=[0.0, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0])
+ADMISSION_SHED_COUNTER = Counter('admission_shed_requests', 'Total amount of requests rejected by admission control', ['model_name', 'priority', 'reason'])
+
+STORAGE_POOL_CONNECTIONS = Gauge('storage_pool_connections', 'Connections of the storage client pools by state (open, in_use, in_flight)', ['storage', 'state'], multiprocess_mode='livesum')
+STORAGE_POOL_WAIT_DURATION_HISTOGRAM = Histogram('storage_pool_wait_duration_histogram', 'distribution of time (seconds) waited for a free pooled connection', ['storage'], buckets=[0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.0, 5.0])
+STORAGE_POOL_CHECK_OUT_FAILURES = Counter('storage_pool_check_out_failures', 'Total amount of failed connection check outs', ['storage', 'reason'])
+STORAGE_OPERATION_DURATION_HISTOGRAM = Histogram('storage_operation_duration_histogram', 'distribution of duration (seconds) of storage operations including retries', ['storage', 'operation'], buckets=[0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.0, 5.0, 15.0])
+STORAGE_OPERATION_RETRIES = Counter('storage_operation_retries', 'Total amount of retried storage operations', ['storage', 'operation'])
+STORAGE_OPERATION_FAILURES = Counter('storage_operation_failures', 'Total amount of storage operations failed after exhausting the retry budget', ['storage', 'operation'])
+IMAGE_BYTES_STORED = Counter('image_bytes_stored', 'Total amount of image bytes written to the object store by kind (original, thumbnail)', ['model_name', 'kind'])
+IMAGE_BYTES_SERVED = Counter('image_bytes_served', 'Total amount of image bytes served by kind (original, thumbnail)', ['model_name', 'kind'])
+STORAGE_INSERT_DURATION_HISTOGRAM = Histogram('storage_insert_duration_histogram', 'distribution of duration (seconds) of storing an entry by storage schema (embedded, normalized)', ['model_name', 'schema'], buckets=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0])
+STORAGE_COLLECTION_BYTES = Gauge('storage_collection_bytes', 'Uncompressed size (bytes) of the stored entries and per-image documents', ['model_name', 'collection'], multiprocess_mode='mostrecent')
+STORAGE_COLLECTION_AVG_OBJECT_BYTES = Gauge('storage_collection_avg_object_bytes', 'Average size (bytes) of a stored entry or per-image document', ['model_name', 'collection'], multiprocess_mode='mostrecent')
+
+RETENTION_TIER_ENTRIES = Gauge('retention_tier_entries', 'Amount of stored entries by retention tier (hot, archived)', ['model_name', 'tier'], multiprocess_mode='mostrecent')
+RETENTION_COLLECTION_BYTES = Gauge('retention_collection_bytes', 'Uncompressed size (bytes) of the documents of the MongoDB collection', ['model_name'], multiprocess_mode='mostrecent')
+RETENTION_ARCHIVED_ENTRIES = Counter('retention_archived_entries', 'Total amount of entries whose feature fields were moved to the archive', ['model_name'])
+RETENTION_ARCHIVED_BYTES = Counter('retention_archived_bytes', 'Total amount of compressed bytes written to the archive', ['model_name'])
+RETENTION_RUN_DURATION_HISTOGRAM = Histogram('retention_run_duration_histogram', 'distribution of duration (seconds) of archival runs', ['model_name'], buckets=[0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0])
+RETENTION_RUN_FAILURES = Counter('retention_run_failures', 'Total amount of failed archival runs', ['model_name'])
+
 #########################################################################
 ### Model Metrics
 #########################################################################
@@ -62,6 +107,11 @@ CONFIDENCE_SCORE_HISTOGRAM = Histogram('confidence_score_histogram', 'Distributi
 CONFIDENCE_SCORE_DIFFERENCE = Gauge('confidence_score_difference', 'difference of start and end confidence score', ['model_name']) #,'inference_id'
 CONFIDENCE_SCORE_DIFFERENCE_HISTOGRAM = Histogram('confidence_score_difference_histogram', 'distribution of confidence score difference', ['model_name'], buckets=[0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0])
 
+WINDOW_COUNT_HISTOGRAM = Histogram('window_count_histogram', 'Distribution of the amount of 512-token windows per request in overflow mode', ['model_name'], buckets=[1, 2, 3, 4, 6, 8, 12, 16])
+
+CASCADE_STAGE_COUNTER = Counter('cascade_stage_counter', 'Total amount of answers by the answering stage of the model cascade (first_stage, full)', ['model_name', 'stage'])
+CASCADE_FIRST_STAGE_CONFIDENCE_HISTOGRAM = Histogram('cascade_first_stage_confidence_histogram', 'Distribution of the minimum of start and end confidence of the first cascade stage', ['model_name'], buckets=[0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0])
+
 #########################################################################
 ### Output Metrics
 #########################################################################
@@ -80,6 +130,14 @@ def update_user_feedback_counter(model_name, feedback_type):
     USER_FEEDBACK_COUNTER.labels(model_name=model_name, feedback_type=feedback_type).inc()
 
 
+def update_user_feedback_counter_bulk(model_name, feedback_types):
+
+    feedback_counts = CollectionCounter(feedback_types)
+
+    for feedback_type, count in feedback_counts.items():
+        USER_FEEDBACK_COUNTER.labels(model_name=model_name, feedback_type=feedback_type).inc(count)
+
+
 def inc_successful__inference(model_name):
     SUCCESSFUL_INFERENCES.labels(model_name=model_name).inc()
 
@@ -100,6 +158,21 @@ def update_confidence_score(model_name, start_confidence, end_confidence):
     CONFIDENCE_SCORE_HISTOGRAM.labels(model_name=model_name, score_type='end').observe(end_confidence)
     CONFIDENCE_SCORE_DIFFERENCE_HISTOGRAM.labels(model_name=model_name).observe(confidence_difference)
 
+    sketch.observe('confidence_score_start', model_name, start_confidence)
+    sketch.observe('confidence_score_end', model_name, end_confidence)
+
+
+def update_window_count(model_name, windows):
+    WINDOW_COUNT_HISTOGRAM.labels(model_name=model_name).observe(windows)
+
+
+def inc_cascade_stage(model_name, stage):
+    CASCADE_STAGE_COUNTER.labels(model_name=model_name, stage=stage).inc()
+
+
+def update_cascade_first_stage_confidence(model_name, confidence):
+    CASCADE_FIRST_STAGE_CONFIDENCE_HISTOGRAM.labels(model_name=model_name).observe(confidence)
+
 
 def update_image_size(model_name, image_width, image_height):
 
@@ -109,6 +182,9 @@ def update_image_size(model_name, image_width, image_height):
     IMAGE_WIDTH_HISTOGRAMM.labels(model_name=model_name).observe(image_width)
     IMAGE_HEIGHT_HISTOGRAMM.labels(model_name=model_name).observe(image_height)
 
+    sketch.observe('image_width_pixels', model_name, image_width)
+    sketch.observe('image_height_pixels', model_name, image_height)
+
 
 def calculate_bounding_box_metrics(model_name, bounding_boxes, image_width, image_height):
     
@@ -126,7 +202,7 @@ def calculate_bounding_box_metrics(model_name, bounding_boxes, image_width, imag
             )
         else:
 
-            print(f"Invalid bounding box detected: {box}")
+            logger.warning(f"Invalid bounding box detected: {box}")
     
     coverage_percentage = (total_bounding_box_area / image_area) * 100
     average_area = total_bounding_box_area / len(bounding_boxes)
@@ -136,12 +212,16 @@ def calculate_bounding_box_metrics(model_name, bounding_boxes, image_width, imag
 
     AVG_BOUNDING_BOX_AREA_HISTOGRAM.labels(model_name=model_name).observe(average_area)
     AVG_BOUNDING_BOX_AREA.labels(model_name=model_name).set(average_area)
+
+    sketch.observe('bounding_box_coverage', model_name, coverage_percentage)
+    sketch.observe('avg_bounding_box_area', model_name, average_area)
     
 
 def update_ocr_word_count(model_name, words):
 
     ocr_word_count = len(words)
     OCR_WORD_COUNT.labels(model_name=model_name).set(ocr_word_count)
+    sketch.observe('ocr_word_count', model_name, ocr_word_count)
 
 
 def update_question_length(model_name, question):
@@ -152,6 +232,7 @@ def update_question_length(model_name, question):
 
     QUESTION_WORD_LENGTH_HISTOGRAM.labels(model_name).observe(question_length)
     QUESTION_WORD_LENGTH.labels(model_name).set(question_length)
+    sketch.observe('question_word_length', model_name, question_length)
 
 
 def update_token_distribution(model_name, input_ids):
@@ -191,6 +272,10 @@ def update_endpoint_latency(model_name, endpoint, start, end):
     REQUEST_LATENCY_HISTOGRAM.labels(model_name=model_name, endpoint=endpoint).observe(latency.total_seconds())
 
 
+def update_request_parse_duration(model_name, protocol, duration):
+    REQUEST_PARSE_DURATION_HISTOGRAM.labels(model_name=model_name, protocol=protocol).observe(duration)
+
+
 def update_initialization_duration(model_name, part, start, end):
     total_duration = end-start
     INITIALIZATION_DURATION.labels(model_name=model_name, part=part).set(total_duration.total_seconds())
@@ -206,4 +291,129 @@ def update_token_ids_count(model_name, token_ids):
 
     for token_id, count in token_counts.items():
         TOKEN_USAGE_GAUGE.labels(model_name=model_name, token_id=token_id).set(count)
-        TOKEN_USAGE.labels(model_name=model_name, token_id=token_id).inc()
\ No newline at end of file
+        TOKEN_USAGE.labels(model_name=model_name, token_id=token_id).inc()
+
+
+def update_storage_pool_connections(storage, state, delta):
+    STORAGE_POOL_CONNECTIONS.labels(storage=storage, state=state).inc(delta)
+
+
+def update_storage_pool_wait_duration(storage, duration):
+    STORAGE_POOL_WAIT_DURATION_HISTOGRAM.labels(storage=storage).observe(duration)
+
+
+def inc_storage_pool_check_out_failure(storage, reason):
+    STORAGE_POOL_CHECK_OUT_FAILURES.labels(storage=storage, reason=reason).inc()
+
+
+def update_storage_operation_duration(storage, operation, duration):
+    STORAGE_OPERATION_DURATION_HISTOGRAM.labels(storage=storage, operation=operation).observe(duration)
+
+
+def inc_storage_operation_retry(storage, operation):
+    STORAGE_OPERATION_RETRIES.labels(storage=storage, operation=operation).inc()
+
+
+def inc_storage_operation_failure(storage, operation):
+    STORAGE_OPERATION_FAILURES.labels(storage=storage, operation=operation).inc()
+
+
+def inc_image_bytes_stored(model_name, kind, size):
+    IMAGE_BYTES_STORED.labels(model_name=model_name, kind=kind).inc(size)
+
+
+def inc_image_bytes_served(model_name, kind, size):
+    IMAGE_BYTES_SERVED.labels(model_name=model_name, kind=kind).inc(size)
+
+
+worker_memory_updated = 0.0
+
+
+def update_storage_insert_duration(model_name, schema, duration):
+    STORAGE_INSERT_DURATION_HISTOGRAM.labels(model_name=model_name, schema=schema).observe(duration)
+
+
+def update_storage_stats(model_name, stats):
+    for collection, collection_stats in stats.items():
+        STORAGE_COLLECTION_BYTES.labels(model_name=model_name, collection=collection).set(collection_stats['size'])
+        STORAGE_COLLECTION_AVG_OBJECT_BYTES.labels(model_name=model_name, collection=collection).set(collection_stats['avg_size'])
+
+
+def update_retention_run(model_name, archived, archived_bytes, duration):
+    RETENTION_ARCHIVED_ENTRIES.labels(model_name=model_name).inc(archived)
+    RETENTION_ARCHIVED_BYTES.labels(model_name=model_name).inc(archived_bytes)
+    RETENTION_RUN_DURATION_HISTOGRAM.labels(model_name=model_name).observe(duration)
+
+
+def inc_retention_run_failure(model_name):
+    RETENTION_RUN_FAILURES.labels(model_name=model_name).inc()
+
+
+def update_retention_tiers(model_name, tier_entries, collection_bytes):
+    for tier, entries in tier_entries.items():
+        RETENTION_TIER_ENTRIES.labels(model_name=model_name, tier=tier).set(entries)
+    RETENTION_COLLECTION_BYTES.labels(model_name=model_name).set(collection_bytes)
+
+
+def update_worker_memory(min_interval=15.0):
+    """ Exports shared and unique memory of the current process from /proc/self/smaps_rollup, at most once per interval. """
+
+    global worker_memory_updated
+
+    now = time.monotonic()
+    if now - worker_memory_updated < min_interval:
+        return
+    worker_memory_updated = now
+
+    try:
+        with open('/proc/self/smaps_rollup', 'r') as f:
+            values = {}
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    values[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    except OSError:
+        return
+
+    WORKER_MEMORY_BYTES.labels(kind='rss').set(values.get('Rss', 0))
+    WORKER_MEMORY_BYTES.labels(kind='pss').set(values.get('Pss', 0))
+    WORKER_MEMORY_BYTES.labels(kind='shared').set(values.get('Shared_Clean', 0) + values.get('Shared_Dirty', 0))
+    WORKER_MEMORY_BYTES.labels(kind='private').set(values.get('Private_Clean', 0) + values.get('Private_Dirty', 0))
+
+
+def update_model_loaded(model_name, duration, memory_bytes):
+    MODEL_LOADS.labels(model_name=model_name).inc()
+    MODEL_LOAD_DURATION_HISTOGRAM.labels(model_name=model_name).observe(duration)
+    MODEL_LOADED.labels(model_name=model_name).set(1)
+    MODEL_MEMORY_BYTES.labels(model_name=model_name).set(memory_bytes)
+
+
+def update_model_evicted(model_name):
+    MODEL_EVICTIONS.labels(model_name=model_name).inc()
+    MODEL_LOADED.labels(model_name=model_name).set(0)
+    MODEL_MEMORY_BYTES.labels(model_name=model_name).set(0)
+
+
+def update_coalesced_request(model_name, wait_duration):
+    COALESCED_REQUESTS.labels(model_name=model_name).inc()
+    COALESCED_WAIT_DURATION_HISTOGRAM.labels(model_name=model_name).observe(wait_duration)
+
+
+def inc_deadline_exceeded(model_name, stage):
+    DEADLINE_EXCEEDED_COUNTER.labels(model_name=model_name, stage=stage).inc()
+
+
+def update_admission_active(model_name, delta):
+    ADMISSION_ACTIVE.labels(model_name=model_name).inc(delta)
+
+
+def update_admission_queue_depth(model_name, delta):
+    ADMISSION_QUEUE_DEPTH.labels(model_name=model_name).inc(delta)
+
+
+def update_admission_wait_duration(model_name, priority, duration):
+    ADMISSION_WAIT_DURATION_HISTOGRAM.labels(model_name=model_name, priority=priority).observe(duration)
+
+
+def inc_admission_shed(model_name, priority, reason):
+    ADMISSION_SHED_COUNTER.labels(model_name=model_name, priority=priority, reason=reason).inc()
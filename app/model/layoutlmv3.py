@@ -1,5 +1,5 @@
 
-from transformers import LayoutLMv3ImageProcessor, LayoutLMv3Processor, AutoModelForQuestionAnswering
+from transformers import LayoutLMv3ImageProcessor, LayoutLMv3Processor, AutoModelForQuestionAnswering, AutoConfig
 import pytesseract
 
 import torch.nn.functional as F
@@ -9,38 +9,123 @@ import io
 from PIL import Image
 
 import os
+import gc
 
 from datetime import datetime
 
 # Modules
 import database
 import metrics
+from deadline import check_deadline
+from model import shared_weights
+import log
+
+logger = log.get_logger("layoutlmv3")
 
 #torch.set_num_threads(24)
 
 model_name = "layoutlmv3"
+checkpoint = "rubentito/layoutlmv3-base-mpdocvqa"
 
-image_processor = LayoutLMv3ImageProcessor()
+# "private": every worker loads its own copy of the weights, "mmap": workers share one memory-mapped copy
+WEIGHTS_MODE = os.environ.get('MODEL_WEIGHTS_MODE', 'private')
+
+# Cascade: a cheaper first stage answers first, requests are escalated to the full model if its
+# start or end confidence is below the threshold. "quantized" uses a dynamically int8-quantized copy
+# of the full model, any other value is loaded as checkpoint sharing the encoder of the full model.
+CASCADE_FIRST_STAGE = os.environ.get('CASCADE_FIRST_STAGE')
+CASCADE_THRESHOLD = float(os.environ.get('CASCADE_THRESHOLD', 0.5))
+
+# Overflow mode: documents exceeding 512 tokens are split into overlapping windows which are run in one
+# batched forward pass, the answer is the best scoring span over all windows.
+OVERFLOW_MODE = os.environ.get('OVERFLOW_MODE', '0') == '1'
+OVERFLOW_STRIDE = int(os.environ.get('OVERFLOW_STRIDE', 128))
+MAX_ANSWER_LENGTH = int(os.environ.get('MAX_ANSWER_LENGTH', 30))
 
-print("[*] Layoutlmv3: Loading Encoder", flush=True)
-load_encoder_start = datetime.now()
-encoder = LayoutLMv3Processor.from_pretrained("microsoft/layoutlmv3-large", resume_download=True, force_download=True, apply_ocr=False)
-load_encoder_end = datetime.now()
-print("[*] Layoutlmv3: Encoder loaded", flush=True)
+image_processor = LayoutLMv3ImageProcessor()
 
-print("[*] Layoutlmv3: Loading Model", flush=True)
-load_model_start = datetime.now()
-model = AutoModelForQuestionAnswering.from_pretrained("rubentito/layoutlmv3-base-mpdocvqa", resume_download=True, low_cpu_mem_usage=False) 
-load_model_end = datetime.now()
-print("[*] Layoutlmv3: Model loaded", flush=True)
+encoder = None
+model = None
+first_stage_model = None
 
-print("[*] Layoutlmv3: Loading Tesseract", flush=True)
 pytesseract.tesseract_cmd = os.environ.get('TESSERACT_CMD', '/usr/bin/tesseract')
-print("[*] Layoutlmv3: Tesseract loaded", flush=True)
 
 
-metrics.update_initialization_duration(model_name, "Encoder", load_encoder_start, load_encoder_start)
-metrics.update_initialization_duration(model_name, "Model", load_model_start, load_model_end)
+def load():
+    """ Loads encoder and model weights into the current process, called by the model registry on the first request. """
+
+    global encoder, model
+
+    logger.info("Loading Encoder", extra={"model_name": model_name})
+    load_encoder_start = datetime.now()
+    encoder = LayoutLMv3Processor.from_pretrained("microsoft/layoutlmv3-large", resume_download=True, apply_ocr=False)
+    load_encoder_end = datetime.now()
+    logger.info("Encoder loaded", extra={"model_name": model_name, "duration": (load_encoder_end - load_encoder_start).total_seconds()})
+
+    logger.info(f"Loading Model ({WEIGHTS_MODE})", extra={"model_name": model_name})
+    load_model_start = datetime.now()
+    if WEIGHTS_MODE == 'mmap':
+        path = shared_weights.convert_once(checkpoint, load_private_model)
+        model = shared_weights.load_shared(AutoModelForQuestionAnswering, AutoConfig.from_pretrained(checkpoint), path)
+    else:
+        model = load_private_model()
+    load_model_end = datetime.now()
+    logger.info("Model loaded", extra={"model_name": model_name, "duration": (load_model_end - load_model_start).total_seconds()})
+
+    metrics.update_initialization_duration(model_name, "Encoder", load_encoder_start, load_encoder_end)
+    metrics.update_initialization_duration(model_name, "Model", load_model_start, load_model_end)
+
+    if CASCADE_FIRST_STAGE:
+        load_first_stage_model()
+
+
+def load_first_stage_model():
+    """ Loads the first stage model of the cascade. """
+
+    global first_stage_model
+
+    logger.info(f"Loading First Stage Model ({CASCADE_FIRST_STAGE})", extra={"model_name": model_name})
+    load_first_stage_start = datetime.now()
+
+    if CASCADE_FIRST_STAGE == 'quantized':
+        first_stage_model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    else:
+        first_stage_model = AutoModelForQuestionAnswering.from_pretrained(CASCADE_FIRST_STAGE, resume_download=True)
+
+    first_stage_model.requires_grad_(False)
+    first_stage_model.eval()
+
+    load_first_stage_end = datetime.now()
+    logger.info("First Stage Model loaded", extra={"model_name": model_name, "duration": (load_first_stage_end - load_first_stage_start).total_seconds()})
+
+    metrics.update_initialization_duration(model_name, "FirstStageModel", load_first_stage_start, load_first_stage_end)
+
+
+def load_private_model():
+    return AutoModelForQuestionAnswering.from_pretrained(checkpoint, resume_download=True, low_cpu_mem_usage=False)
+
+
+def unload():
+    """ Releases encoder and model weights, called by the model registry on eviction. """
+
+    global encoder, model, first_stage_model
+
+    encoder = None
+    model = None
+    first_stage_model = None
+    gc.collect()
+
+
+def memory_footprint():
+    """ Returns the amount of bytes held by the parameters and buffers of the loaded model. """
+
+    footprint = 0
+
+    for loaded_model in (model, first_stage_model):
+        if loaded_model is not None:
+            footprint += sum(tensor.numel() * tensor.element_size() for tensor in loaded_model.state_dict().values() if isinstance(tensor, torch.Tensor))
+
+    return footprint
 
 
 def convert_image(image):
@@ -58,7 +143,7 @@ def convert_image(image):
     
     return pil_image
 
-def start_inference(question, image, inference_id):
+def start_inference(question, image, inference_id, deadline=None):
     """
     Processes an image and performs question-answering inference using the LayoutLMv3 model.
 
@@ -66,10 +151,14 @@ def start_inference(question, image, inference_id):
         question (str): The question to be answered based on the content of the image.
         image (bytes object): The raw byte data of the image file read from a request.
         inference_id (str): A unique identifier for the inference request.
+        deadline (float): Optional deadline as seconds since epoch, checked before OCR, model inference and persistence.
 
     Returns:
         str: The result of the inference, which is the answer generated by the model.
 
+    Raises:
+        DeadlineExceeded: If the deadline passed before one of the expensive stages.
+
     The function performs the following steps:
     1. **Image Processing**: 
        - The raw byte image is converted to a PIL image format for further processing.
@@ -95,11 +184,10 @@ def start_inference(question, image, inference_id):
 
     """
 
-    print("[*] Layoutlmv3: Processing Image", flush=True)
-
-    pil_image = convert_image(image)
+    with log.stage(logger, "image_conversion"):
+        pil_image = convert_image(image)
 
-    print("[*] Layoutlmv3: Encoding", flush=True)
+    check_deadline(model_name, deadline, "encoding")
 
     encoding_start = datetime.now()
 
@@ -107,11 +195,14 @@ def start_inference(question, image, inference_id):
 
     encoding_end = datetime.now()
 
-    print("[*] Layoutlmv3: Inference", flush=True)
+    check_deadline(model_name, deadline, "inference")
+
+    metrics.update_window_count(model_name, encoded_data["input_ids"].shape[0])
 
     inference_start = datetime.now()
 
-    result, confidence_score_s, confidence_score_e = inference(encoded_data)
+    with log.stage(logger, "inference"):
+        result, confidence_score_s, confidence_score_e, answered_by = cascade_inference(encoded_data)
 
     # Model returns empty strings with failed inferences
     if not result.strip():
@@ -119,11 +210,16 @@ def start_inference(question, image, inference_id):
 
     inference_end = datetime.now()
 
+    check_deadline(model_name, deadline, "persistence")
+
     timestamp_now = datetime.now()
     
     image_hash = database.generate_image_hash(pil_image)
 
-    object_name = f"{model_name}/{image_hash}.png"
+    # Original encoding unless IMAGE_STORAGE_FORMAT requests a lossless recompression
+    stored_image = database.encode_image(image)
+
+    object_name = f"{model_name}/{image_hash}.{stored_image.extension}"
     
     encoded_dict = tensor_to_json(encoded_data)
 
@@ -132,38 +228,61 @@ def start_inference(question, image, inference_id):
         'timestamp': timestamp_now,
         'question': question,
         'image': object_name,
-        'words' : words,
+        'image_hash': image_hash,
         'input_ids' : encoded_dict['input_ids'],
         'attention_mask' : encoded_dict['attention_mask'],
         'bbox' : encoded_dict['bbox'],
-        'pixel_values' : encoded_dict['pixel_values'],
         'result' : result,
         'confidence_score_start' : confidence_score_s,
         'confidence_score_end' : confidence_score_e,
+        'answered_by' : answered_by,
         'feedback_type' : "None"
     }
     
-    print("[*] Layoutlmv3: Starting Database upload", flush=True)
-    database.insert_data(model_name, data_input)
-    print(f"[*] Layoutlmv3: Saving Image as Object: {object_name}", flush=True)
-    database.insert_image(model_name, object_name, image)
-    print("[*] Layoutlmv3: Database upload done", flush=True)
+    # Features of the image regardless of the question, stored once per image with the normalized schema
+    document = {
+        'words' : words,
+        'ocr_boxes' : boxes,
+        'pixel_values' : encoded_dict['pixel_values']
+    }
+    
+    with log.stage(logger, "db_insert_data"):
+        database.insert_data(model_name, data_input, document)
+    with log.stage(logger, "db_insert_image"):
+        if database.insert_image(model_name, object_name, stored_image.data, stored_image.content_type):
+            database.schedule_thumbnail(model_name, object_name, pil_image)
+
+    with log.stage(logger, "metric_updates"):
+        update_metrics(question, pil_image, words, boxes, encoded_dict['input_ids'][0], confidence_score_s, confidence_score_e)
+        metrics.calculate_encoding_duration(model_name,encoding_start, encoding_end)
+        metrics.calculate_inference_duration(model_name, inference_start, inference_end)
+
+    return result
+
+
+def update_metrics(question, pil_image, words, boxes, input_ids, confidence_score_s, confidence_score_e):
+    """
+    Updates the input and model metrics of a single inference.
+
+    Args:
+        question (str): The question regarding the given image.
+        pil_image (PIL.Image): The image used in the inference.
+        words (List): List of recognized OCR-Words.
+        boxes (List): List of coresponding bounding boxes.
+        input_ids (List): Token ids of the encoded input.
+        confidence_score_s (float): Confidence score of the start position.
+        confidence_score_e (float): Confidence score of the end position.
+    """
 
     image_width, image_height = pil_image.size
 
-    print("[*] Layoutlmv3: Calculating Metrics", flush=True)
     metrics.update_image_size(model_name, image_width, image_height)
     metrics.update_confidence_score(model_name, confidence_score_s, confidence_score_e)
     metrics.calculate_bounding_box_metrics(model_name, boxes, image_width, image_height)
     metrics.update_ocr_word_count(model_name, words)
     metrics.update_question_length(model_name, question)
-    metrics.update_token_distribution(model_name, encoded_dict['input_ids'][0])
-    metrics.calculate_encoding_duration(model_name,encoding_start, encoding_end)
-    metrics.calculate_inference_duration(model_name, inference_start, inference_end)
-    metrics.update_token_ids_count(model_name, encoded_dict['input_ids'][0])
-    print("[*] Layoutlmv3: Metrics done", flush=True)
-
-    return result
+    metrics.update_token_distribution(model_name, input_ids)
+    metrics.update_token_ids_count(model_name, input_ids)
 
 
 def tensor_to_json(encoded_data):
@@ -179,6 +298,10 @@ def tensor_to_json(encoded_data):
     """
     encoding_dict = dict(encoded_data) 
 
+    # All windows share the same image, it is stored once
+    if "pixel_values" in encoding_dict and isinstance(encoding_dict["pixel_values"], torch.Tensor):
+        encoding_dict["pixel_values"] = encoding_dict["pixel_values"][:1]
+
     for key, value in encoding_dict.items():
         if isinstance(value, torch.Tensor):
             encoding_dict[key] = value.tolist()
@@ -202,9 +325,8 @@ def encoding(question, image):
         bboc (List): List if coresponding bounding boxes.
     """
         
-    print("[*] Layoutlmv3: Encoding > Preprocess Image", flush=True)
-    
-    processed_image = image_processor.preprocess(image)
+    with log.stage(logger, "ocr"):
+        processed_image = image_processor.preprocess(image)
 
     encoded = {
     "words": processed_image.words,
@@ -214,12 +336,27 @@ def encoding(question, image):
     words = encoded["words"][0]
     boxes = encoded['bbox'][0]
 
-    print("[*] Layoutlmv3: Encoding > Starting Enconding", flush=True)
-    encoding = encoder(image, question, words, boxes=boxes, return_tensors="pt", max_length = 512, padding="max_length", truncation=True)
-    print("[*] Layoutlmv3: Encoding > Enconding finished", flush=True)
-    
+    with log.stage(logger, "tokenization"):
+        encoding = tokenize(image, question, words, boxes)
+
     return encoding, words, boxes
 
+
+def tokenize(image, question, words, boxes):
+    """ Encodes question, words and boxes into model features, one row per 512-token window in overflow mode. """
+
+    if OVERFLOW_MODE:
+        encoding = encoder(image, question, words, boxes=boxes, return_tensors="pt", max_length = 512, padding="max_length", truncation="only_second", stride=OVERFLOW_STRIDE, return_overflowing_tokens=True)
+        encoding.pop("overflow_to_sample_mapping", None)
+
+        # The processor repeats the image per window, all windows share a view of the first one instead
+        pixel_values = encoding["pixel_values"][0].unsqueeze(0)
+        encoding["pixel_values"] = pixel_values.expand(encoding["input_ids"].shape[0], -1, -1, -1)
+    else:
+        encoding = encoder(image, question, words, boxes=boxes, return_tensors="pt", max_length = 512, padding="max_length", truncation=True)
+
+    return encoding
+
 def inference(encoded_data):
     """
     Performs inference based on given features.
@@ -233,30 +370,142 @@ def inference(encoded_data):
         confidence_score_e (float): Models confidence score (0.0 - 1.0) for the prediction of the ending position in the given context.
     """
         
-    start_positions = torch.tensor([1])
-    end_positions = torch.tensor([3])
+    outputs = forward(encoded_data)
+
+    return answer(encoded_data, outputs)
+
+
+def answer(encoded_data, outputs):
+    """ Decodes the answer of the model outputs, the best span over all windows in overflow mode. """
+
+    if OVERFLOW_MODE or encoded_data["input_ids"].shape[0] > 1:
+        return decode_best_span(encoded_data, outputs.start_logits, outputs.end_logits)
+
+    return decode_answer(encoded_data["input_ids"], outputs.start_logits, outputs.end_logits)
+
+
+def cascade_inference(encoded_data):
+    """
+    Performs inference with the first stage model and escalates to the full model if the first stage is not confident.
+
+    Args:
+        encoded_data (tensor): Encoded features as tensors.
+
+    Returns:
+        result (str): Answer to the posed question as an inference result.
+        confidence_score_s (float): Confidence score of the start position of the answering stage.
+        confidence_score_e (float): Confidence score of the end position of the answering stage.
+        answered_by (str): "first_stage" or "full", the stage which produced the answer.
+    """
+
+    if first_stage_model is not None:
+        outputs = forward(encoded_data, first_stage_model)
+        result, confidence_score_s, confidence_score_e = answer(encoded_data, outputs)
+
+        metrics.update_cascade_first_stage_confidence(model_name, min(confidence_score_s, confidence_score_e))
+
+        if min(confidence_score_s, confidence_score_e) >= CASCADE_THRESHOLD:
+            metrics.inc_cascade_stage(model_name, "first_stage")
+            return result, confidence_score_s, confidence_score_e, "first_stage"
+
+    result, confidence_score_s, confidence_score_e = inference(encoded_data)
+    metrics.inc_cascade_stage(model_name, "full")
+
+    return result, confidence_score_s, confidence_score_e, "full"
+
+
+def forward(encoded_data, stage_model=None):
+    """ Runs the model (or the given stage model) on the encoded features and returns its outputs containing start and end logits. """
+
+    features = {key: encoded_data[key] for key in ("input_ids", "attention_mask", "bbox", "pixel_values")}
+
+    return (stage_model or model)(**features)
+
+
+def decode_answer(input_ids, start_logits, end_logits):
+    """
+    Decodes the answer span and its confidence scores from the model outputs.
 
-    outputs = model(**encoded_data, start_positions=start_positions, end_positions=end_positions)
-    loss = outputs.loss
-    start_scores = outputs.start_logits
-    end_scores = outputs.end_logits
+    Args:
+        input_ids (tensor): Token ids of the encoded input.
+        start_logits (tensor): Start logits of the model outputs.
+        end_logits (tensor): End logits of the model outputs.
 
-    start_logits = outputs.start_logits
-    end_logits = outputs.end_logits
+    Returns:
+        result (str): Answer to the posed question as an inference result.
+        confidence_score_s (float): Confidence score of the start position.
+        confidence_score_e (float): Confidence score of the end position.
+    """
 
     predicted_start_idx = start_logits.argmax(-1).item()
     predicted_end_idx = end_logits.argmax(-1).item()
 
-    probabilities_s = F.softmax(outputs.start_logits, dim=-1)
-    probabilities_e = F.softmax(outputs.end_logits, dim=-1)
+    probabilities_s = F.softmax(start_logits, dim=-1)
+    probabilities_e = F.softmax(end_logits, dim=-1)
 
     confidence_score_s = probabilities_s[0][predicted_start_idx].item()
     confidence_score_e = probabilities_e[0][predicted_end_idx].item()
 
-    result = encoder.tokenizer.decode(encoded_data.input_ids.squeeze()[predicted_start_idx:predicted_end_idx+1])
+    result = encoder.tokenizer.decode(input_ids.squeeze()[predicted_start_idx:predicted_end_idx+1])
     
     # Postprocessing, Inference adds a single ' ' infront of result.
     if result.startswith(' '):
         result = result.lstrip()
 
     return result, confidence_score_s, confidence_score_e
+
+
+def context_mask(encoded_data):
+    """ Returns a boolean mask of the tokens belonging to the document words (not question, special or padding tokens). """
+
+    if hasattr(encoded_data, "sequence_ids") and encoded_data.encodings:
+        return torch.tensor([
+            [sequence_id == 1 for sequence_id in encoded_data.sequence_ids(window)]
+            for window in range(encoded_data["input_ids"].shape[0])
+        ])
+
+    # Features restored from the database: question and special tokens have empty boxes
+    return (encoded_data["bbox"].sum(-1) > 0) & (encoded_data["attention_mask"] > 0)
+
+
+def decode_best_span(encoded_data, start_logits, end_logits):
+    """
+    Selects the answer span with the highest joint start and end score over all windows.
+
+    Only spans within the document words, with end >= start and at most MAX_ANSWER_LENGTH tokens are considered.
+
+    Args:
+        encoded_data (BatchEncoding): Encoded features with one row per window.
+        start_logits (tensor): Start logits of all windows.
+        end_logits (tensor): End logits of all windows.
+
+    Returns:
+        result (str): Answer to the posed question as an inference result.
+        confidence_score_s (float): Confidence score of the start position within its window.
+        confidence_score_e (float): Confidence score of the end position within its window.
+    """
+
+    windows, length = start_logits.shape
+
+    mask = context_mask(encoded_data)
+    masked_start = start_logits.masked_fill(~mask, float("-inf"))
+    masked_end = end_logits.masked_fill(~mask, float("-inf"))
+
+    span_scores = masked_start.unsqueeze(-1) + masked_end.unsqueeze(-2)
+    valid_spans = torch.ones(length, length, dtype=torch.bool).triu().tril(MAX_ANSWER_LENGTH - 1)
+    span_scores = span_scores.masked_fill(~valid_spans, float("-inf"))
+
+    best = span_scores.view(-1).argmax().item()
+
+    # Documents without recognized words have no valid span
+    if span_scores.view(-1)[best] == float("-inf"):
+        return "", 0.0, 0.0
+
+    window, start_idx, end_idx = best // (length * length), (best % (length * length)) // length, best % length
+
+    confidence_score_s = F.softmax(start_logits[window], dim=-1)[start_idx].item()
+    confidence_score_e = F.softmax(end_logits[window], dim=-1)[end_idx].item()
+
+    result = encoder.tokenizer.decode(encoded_data["input_ids"][window][start_idx:end_idx+1]).strip()
+
+    return result, confidence_score_s, confidence_score_e
@@ -0,0 +1,143 @@
+import os
+import time
+import importlib
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+import metrics
+import log
+
+logger = log.get_logger("registry")
+
+#########################################################################
+### Model Registry
+#########################################################################
+#
+# Every model declares the module containing its pipeline and the MongoDB collection of its history.
+# A model module has to provide:
+#   load()                  loads encoder and weights into the current process
+#   unload()                releases encoder and weights
+#   memory_footprint()      bytes held by the loaded model
+#   start_inference(question, image, inference_id, deadline=None)
+#
+# A pipeline module keeps its encoder and weights in module globals, so every model needs a module of
+# its own, e.g. a copy of model/layoutlmv3.py with another checkpoint and model_name.
+#
+# Models are loaded on their first request and kept in LRU order. Once the loaded models exceed
+# MODEL_MEMORY_BUDGET_MB, the least recently used models which are not running an inference are evicted.
+# Loading holds a lock per model only, requests of models already loaded are not blocked meanwhile.
+
+ModelSpec = namedtuple('ModelSpec', ['name', 'module', 'collection'])
+
+MODELS = OrderedDict()
+
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get('MODEL_MEMORY_BUDGET_MB', 4096))
+
+
+def register(name, module, collection):
+    """ Registers a model by its name, the import path of its pipeline module and its collection name. """
+
+    for spec in MODELS.values():
+        if spec.module == module and spec.name != name:
+            raise ValueError(f"Module {module} is already registered for {spec.name}, every model needs its own module")
+
+    MODELS[name] = ModelSpec(name, module, collection)
+
+
+register("layoutlmv3", "model.layoutlmv3", "entryhistory")
+# Register an additional model here
+
+
+class UnknownModel(Exception):
+    """ Raised if a request addresses a model which is not registered. """
+
+
+loaded = OrderedDict()
+in_use = {}
+footprints = {}
+load_locks = {}
+lock = threading.RLock()
+
+
+def get_spec(model_name):
+    if model_name not in MODELS:
+        raise UnknownModel(f"No model registered with name: {model_name}")
+    return MODELS[model_name]
+
+
+def load(model_name):
+    """ Loads a model into the current process if necessary and marks it as most recently used. """
+
+    spec = get_spec(model_name)
+
+    with lock:
+        if model_name in loaded:
+            loaded.move_to_end(model_name)
+            return loaded[model_name]
+        load_lock = load_locks.setdefault(model_name, threading.Lock())
+
+    # Concurrent first requests of the same model wait for a single load
+    with load_lock:
+        with lock:
+            if model_name in loaded:
+                loaded.move_to_end(model_name)
+                return loaded[model_name]
+
+        logger.info(f"Loading {model_name}", extra={"model_name": model_name})
+        load_start = time.perf_counter()
+
+        pipeline = importlib.import_module(spec.module)
+        pipeline.load()
+        footprint = pipeline.memory_footprint()
+
+        with lock:
+            loaded[model_name] = pipeline
+            footprints[model_name] = footprint
+
+        metrics.update_model_loaded(model_name, time.perf_counter() - load_start, footprint)
+        metrics.update_worker_memory(min_interval=0)
+        logger.info(f"{model_name} loaded ({footprint / 2**20:.0f} MB)", extra={"model_name": model_name, "duration": time.perf_counter() - load_start})
+
+        evict(keep=model_name)
+
+        return pipeline
+
+
+def evict(keep=None):
+    """ Evicts least recently used models which are not in use until the loaded models fit into the memory budget. """
+
+    budget = MODEL_MEMORY_BUDGET_MB * 2**20
+
+    with lock:
+        for model_name in list(loaded):
+            if sum(footprints.values()) <= budget:
+                break
+
+            if model_name == keep or in_use.get(model_name, 0) > 0:
+                continue
+
+            logger.info(f"Evicting {model_name} in order to stay within {MODEL_MEMORY_BUDGET_MB:.0f} MB", extra={"model_name": model_name})
+            loaded.pop(model_name).unload()
+            footprints.pop(model_name)
+            metrics.update_model_evicted(model_name)
+
+
+@contextmanager
+def use(model_name):
+    """ Provides the pipeline module of a loaded model, the model is not evicted while it is in use. """
+
+    while True:
+        pipeline = load(model_name)
+        with lock:
+            # Another request may have evicted the model since it was loaded
+            if loaded.get(model_name) is pipeline:
+                in_use[model_name] = in_use.get(model_name, 0) + 1
+                break
+
+    try:
+        yield pipeline
+    finally:
+        with lock:
+            in_use[model_name] -= 1
+        evict()
@@ -0,0 +1,84 @@
+import os
+import fcntl
+
+import torch
+from accelerate import init_empty_weights
+
+import log
+
+logger = log.get_logger("shared_weights")
+
+#########################################################################
+### Shared Model Weights
+#########################################################################
+#
+# The checkpoint is converted once into a local torch file. Every worker maps this file read-only
+# (copy-on-write) instead of materializing a private copy of the weights, so all workers share the
+# same physical pages from the page cache. The weights must never be written to after loading,
+# otherwise the touched pages are copied into the worker.
+
+WEIGHTS_CACHE_DIR = os.environ.get('MODEL_WEIGHTS_CACHE_DIR', '/tmp/model_weights')
+
+
+def weights_path(checkpoint):
+    return os.path.join(WEIGHTS_CACHE_DIR, checkpoint.replace('/', '--') + '.pt')
+
+
+def convert_once(checkpoint, load_private):
+    """
+    Converts a checkpoint into a mappable weights file unless another worker already did.
+
+    Args:
+        checkpoint (str): Name of the checkpoint, used for the file name.
+        load_private (callable): Loads the model the regular way, only called for the conversion.
+
+    Returns:
+        path (str): Path of the weights file.
+    """
+
+    path = weights_path(checkpoint)
+    os.makedirs(WEIGHTS_CACHE_DIR, exist_ok=True)
+
+    with open(path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(path):
+                logger.info(f"Converting {checkpoint} to {path}")
+                model = load_private()
+                torch.save(model.state_dict(), path + '.tmp')
+                os.replace(path + '.tmp', path)
+                del model
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return path
+
+
+def load_shared(model_class, config, path):
+    """
+    Builds a model without allocating weights and assigns the memory-mapped tensors of the weights file.
+
+    Args:
+        model_class: Transformers auto class, e.g. AutoModelForQuestionAnswering.
+        config: Model config of the checkpoint.
+        path (str): Path of the weights file created by convert_once().
+
+    Returns:
+        model: The model in eval mode, its parameters are backed by the mapped file.
+    """
+
+    with init_empty_weights():
+        model = model_class.from_config(config)
+
+    state_dict = torch.load(path, mmap=True, weights_only=True, map_location='cpu')
+    model.load_state_dict(state_dict, assign=True)
+
+    # Autograd is never needed and must not touch the mapped parameters
+    model.requires_grad_(False)
+    model.eval()
+
+    missing = [name for name, tensor in list(model.named_parameters()) + list(model.named_buffers()) if tensor.is_meta]
+    if missing:
+        raise ValueError(f"Weights file {path} is missing tensors: {', '.join(missing)}")
+
+    return model
@@ -0,0 +1,126 @@
+import os
+import glob
+import time
+import fcntl
+import shutil
+import threading
+from contextlib import contextmanager
+
+from prometheus_client import CollectorRegistry, generate_latest, multiprocess
+from prometheus_client.mmap_dict import MmapedDict
+
+import sketch
+
+#########################################################################
+### Prometheus Multiprocess Metrics
+#########################################################################
+#
+# Every gunicorn worker writes its metrics into its own mmap files in the multiprocess directory.
+# Files of exited workers are compacted into one file per metric type, so a scrape reads a
+# constant amount of files no matter how often workers were restarted. Compaction holds an exclusive
+# lock on the directory and scrapes a shared one, so a scrape never sees a worker's values both in
+# its own file and in the compacted file, or a file removed while it is read.
+
+METRICS_CACHE_TTL = float(os.environ.get('METRICS_CACHE_TTL', 1.0))
+
+# Metric types whose values of exited workers remain part of the aggregated totals
+ACCUMULATING_TYPES = ('counter', 'histogram', 'summary')
+
+LOCK_FILE = '.compaction.lock'
+
+cache_lock = threading.Lock()
+cached_output = None
+cached_at = 0.0
+
+
+def get_directory():
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir')
+
+
+def clear_directory(directory):
+    """ Removes the files of a previous run, called by the gunicorn master before the workers are started. """
+
+    os.makedirs(directory, exist_ok=True)
+
+    for path in glob.glob(os.path.join(directory, '*.db')) + glob.glob(os.path.join(directory, '*.db.tmp')):
+        os.remove(path)
+
+    sketch.clear_directory(directory)
+
+
+@contextmanager
+def directory_lock(directory, exclusive):
+    """ Locks the multiprocess directory across all processes, exclusively for compaction and shared for scrapes. """
+
+    with open(os.path.join(directory, LOCK_FILE), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def compact_worker(directory, pid):
+    """
+    Merges the counters, histograms and summaries of an exited worker into the compacted files and removes its files.
+
+    Gauges of the exited worker are dropped, the gauges of this project either report per-process values or
+    live sums which must not contain exited workers.
+    """
+
+    with directory_lock(directory, exclusive=True):
+        for path in glob.glob(os.path.join(directory, f'*_{pid}.db')):
+            metric_type = os.path.basename(path).split('_')[0]
+
+            if metric_type in ACCUMULATING_TYPES:
+                merge_into_compacted(directory, metric_type, path)
+
+            os.remove(path)
+
+        sketch.compact_worker(directory, pid)
+
+
+def merge_into_compacted(directory, metric_type, path):
+    """ Adds the values of a worker file to a copy of the compacted file and replaces the compacted file by it. """
+
+    compacted_path = os.path.join(directory, f'{metric_type}_compacted.db')
+    # Not matched by the *.db pattern of the collector while it is written
+    temp_path = compacted_path + '.tmp'
+
+    if os.path.exists(compacted_path):
+        shutil.copyfile(compacted_path, temp_path)
+    elif os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    source = MmapedDict(path, read_mode=True)
+    target = MmapedDict(temp_path)
+    try:
+        for key, value, _ in source.read_all_values():
+            current, _ = target.read_value(key)
+            target.write_value(key, current + value, 0.0)
+    finally:
+        source.close()
+        target.close()
+
+    os.replace(temp_path, compacted_path)
+
+
+def generate_metrics():
+    """
+    Returns the aggregated metrics of all workers in the text exposition format.
+
+    The output is cached for METRICS_CACHE_TTL seconds, concurrent scrapes within this period share one aggregation.
+    """
+
+    global cached_output, cached_at
+
+    with cache_lock:
+        if cached_output is None or time.monotonic() - cached_at >= METRICS_CACHE_TTL:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            registry.register(sketch.SketchCollector(get_directory()))
+            with directory_lock(get_directory(), exclusive=False):
+                cached_output = generate_latest(registry)
+            cached_at = time.monotonic()
+
+        return cached_output
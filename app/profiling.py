@@ -0,0 +1,162 @@
+import os
+import re
+import uuid
+import hmac
+import mmap
+import fcntl
+import pstats
+import cProfile
+from datetime import datetime
+
+import torch
+
+import log
+
+logger = log.get_logger("profiling")
+
+#########################################################################
+### On-demand Profiling
+#########################################################################
+#
+# An admin arms the profiler for the next N inference requests. The amount of remaining
+# requests is kept in a small memory-mapped file shared by all gunicorn workers, so checking
+# whether a request has to be profiled is a single memory read while the profiler is idle.
+
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+PROFILE_OUTPUT_DIR = os.environ.get('PROFILE_OUTPUT_DIR', '/tmp/profiles')
+PROFILE_MAX_REQUESTS = int(os.environ.get('PROFILE_MAX_REQUESTS', 20))
+
+CONTROL_FILE = os.path.join(PROFILE_OUTPUT_DIR, '.control')
+
+# Inference ids are client supplied, other ids are replaced by a uuid in the profile directory name
+SAFE_ID = re.compile(r'[A-Za-z0-9_-]{1,128}')
+IDLE = bytes(8)
+
+control_file = None
+control = None
+
+
+def open_control():
+    """ Maps the shared control file of the current process, it stores the amount of remaining profiled requests. """
+
+    global control_file, control
+
+    os.makedirs(PROFILE_OUTPUT_DIR, exist_ok=True)
+
+    control_file = open(CONTROL_FILE, 'a+b')
+    if os.path.getsize(CONTROL_FILE) < 8:
+        control_file.write(bytes(8))
+        control_file.flush()
+
+    control = mmap.mmap(control_file.fileno(), 8)
+
+
+def is_authorized(token):
+    """ Admin endpoints are disabled unless ADMIN_TOKEN is set to a non-empty value. """
+
+    if not ADMIN_TOKEN or not token:
+        return False
+
+    return hmac.compare_digest(token, ADMIN_TOKEN)
+
+
+def remaining():
+    return int.from_bytes(control[:8], 'little')
+
+
+def arm(requests):
+    """ Arms the profiler of all workers for the next given amount of inference requests. """
+
+    requests = max(0, min(requests, PROFILE_MAX_REQUESTS))
+
+    fcntl.flock(control_file, fcntl.LOCK_EX)
+    try:
+        control[:8] = requests.to_bytes(8, 'little')
+    finally:
+        fcntl.flock(control_file, fcntl.LOCK_UN)
+
+    return requests
+
+
+def claim():
+    """ Atomically takes one of the remaining profiled requests, returns False if another worker was faster. """
+
+    fcntl.flock(control_file, fcntl.LOCK_EX)
+    try:
+        left = remaining()
+        if left == 0:
+            return False
+        control[:8] = (left - 1).to_bytes(8, 'little')
+        return True
+    finally:
+        fcntl.flock(control_file, fcntl.LOCK_UN)
+
+
+def profile_call(model_name, inference_id, function, *args, **kwargs):
+    """
+    Calls the given pipeline function and profiles it if the profiler is armed.
+
+    Profiled requests store the following files in PROFILE_OUTPUT_DIR/<timestamp>-<model>-<inference_id or uuid>/:
+        inference_id.txt: The inference id of the request.
+        python.prof: cProfile stats, e.g. for flameprof or snakeviz.
+        python.txt: cProfile stats sorted by cumulative time.
+        torch_ops.txt: Operator table of the forward pass sorted by self CPU time.
+        torch.stacks: Folded stacks of the torch operators, input for flamegraph.pl.
+        torch_trace.json: Chrome trace of the torch operators.
+    """
+
+    if control[:8] == IDLE or not claim():
+        return function(*args, **kwargs)
+
+    profile_id = inference_id if SAFE_ID.fullmatch(str(inference_id)) else uuid.uuid4().hex
+    profile_dir = os.path.join(PROFILE_OUTPUT_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{model_name}-{profile_id}")
+    os.makedirs(profile_dir, exist_ok=True)
+
+    with open(os.path.join(profile_dir, 'inference_id.txt'), 'w') as f:
+        f.write(str(inference_id))
+
+    python_profiler = cProfile.Profile()
+    torch_profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], record_shapes=True, with_stack=True)
+
+    try:
+        with torch_profiler:
+            python_profiler.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                python_profiler.disable()
+
+    finally:
+        # Torch results are only available after the profiler context is closed
+        store_profile(python_profiler, torch_profiler, profile_dir)
+        logger.info(f"Stored profile in {profile_dir}", extra={"inference_id": inference_id})
+
+
+def store_profile(python_profiler, torch_profiler, profile_dir):
+    """ Writes the results of both profilers of a single request. """
+
+    python_profiler.dump_stats(os.path.join(profile_dir, 'python.prof'))
+    with open(os.path.join(profile_dir, 'python.txt'), 'w') as f:
+        pstats.Stats(python_profiler, stream=f).sort_stats('cumulative').print_stats(100)
+
+    with open(os.path.join(profile_dir, 'torch_ops.txt'), 'w') as f:
+        f.write(torch_profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=50))
+
+    torch_profiler.export_stacks(os.path.join(profile_dir, 'torch.stacks'), 'self_cpu_time_total')
+    torch_profiler.export_chrome_trace(os.path.join(profile_dir, 'torch_trace.json'))
+
+
+def list_profiles():
+    """ Returns the stored profiles and their files. """
+
+    profiles = {}
+
+    for name in sorted(os.listdir(PROFILE_OUTPUT_DIR)):
+        path = os.path.join(PROFILE_OUTPUT_DIR, name)
+        if os.path.isdir(path):
+            profiles[name] = sorted(os.listdir(path))
+
+    return profiles
+
+
+open_control()
@@ -0,0 +1,217 @@
+import json
+import time
+import argparse
+import importlib
+from datetime import datetime
+from types import SimpleNamespace
+
+import torch
+
+from model import registry
+from similarity import anls
+
+import database
+
+#########################################################################
+### Replay of stored production features
+#########################################################################
+#
+# Streams the stored features of a model's history from MongoDB, rebuilds the tensors in batches and runs
+# them through the model without OCR or encoding. Reports throughput, batch latency and the agreement of the
+# replayed answers with the stored results, e.g. to compare a new checkpoint or runtime on real traffic:
+#
+#   python replay.py --model layoutlmv3 --start 2024-06-01 --limit 2000 --batch-size 8 --output replay.json
+#   CASCADE_FIRST_STAGE=quantized python replay.py --stage first_stage --limit 2000
+#
+# Runtime settings of the pipeline (MODEL_WEIGHTS_MODE, CASCADE_FIRST_STAGE, OVERFLOW_MODE, ...) apply as in the backend.
+
+TENSOR_TYPES = {
+    "input_ids": torch.long,
+    "attention_mask": torch.long,
+    "bbox": torch.long,
+    "pixel_values": torch.float32,
+}
+
+# Disagreements kept in the report for inspection
+MAX_DISAGREEMENTS = 50
+
+
+def to_tensors(record):
+    """ Rebuilds the encoded features of a stored record, None if the record has no stored features. """
+
+    if any(not record.get(name) for name in TENSOR_TYPES):
+        return None
+
+    encoded = {name: torch.tensor(record[name], dtype=dtype) for name, dtype in TENSOR_TYPES.items()}
+
+    # The image is stored once for all windows of a record
+    windows = encoded["input_ids"].shape[0]
+    encoded["pixel_values"] = encoded["pixel_values"][:1].expand(windows, -1, -1, -1)
+
+    return encoded
+
+
+def batches(records, batch_size, stats):
+    """ Groups records with stored features into lists of (record, encoded features). """
+
+    batch = []
+
+    for record in records:
+        encoded = to_tensors(record)
+        if encoded is None:
+            stats["skipped"] += 1
+            continue
+
+        batch.append((record, encoded))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def run_batch(pipeline, batch, stage_model):
+    """
+    Runs one batched forward pass over all windows of the given records and decodes the answer of each record.
+
+    Returns:
+        answers (List): (result, confidence_score_s, confidence_score_e) per record.
+    """
+
+    features = {
+        name: torch.cat([encoded[name] for _, encoded in batch])
+        for name in TENSOR_TYPES
+    }
+
+    outputs = pipeline.forward(features, stage_model)
+
+    answers = []
+    offset = 0
+
+    for _, encoded in batch:
+        windows = encoded["input_ids"].shape[0]
+        record_outputs = SimpleNamespace(
+            start_logits=outputs.start_logits[offset:offset + windows],
+            end_logits=outputs.end_logits[offset:offset + windows]
+        )
+        answers.append(pipeline.answer(encoded, record_outputs))
+        offset += windows
+
+    return answers
+
+
+def percentile(values, q):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def replay(model_name, query_filter, limit=None, batch_size=8, stage="full"):
+    """
+    Replays the stored records of a model matching a filter.
+
+    Args:
+        model_name (str): Name of the registered model.
+        query_filter (dict): Filter as returned by database.build_query_filter().
+        limit (int): Maximum amount of records, unlimited if None.
+        batch_size (int): Amount of records per forward pass.
+        stage (str): "full" for the full model, "first_stage" for the first cascade stage.
+
+    Returns:
+        report (dict): Throughput, latency percentiles and agreement with the stored results.
+    """
+
+    pipeline = importlib.import_module(registry.get_spec(model_name).module)
+    pipeline.load()
+
+    stage_model = None
+    if stage == "first_stage":
+        stage_model = pipeline.first_stage_model
+        if stage_model is None:
+            raise ValueError("CASCADE_FIRST_STAGE has to be set in order to replay the first stage")
+
+    stats = {"records": 0, "skipped": 0, "exact_matches": 0, "anls_sum": 0.0, "confidence_delta_sum": 0.0}
+    batch_latencies = []
+    disagreements = []
+
+    records = database.query_entries(model_name, query_filter, tuple(TENSOR_TYPES), limit=limit)
+
+    start = time.perf_counter()
+
+    with torch.inference_mode():
+        for batch in batches(records, batch_size, stats):
+            batch_start = time.perf_counter()
+            answers = run_batch(pipeline, batch, stage_model)
+            batch_latencies.append(time.perf_counter() - batch_start)
+
+            for (record, _), (result, confidence_score_s, confidence_score_e) in zip(batch, answers):
+                stored = record.get("result") or ""
+
+                stats["records"] += 1
+                stats["anls_sum"] += anls(result, [stored])
+                stats["confidence_delta_sum"] += abs(min(confidence_score_s, confidence_score_e) - min(record.get("confidence_score_start", 0), record.get("confidence_score_end", 0)))
+
+                if result.strip().lower() == stored.strip().lower():
+                    stats["exact_matches"] += 1
+                elif len(disagreements) < MAX_DISAGREEMENTS:
+                    disagreements.append({"inference_id": record["inference_id"], "stored": stored, "replayed": result})
+
+            print(f"[*] Replay: {stats['records']} records replayed", flush=True)
+
+    duration = time.perf_counter() - start
+    records_count = stats["records"]
+
+    return {
+        "model": model_name,
+        "stage": stage,
+        "batch_size": batch_size,
+        "records": records_count,
+        "skipped": stats["skipped"],
+        "duration_seconds": duration,
+        "throughput_records_per_second": records_count / duration if duration else 0.0,
+        "batch_latency_seconds": {
+            "p50": percentile(batch_latencies, 0.5),
+            "p90": percentile(batch_latencies, 0.9),
+            "p99": percentile(batch_latencies, 0.99),
+            "max": max(batch_latencies, default=None),
+        },
+        "exact_agreement": stats["exact_matches"] / records_count if records_count else None,
+        "mean_anls": stats["anls_sum"] / records_count if records_count else None,
+        "mean_confidence_delta": stats["confidence_delta_sum"] / records_count if records_count else None,
+        "disagreements": disagreements,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay stored features of production inferences against the model.")
+    parser.add_argument("--model", default="layoutlmv3")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="ISO timestamp of the first record")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="ISO timestamp after the last record")
+    parser.add_argument("--feedback-type", help="Only replay records with this feedback type")
+    parser.add_argument("--limit", type=int, default=1000, help="Maximum amount of records, 0 for all")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--stage", choices=["full", "first_stage"], default="full")
+    parser.add_argument("--output", help="Path of the JSON report")
+    args = parser.parse_args()
+
+    database.initialize_mongodb()
+
+    query_filter = database.build_query_filter(start_time=args.start, end_time=args.end, feedback_type=args.feedback_type)
+    report = replay(args.model, query_filter, args.limit or None, args.batch_size, args.stage)
+
+    latency = report["batch_latency_seconds"]
+    print(f"Replayed {report['records']} records ({report['skipped']} without features) in {report['duration_seconds']:.1f}s, {report['throughput_records_per_second']:.1f} records/sec")
+    if report["records"]:
+        print(f"Batch latency p50 {latency['p50']:.3f}s, p90 {latency['p90']:.3f}s, p99 {latency['p99']:.3f}s")
+        print(f"Exact agreement {report['exact_agreement']:.1%}, mean ANLS {report['mean_anls']:.4f}, mean confidence delta {report['mean_confidence_delta']:.4f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import os
+import time
+import fcntl
+import random
+import argparse
+import threading
+
+from model import registry
+
+import database
+import metrics
+import log
+
+logger = log.get_logger("retention")
+
+#########################################################################
+### Retention of the entry history
+#########################################################################
+#
+# Usage (inside the backend container):
+#   python retention.py --model layoutlmv3
+#
+# The backend also runs the archival every RETENTION_INTERVAL seconds in a background thread of each
+# worker. A file lock ensures only one worker archives at a time, the others skip the run.
+
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', 3600))
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', 100))
+RETENTION_MAX_ENTRIES_PER_RUN = int(os.environ.get('RETENTION_MAX_ENTRIES_PER_RUN', 10000))
+RETENTION_LOCK_FILE = os.environ.get('RETENTION_LOCK_FILE', '/tmp/retention.lock')
+
+scheduler = None
+
+
+def run(model_name, limit=RETENTION_MAX_ENTRIES_PER_RUN):
+    """
+    Archives the entries and per-image documents of a model which left the hot tier and exports the resulting tier and collection sizes.
+
+    Returns:
+        archived (int): Amount of archived entries.
+    """
+
+    start = time.perf_counter()
+
+    try:
+        database.ensure_indexes(model_name)
+        database.ensure_archive_lifecycle()
+        archived, archived_bytes = database.archive_entries(model_name, RETENTION_BATCH_SIZE, limit)
+        # Per-image documents of the normalized schema
+        archived_documents, archived_document_bytes = database.archive_documents(model_name, RETENTION_BATCH_SIZE, limit)
+        archived_bytes += archived_document_bytes
+
+    except Exception:
+        metrics.inc_retention_run_failure(model_name)
+        raise
+
+    duration = time.perf_counter() - start
+    metrics.update_retention_run(model_name, archived, archived_bytes, duration)
+
+    tier_entries, collection_bytes = database.count_tiers(model_name)
+    metrics.update_retention_tiers(model_name, tier_entries, collection_bytes)
+    metrics.update_storage_stats(model_name, database.storage_stats(model_name))
+
+    logger.info(f"Archived {archived} entries and {archived_documents} documents ({archived_bytes / 1e6:.1f} MB, {archived / duration if duration else 0:.1f} entries/sec)", extra={"model_name": model_name, "stage": "archival", "duration": duration})
+
+    return archived
+
+
+def run_locked():
+    """ Runs the archival of every registered model unless another process currently holds the lock. """
+
+    with open(RETENTION_LOCK_FILE, 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+
+        try:
+            for model_name in registry.MODELS:
+                try:
+                    run(model_name)
+                except Exception as e:
+                    logger.exception(f"Archival of {model_name} failed: {e}", extra={"model_name": model_name, "stage": "archival"})
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def schedule():
+    while True:
+        # Jitter spreads the runs of workers started at the same time
+        time.sleep(RETENTION_INTERVAL * random.uniform(0.9, 1.1))
+        run_locked()
+
+
+def start_scheduler():
+    """ Starts the periodic archival in the current process, disabled if RETENTION_INTERVAL is 0. """
+
+    global scheduler
+
+    if RETENTION_INTERVAL <= 0 or scheduler is not None:
+        return
+
+    scheduler = threading.Thread(target=schedule, name="retention", daemon=True)
+    scheduler.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move feature fields of old entries to the archive.")
+    parser.add_argument("--model", default="layoutlmv3")
+    parser.add_argument("--limit", type=int, default=0, help="Maximum amount of entries to archive, 0 for all")
+    args = parser.parse_args()
+
+    database.initialize_mongodb()
+    database.initialize_minio()
+
+    run(args.model, args.limit or None)
+
+
+if __name__ == "__main__":
+    main()
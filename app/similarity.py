@@ -0,0 +1,57 @@
+import numpy as np
+
+#########################################################################
+### Answer Similarity
+#########################################################################
+#
+# Levenshtein distance and ANLS (Average Normalized Levenshtein Similarity) used by the cascade
+# tuning, the replay engine and the Locust harness.
+
+
+# Row-by-row Levenshtein distance, each row is computed with vectorized numpy operations
+def levenshtein_distance(str1, str2):
+
+    if len(str1) < len(str2):
+        str1, str2 = str2, str1
+
+    if not str2:
+        return len(str1)
+
+    chars1 = np.frombuffer(str1.encode("utf-32-le"), dtype=np.uint32)
+    chars2 = np.frombuffer(str2.encode("utf-32-le"), dtype=np.uint32)
+
+    offsets = np.arange(len(chars2) + 1)
+    previous = offsets.copy()
+
+    for i, char in enumerate(chars1, start=1):
+        current = np.empty_like(previous)
+        current[0] = i
+        current[1:] = np.minimum(previous[:-1] + (chars2 != char),   # Replace
+                                 previous[1:] + 1)                   # Remove
+
+        # Insert: current[j] = min(current[j], current[j - 1] + 1) resolved as running minimum
+        current = np.minimum.accumulate(current - offsets) + offsets
+        previous = current
+
+    return int(previous[-1])
+
+
+def anls_score(str1, str2, threshold=0.5):
+    """ Normalized Levenshtein similarity of two strings, 0 once the normalized distance reaches the threshold. """
+
+    max_len = max(len(str1), len(str2))
+
+    if max_len == 0:
+        return 1.0
+
+    normalized_lev_distance = levenshtein_distance(str1, str2) / max_len
+
+    return 1 - normalized_lev_distance if normalized_lev_distance < threshold else 0.0
+
+
+def anls(prediction, answers, threshold=0.5):
+    """ ANLS of a prediction against all valid answers, ignoring case and surrounding whitespace. """
+
+    prediction = prediction.strip().lower()
+
+    return max((anls_score(answer.strip().lower(), prediction, threshold) for answer in answers), default=0.0)
@@ -0,0 +1,180 @@
+import os
+import re
+import glob
+import json
+import time
+import fcntl
+import hashlib
+
+import metrics
+from deadline import check_deadline
+
+#########################################################################
+### Single-Flight Coalescing
+#########################################################################
+#
+# Identical requests (same model, image bytes and normalized question) running at the same time are
+# coalesced across all workers of the host. The first request holds a file lock per request key and runs
+# the inference, the others wait for the lock and reuse the result the leader wrote next to it. Only
+# results written while a request was waiting are reused, later requests run their own inference.
+
+SINGLEFLIGHT_ENABLED = os.environ.get('SINGLEFLIGHT_ENABLED', 'true').lower() == 'true'
+SINGLEFLIGHT_DIR = os.environ.get('SINGLEFLIGHT_DIR', '/tmp/singleflight')
+SINGLEFLIGHT_MAX_WAIT = float(os.environ.get('SINGLEFLIGHT_MAX_WAIT', 120))
+SINGLEFLIGHT_POLL_INTERVAL = float(os.environ.get('SINGLEFLIGHT_POLL_INTERVAL', 0.02))
+
+# Lock and result files of keys untouched for this many seconds are removed
+SINGLEFLIGHT_FILE_TTL = 300
+SWEEP_INTERVAL = 60
+
+last_sweep = 0.0
+
+
+def normalize_question(question):
+    return re.sub(r"\s+", " ", question).strip().lower()
+
+
+def request_key(model_name, image, question):
+    """ Returns the coalescing key of a request, the MD5 hash of the model name, raw image bytes and normalized question. """
+
+    digest = hashlib.md5(image)
+    digest.update(b'\0' + model_name.encode('utf-8') + b'\0' + normalize_question(question).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def read_result(path, not_before):
+    try:
+        with open(path, 'r') as f:
+            shared = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    return shared if shared['finished'] >= not_before else None
+
+
+def write_result(path, inference_id, result):
+    with open(path + '.tmp', 'w') as f:
+        json.dump({"inference_id": inference_id, "result": result, "finished": time.time()}, f)
+    os.replace(path + '.tmp', path)
+
+
+def run(model_name, key, inference_id, deadline, compute):
+    """
+    Runs compute() unless an identical request is in flight, in which case its result is awaited and returned.
+
+    Args:
+        model_name (str): Name of the model, used as metric label.
+        key (str): Key as returned by request_key().
+        inference_id (str): Inference id of the current request.
+        deadline (float): Deadline of the current request or None, waiting stops once it passed.
+        compute (callable): Runs the inference and returns its result.
+
+    Returns:
+        result (str): The result of the own or the coalesced inference.
+        leader_inference_id (str): Inference id of the request whose result was reused, None if compute() ran.
+
+    Raises:
+        deadline.DeadlineExceeded: If the deadline passed while waiting.
+    """
+
+    if not SINGLEFLIGHT_ENABLED:
+        return compute(), None
+
+    os.makedirs(SINGLEFLIGHT_DIR, exist_ok=True)
+    lock_path = os.path.join(SINGLEFLIGHT_DIR, key + '.lock')
+    result_path = os.path.join(SINGLEFLIGHT_DIR, key + '.json')
+
+    wait_start = time.time()
+    waited = False
+
+    while True:
+        with open(lock_path, 'a') as lock_file:
+            acquired, lock_waited = acquire(lock_file, model_name, deadline, wait_start)
+            waited = waited or lock_waited
+
+            if not acquired:
+                # The leader is stuck, do not wait for it any longer
+                return compute(), None
+
+            if not is_current(lock_file, lock_path):
+                # sweep() removed the file after it was opened, a new file may be locked by another leader
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                continue
+
+            try:
+                if waited:
+                    shared = read_result(result_path, wait_start)
+                    if shared is not None:
+                        metrics.update_coalesced_request(model_name, time.time() - wait_start)
+                        return shared['result'], shared['inference_id']
+
+                # No leader or the leader failed, this request becomes the leader
+                result = compute()
+                write_result(result_path, inference_id, result)
+                return result, None
+
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                sweep()
+
+
+def acquire(lock_file, model_name, deadline, wait_start):
+    """
+    Waits for the lock of a key.
+
+    Returns:
+        acquired (bool): False if the lock was not acquired within SINGLEFLIGHT_MAX_WAIT.
+        waited (bool): Whether the lock was held by another request.
+    """
+
+    waited = False
+
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True, waited
+        except BlockingIOError:
+            waited = True
+            check_deadline(model_name, deadline, "coalescing")
+            if time.time() - wait_start > SINGLEFLIGHT_MAX_WAIT:
+                return False, waited
+            time.sleep(SINGLEFLIGHT_POLL_INTERVAL)
+
+
+def is_current(lock_file, lock_path):
+    """ Returns whether the opened lock file is still the file at lock_path. """
+
+    try:
+        current = os.stat(lock_path)
+    except FileNotFoundError:
+        return False
+
+    opened = os.fstat(lock_file.fileno())
+    return (opened.st_dev, opened.st_ino) == (current.st_dev, current.st_ino)
+
+
+def sweep():
+    """ Removes the files of keys which were not requested for a while, at most once per SWEEP_INTERVAL. """
+
+    global last_sweep
+
+    now = time.time()
+    if now - last_sweep < SWEEP_INTERVAL:
+        return
+    last_sweep = now
+
+    for lock_path in glob.glob(os.path.join(SINGLEFLIGHT_DIR, '*.lock')):
+        try:
+            if now - os.path.getmtime(lock_path) < SINGLEFLIGHT_FILE_TTL:
+                continue
+
+            with open(lock_path, 'a') as lock_file:
+                # Keys in flight keep their files
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                result_path = lock_path[:-len('.lock')] + '.json'
+                if os.path.exists(result_path):
+                    os.remove(result_path)
+                os.remove(lock_path)
+
+        except (BlockingIOError, FileNotFoundError):
+            continue
@@ -0,0 +1,326 @@
+import os
+import json
+import math
+import glob
+import time
+import threading
+
+from prometheus_client import REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+
+import log
+
+logger = log.get_logger("sketch")
+
+#########################################################################
+### Streaming Quantile Sketches
+#########################################################################
+#
+# Per-request signals (image size, word counts, confidence scores, ...) are recorded in DDSketches
+# with a relative accuracy of SKETCH_RELATIVE_ACCURACY. Every worker keeps one sketch per signal, model
+# and time slice of SKETCH_SLICE_SECONDS and writes them to sketch_<pid>.json in the Prometheus
+# multiprocess directory. Sketches merge losslessly, so a scrape merges the slices of all workers
+# into exact-within-accuracy quantiles per time window.
+
+SKETCH_RELATIVE_ACCURACY = float(os.environ.get('SKETCH_RELATIVE_ACCURACY', 0.01))
+SKETCH_MAX_BINS = int(os.environ.get('SKETCH_MAX_BINS', 1024))
+SKETCH_SLICE_SECONDS = int(os.environ.get('SKETCH_SLICE_SECONDS', 60))
+SKETCH_FLUSH_INTERVAL = float(os.environ.get('SKETCH_FLUSH_INTERVAL', 5))
+SKETCH_QUANTILES = (0.5, 0.9, 0.99)
+
+# Values below are counted as zero, e.g. confidence scores which underflow
+MIN_INDEXABLE_VALUE = 1e-9
+
+SIGNALS = {
+    'image_width_pixels': 'Width of the image in pixels',
+    'image_height_pixels': 'Height of the image in pixels',
+    'ocr_word_count': 'Amount of recognized words per image',
+    'question_word_length': 'Amount of words per question',
+    'bounding_box_coverage': 'Relative bounding box coverage in percent',
+    'avg_bounding_box_area': 'Average bounding box area per image',
+    'confidence_score_start': 'Confidence score of the answer start',
+    'confidence_score_end': 'Confidence score of the answer end',
+}
+
+
+def parse_windows(value):
+    """ Parses a comma separated list of durations like "1m,5m,1h" into (label, seconds) pairs. """
+
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    windows = []
+
+    for label in value.split(','):
+        label = label.strip()
+        if label:
+            windows.append((label, int(label[:-1]) * units[label[-1]]))
+
+    return windows
+
+
+SKETCH_WINDOWS = parse_windows(os.environ.get('SKETCH_WINDOWS', '1m,5m,1h'))
+MAX_WINDOW_SECONDS = max(seconds for _, seconds in SKETCH_WINDOWS)
+
+
+class DDSketch:
+    """
+    Quantile sketch with logarithmic bins, every quantile is returned within the relative accuracy.
+
+    Memory is bounded by max_bins, once exceeded the lowest bins are collapsed, which only affects low quantiles.
+    """
+
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY, max_bins=SKETCH_MAX_BINS):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value, count=1):
+        if value < MIN_INDEXABLE_VALUE:
+            self.zero_count += count
+        else:
+            index = math.ceil(math.log(value) / self.log_gamma)
+            self.bins[index] = self.bins.get(index, 0) + count
+            if len(self.bins) > self.max_bins:
+                self.collapse()
+        self.count += count
+
+    def merge(self, other):
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        if len(self.bins) > self.max_bins:
+            self.collapse()
+
+    def collapse(self):
+        indices = sorted(self.bins)
+        excess = len(indices) - self.max_bins
+        target = indices[excess]
+        for index in indices[:excess]:
+            self.bins[target] += self.bins.pop(index)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return math.nan
+
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+
+        cumulative = self.zero_count
+        for index in sorted(self.bins):
+            cumulative += self.bins[index]
+            if cumulative > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def to_dict(self):
+        return {"zero_count": self.zero_count, "bins": self.bins}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls()
+        sketch.zero_count = data["zero_count"]
+        sketch.bins = {int(index): count for index, count in data["bins"].items()}
+        sketch.count = sketch.zero_count + sum(sketch.bins.values())
+        return sketch
+
+
+class SketchStore:
+    """ Sketches of one process by (signal, model name) and slice start, slices older than the largest window are dropped. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.slices = {}
+        self.dirty = False
+
+    def observe(self, signal, model_name, value, now=None):
+        slice_start = int((now or time.time()) // SKETCH_SLICE_SECONDS) * SKETCH_SLICE_SECONDS
+
+        with self.lock:
+            series = self.slices.setdefault((signal, model_name), {})
+            sketch = series.get(slice_start)
+            if sketch is None:
+                sketch = series[slice_start] = DDSketch()
+                self.prune(slice_start)
+            sketch.add(value)
+            self.dirty = True
+
+    def merge(self, other):
+        with self.lock:
+            for key, series in other.slices.items():
+                target = self.slices.setdefault(key, {})
+                for slice_start, sketch in series.items():
+                    if slice_start in target:
+                        target[slice_start].merge(sketch)
+                    else:
+                        target[slice_start] = sketch
+            self.dirty = True
+
+    def prune(self, now):
+        oldest = now - MAX_WINDOW_SECONDS
+        for series in self.slices.values():
+            for slice_start in [start for start in series if start <= oldest]:
+                del series[slice_start]
+
+    def window(self, signal, model_name, seconds, now):
+        """ Returns the merge of all slices of a series within the last seconds. """
+
+        merged = DDSketch()
+        with self.lock:
+            for slice_start, sketch in self.slices.get((signal, model_name), {}).items():
+                if slice_start > now - seconds:
+                    merged.merge(sketch)
+        return merged
+
+    def to_json(self):
+        with self.lock:
+            return json.dumps([
+                {"signal": signal, "model_name": model_name, "slices": {str(start): sketch.to_dict() for start, sketch in series.items()}}
+                for (signal, model_name), series in self.slices.items()
+            ])
+
+    @classmethod
+    def from_json(cls, text):
+        store = cls()
+        for series in json.loads(text):
+            store.slices[(series["signal"], series["model_name"])] = {
+                int(start): DDSketch.from_dict(sketch) for start, sketch in series["slices"].items()
+            }
+        return store
+
+
+store = SketchStore()
+store_pid = None
+store_lock = threading.Lock()
+flusher = None
+
+
+def get_directory():
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir')
+
+
+def observe(signal, model_name, value):
+    """ Records a value of a signal in the sketches of the current process. """
+
+    global store, store_pid
+
+    if store_pid != os.getpid():
+        with store_lock:
+            if store_pid != os.getpid():
+                # A forked worker must not report the sketches of its parent
+                store = SketchStore()
+                store_pid = os.getpid()
+                start_flusher()
+
+    store.observe(signal, model_name, value)
+
+
+def write_store(path, sketch_store):
+    with open(path + '.tmp', 'w') as f:
+        f.write(sketch_store.to_json())
+    os.replace(path + '.tmp', path)
+
+
+def read_store(path):
+    try:
+        with open(path, 'r') as f:
+            return SketchStore.from_json(f.read())
+    except (OSError, ValueError):
+        return SketchStore()
+
+
+def flush():
+    """ Writes the sketches of the current process to the multiprocess directory if they changed. """
+
+    directory = get_directory()
+    if not directory or not store.dirty:
+        return
+
+    store.dirty = False
+    write_store(os.path.join(directory, f'sketch_{os.getpid()}.json'), store)
+
+
+def start_flusher():
+    global flusher
+
+    if not get_directory():
+        return
+
+    def run():
+        while True:
+            time.sleep(SKETCH_FLUSH_INTERVAL)
+            try:
+                flush()
+            except OSError as e:
+                logger.warning(f"Writing sketches failed: {e}")
+
+    flusher = threading.Thread(target=run, name="sketch-flush", daemon=True)
+    flusher.start()
+
+
+def compact_worker(directory, pid):
+    """ Merges the sketches of an exited worker into sketch_compacted.json, called by the gunicorn master. """
+
+    path = os.path.join(directory, f'sketch_{pid}.json')
+    if not os.path.exists(path):
+        return
+
+    compacted_path = os.path.join(directory, 'sketch_compacted.json')
+    compacted = read_store(compacted_path)
+    compacted.merge(read_store(path))
+    compacted.prune(time.time())
+    write_store(compacted_path, compacted)
+
+    os.remove(path)
+
+
+def clear_directory(directory):
+    for path in glob.glob(os.path.join(directory, 'sketch_*.json')):
+        os.remove(path)
+
+
+class SketchCollector:
+    """ Exposes p50/p90/p99 per signal, model and window, merged over all workers if a multiprocess directory is set. """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+
+    def load(self):
+        if not self.directory:
+            return store
+
+        merged = SketchStore()
+        for path in glob.glob(os.path.join(self.directory, 'sketch_*.json')):
+            merged.merge(read_store(path))
+        return merged
+
+    def collect(self):
+        merged = self.load()
+        now = time.time()
+
+        with merged.lock:
+            keys = list(merged.slices)
+
+        for signal, documentation in SIGNALS.items():
+            quantiles = GaugeMetricFamily(f'{signal}_sketch', f'{documentation}, quantiles per time window', labels=['model_name', 'window', 'quantile'])
+            counts = GaugeMetricFamily(f'{signal}_sketch_observations', f'{documentation}, amount of observations per time window', labels=['model_name', 'window'])
+
+            for model_name in sorted({model_name for key_signal, model_name in keys if key_signal == signal}):
+                for label, seconds in SKETCH_WINDOWS:
+                    sketch = merged.window(signal, model_name, seconds, now)
+                    counts.add_metric([model_name, label], sketch.count)
+                    if sketch.count:
+                        for q in SKETCH_QUANTILES:
+                            quantiles.add_metric([model_name, label, str(q)], sketch.quantile(q))
+
+            yield quantiles
+            yield counts
+
+
+if not get_directory():
+    # Single process, the default registry is exposed directly
+    REGISTRY.register(SketchCollector())
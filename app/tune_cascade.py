@@ -0,0 +1,119 @@
+import os
+import csv
+import json
+import argparse
+
+import torch
+
+import model.layoutlmv3 as layoutlmv3
+from similarity import anls
+
+#########################################################################
+### Offline tuning of the cascade threshold
+#########################################################################
+#
+# Runs the first stage and the full model over a labelled DocVQA split and picks the
+# CASCADE_THRESHOLD which escalates the fewest requests while reaching the target ANLS.
+#
+#   CASCADE_FIRST_STAGE=quantized python tune_cascade.py --dataset val_v1.0_withQT.json --root-dir data/ --target-anls 0.75
+#
+# The collected scores are stored as CSV, --scores re-tunes from such a file without running the models.
+
+
+def collect_scores(dataset_path, root_dir, max_records):
+    """ Runs both cascade stages over the dataset and returns confidence and ANLS per record. """
+
+    with open(dataset_path, "r") as f:
+        records = json.load(f)["data"][:max_records]
+
+    scores = []
+
+    with torch.inference_mode():
+        for index, record in enumerate(records):
+            with open(os.path.join(root_dir, record["image"]), "rb") as f:
+                pil_image = layoutlmv3.convert_image(f.read())
+
+            encoded_data, _, _ = layoutlmv3.encoding(record["question"], pil_image)
+
+            outputs = layoutlmv3.forward(encoded_data, layoutlmv3.first_stage_model)
+            first_answer, first_s, first_e = layoutlmv3.answer(encoded_data, outputs)
+            full_answer, _, _ = layoutlmv3.inference(encoded_data)
+
+            scores.append({
+                "question_id": record.get("questionId", index),
+                "first_stage_confidence": min(first_s, first_e),
+                "first_stage_anls": anls(first_answer, record["answers"]),
+                "full_anls": anls(full_answer, record["answers"]),
+            })
+
+            print(f"[*] Tuning: {index + 1}/{len(records)}", flush=True)
+
+    return scores
+
+
+def sweep(scores, steps=100):
+    """ Returns mean ANLS and escalation rate of the cascade for every threshold between 0 and 1. """
+
+    results = []
+
+    for step in range(steps + 1):
+        threshold = step / steps
+        escalated = [score["first_stage_confidence"] < threshold for score in scores]
+        cascade_anls = [
+            score["full_anls"] if escalate else score["first_stage_anls"]
+            for score, escalate in zip(scores, escalated)
+        ]
+        results.append({
+            "threshold": threshold,
+            "anls": sum(cascade_anls) / len(scores),
+            "escalation_rate": sum(escalated) / len(scores),
+        })
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pick the cascade threshold for a target ANLS.")
+    parser.add_argument("--dataset", help="DocVQA annotation file (json with a data list)")
+    parser.add_argument("--root-dir", default=".")
+    parser.add_argument("--max-records", type=int, default=500)
+    parser.add_argument("--target-anls", type=float, required=True)
+    parser.add_argument("--scores", help="CSV of previously collected scores")
+    parser.add_argument("--output", default="cascade_scores.csv")
+    args = parser.parse_args()
+
+    if args.scores:
+        with open(args.scores, "r") as f:
+            scores = [{key: float(value) for key, value in row.items()} for row in csv.DictReader(f)]
+    else:
+        if not layoutlmv3.CASCADE_FIRST_STAGE:
+            parser.error("CASCADE_FIRST_STAGE has to be set in order to collect scores")
+
+        layoutlmv3.load()
+        scores = collect_scores(args.dataset, args.root_dir, args.max_records)
+
+        with open(args.output, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(scores[0]))
+            writer.writeheader()
+            writer.writerows(scores)
+
+    results = sweep(scores)
+    full_anls = sum(score["full_anls"] for score in scores) / len(scores)
+
+    print(f"Full model ANLS: {full_anls:.4f} over {len(scores)} records")
+    print(f"{'threshold':>10}{'ANLS':>10}{'escalated':>11}")
+    for result in results[::10]:
+        print(f"{result['threshold']:>10.2f}{result['anls']:>10.4f}{result['escalation_rate']:>10.1%}")
+
+    feasible = [result for result in results if result["anls"] >= args.target_anls]
+
+    if not feasible:
+        print(f"No threshold reaches ANLS {args.target_anls}, use the full model only")
+        return
+
+    best = min(feasible, key=lambda result: (result["escalation_rate"], result["threshold"]))
+    print(f"CASCADE_THRESHOLD={best['threshold']:.2f} (ANLS {best['anls']:.4f}, {best['escalation_rate']:.1%} escalated)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+
+from PIL import Image, ImageDraw
+import bson
+from minio.error import S3Error
+
+# Modules of the backend
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import database
+import model.layoutlmv3 as layoutlmv3
+
+#########################################################################
+### Stage-level micro-benchmarks of the inference pipeline
+#########################################################################
+#
+# Times every stage of layoutlmv3.start_inference in isolation over a fixed corpus and compares
+# the median durations with a JSON baseline. Databases are replaced by in-memory stand-ins which
+# still BSON-encode every document, so the serialization cost of the writes is measured.
+#
+#   python benchmarks/stages.py --update-baseline      # record a new baseline
+#   python benchmarks/stages.py --threshold 10         # fail if a stage got >10% slower
+#
+# Run without prometheus_multiproc_dir set, otherwise metric updates write to the shared mmap files.
+# docker-compose mounts this directory into the backend container at /benchmarks:
+#   docker compose exec backend env -u prometheus_multiproc_dir python /benchmarks/stages.py --threshold 10
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+QUESTIONS = [
+    "What is the invoice number?",
+    "What is the total amount?",
+    "Who is the sender of the letter?",
+    "What is the date mentioned in the document?",
+]
+
+VOCABULARY = ["invoice", "total", "amount", "date", "sender", "company", "address", "payment", "order", "number",
+              "report", "budget", "tax", "due", "account", "customer", "item", "price", "quantity", "signature"]
+
+
+class InMemoryCollection:
+    """ Stand-in for a pymongo collection, documents are BSON-encoded like on the wire. """
+
+    def __init__(self):
+        self.documents = []
+
+    def insert_one(self, document):
+        self.documents.append(bson.encode(document))
+
+
+class InMemoryObjectStore:
+    """ Stand-in for the MinIO client, supports the calls of database.insert_image(). """
+
+    def __init__(self):
+        self.objects = {}
+
+    def stat_object(self, bucket_name, object_name):
+        if object_name not in self.objects:
+            raise S3Error("NoSuchKey", "Object does not exist", object_name, None, None, None)
+        return object_name
+
+    def put_object(self, bucket_name, object_name, data, length, content_type):
+        self.objects[object_name] = data.read(length)
+
+
+def build_corpus(size, seed):
+    """ Renders a fixed set of synthetic document pages with printed text lines. """
+
+    rng = random.Random(seed)
+    corpus = []
+
+    for index in range(size):
+        width, height = rng.choice([(1240, 1754), (1700, 2200), (2480, 3508)])
+        image = Image.new("RGB", (width, height), "white")
+        draw = ImageDraw.Draw(image)
+
+        line_height = height // 60
+        for line in range(rng.randint(15, 55)):
+            text = " ".join(rng.choice(VOCABULARY) for _ in range(rng.randint(3, 12)))
+            draw.text((width // 12, line_height * (line + 2)), text, fill="black")
+
+        buffered = io.BytesIO()
+        image.save(buffered, format="PNG")
+        corpus.append((QUESTIONS[index % len(QUESTIONS)], buffered.getvalue()))
+
+    return corpus
+
+
+def install_stand_ins():
+    """ Replaces the storage clients of the database module with in-memory stand-ins. """
+
+    database.mongodb_client = object()
+    database.mongodb_pid = os.getpid()
+    database.collections[layoutlmv3.model_name] = InMemoryCollection()
+
+    database.minio_client = InMemoryObjectStore()
+    database.minio_pid = os.getpid()
+
+
+def run_stages(question, image):
+    """ Runs every pipeline stage once and returns the duration of each stage in seconds. """
+
+    durations = {}
+
+    def timed(stage, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        durations[stage] = time.perf_counter() - start
+        return result
+
+    pil_image = timed("image_conversion", layoutlmv3.convert_image, image)
+
+    processed_image = timed("ocr", layoutlmv3.image_processor.preprocess, pil_image)
+    words, boxes = processed_image.words[0], processed_image.boxes[0]
+
+    encoded_data = timed("tokenization", layoutlmv3.encoder, pil_image, question, words, boxes=boxes, return_tensors="pt", max_length=512, padding="max_length", truncation=True)
+
+    outputs = timed("forward_pass", layoutlmv3.forward, encoded_data)
+
+    result, confidence_score_s, confidence_score_e = timed("answer_decoding", layoutlmv3.answer, encoded_data, outputs)
+
+    encoded_dict = timed("feature_serialization", layoutlmv3.tensor_to_json, encoded_data)
+
+    image_hash = timed("image_hash", database.generate_image_hash, pil_image)
+
+    stored_image = timed("image_encoding", database.encode_image, image)
+
+    timed("metric_updates", layoutlmv3.update_metrics, question, pil_image, words, boxes, encoded_dict['input_ids'][0], confidence_score_s, confidence_score_e)
+
+    data_input = {
+        'inference_id': f"benchmark-{time.perf_counter_ns()}",
+        'question': question,
+        'image': f"{layoutlmv3.model_name}/{image_hash}.{stored_image.extension}",
+        'words': words,
+        'input_ids': encoded_dict['input_ids'],
+        'attention_mask': encoded_dict['attention_mask'],
+        'bbox': encoded_dict['bbox'],
+        'pixel_values': encoded_dict['pixel_values'],
+        'result': result,
+        'confidence_score_start': confidence_score_s,
+        'confidence_score_end': confidence_score_e,
+        'feedback_type': "None"
+    }
+
+    timed("db_insert_data", database.insert_data, layoutlmv3.model_name, data_input)
+    timed("db_insert_image", database.insert_image, layoutlmv3.model_name, data_input['image'], stored_image.data, stored_image.content_type)
+
+    return durations
+
+
+def benchmark(corpus, repetitions, warmup):
+    """ Runs the corpus repeatedly and returns median and p95 duration (ms) per stage. """
+
+    for question, image in corpus[:warmup]:
+        run_stages(question, image)
+
+    samples = {}
+    for _ in range(repetitions):
+        install_stand_ins()
+        for question, image in corpus:
+            for stage, duration in run_stages(question, image).items():
+                samples.setdefault(stage, []).append(duration * 1000)
+
+    results = {}
+    for stage, values in samples.items():
+        values.sort()
+        results[stage] = {
+            "median_ms": statistics.median(values),
+            "p95_ms": values[min(len(values) - 1, int(len(values) * 0.95))],
+            "samples": len(values),
+        }
+
+    return results
+
+
+def compare(results, baseline, threshold, stage_thresholds):
+    """ Returns the stages whose median exceeds the baseline median by more than the allowed percentage. """
+
+    regressions = []
+
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+
+        allowed = stage_thresholds.get(stage, threshold)
+        change = (result["median_ms"] / baseline[stage]["median_ms"] - 1) * 100
+
+        status = "REGRESSION" if change > allowed else "ok"
+        print(f"{stage:<24}{baseline[stage]['median_ms']:>12.3f}{result['median_ms']:>12.3f}{change:>+10.1f}%  {status}")
+
+        if change > allowed:
+            regressions.append(stage)
+
+    return regressions
+
+
+def parse_stage_thresholds(values):
+    stage_thresholds = {}
+    for value in values:
+        stage, percentage = value.split("=")
+        stage_thresholds[stage] = float(percentage)
+    return stage_thresholds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stage-level micro-benchmarks with regression thresholds.")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as new baseline instead of comparing")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed slowdown of the median in percent")
+    parser.add_argument("--stage-threshold", action="append", default=[], help="per-stage threshold, e.g. ocr=20")
+    parser.add_argument("--corpus-size", type=int, default=8)
+    parser.add_argument("--repetitions", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    layoutlmv3.load()
+    install_stand_ins()
+    corpus = build_corpus(args.corpus_size, args.seed)
+    results = benchmark(corpus, args.repetitions, args.warmup)
+
+    if args.update_baseline or not os.path.exists(args.baseline):
+        with open(args.baseline, "w") as f:
+            json.dump({"corpus_size": args.corpus_size, "seed": args.seed, "stages": results}, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        for stage, result in results.items():
+            print(f"{stage:<24}{result['median_ms']:>12.3f} ms (p95 {result['p95_ms']:.3f} ms)")
+        return
+
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+
+    if baseline.get("corpus_size") != args.corpus_size or baseline.get("seed") != args.seed:
+        print("Warning: corpus differs from the baseline corpus, results are not comparable")
+
+    print(f"{'stage':<24}{'baseline ms':>12}{'current ms':>12}{'change':>11}")
+    regressions = compare(results, baseline["stages"], args.threshold, parse_stage_thresholds(args.stage_threshold))
+
+    if regressions:
+        print(f"Regressed stages: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()